@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+
+from name_table import in_ranking
+from profiling import profiled
+
+FREQUENCY_COLUMNS = {'frequency_male': 'M', 'frequency_female': 'F'}
+
+
+def group_keys(df, keys):
+    # A frame with several countries (sources.combine_sources) is analyzed separately for every country
+    # in the same grouped pass, so the 'country' column is added to the keys
+    return ['country'] + list(keys) if 'country' in df.columns else list(keys)
+
+
+# Task 4
+@profiled
+def births_by_sex(df):
+    # Sum the number of boys and girls born each year (a small table with one row for every year and sex)
+    return df.groupby(group_keys(df, ['year', 'sex']), observed=True)['count'].sum()
+
+
+@profiled
+def calculate_frequency(df, dtype='float64'):
+    # Calculate the ratio between count of specific name to the total number of births for the gender in that year.
+    # Only a single 'frequency' column is stored (the old frequency_male/frequency_female columns were 0 for half
+    # of the rows) - they are still available through df.legacy['frequency_male'] and df.legacy['frequency_female']
+    total_births_by_sex = df.groupby(group_keys(df, ['year', 'sex']), observed=True)['count'].transform('sum')
+    df['frequency'] = (df['count'] / total_births_by_sex).astype(dtype)
+    return df
+
+
+@pd.api.extensions.register_dataframe_accessor('legacy')
+class LegacyFrequencyAccessor:
+    # Compatibility accessor for the old columns - frequency of the name for one sex and 0 for the other one
+
+    def __init__(self, df):
+        self._df = df
+
+    def __getitem__(self, column):
+        if column not in FREQUENCY_COLUMNS:
+            raise KeyError(column)
+        frequency = np.where(self._df['sex'] == FREQUENCY_COLUMNS[column], self._df['frequency'], 0)
+        return pd.Series(frequency, index=self._df.index, name=column)
+
+
+# Task 6
+@profiled
+def top_n_from_frequency(names_frequency, n):
+    # Get the top n names for both genders separately (from the sum of the frequency of each name over the years)
+    sexes = names_frequency.index.get_level_values('sex')
+    names_df = pd.DataFrame({column: np.where(sexes == sex, names_frequency, 0.0)
+                             for column, sex in FREQUENCY_COLUMNS.items()}, index=names_frequency.index)
+
+    top_male_names = names_df.nlargest(n, 'frequency_male')
+    top_female_names = names_df.nlargest(n, 'frequency_female')
+    return pd.concat([top_male_names, top_female_names])
+
+
+@profiled
+def names_frequency(df):
+    # Calculate the frequency of each name over the years (divided by the number of years of its country)
+    sums = df.groupby(group_keys(df, ['name', 'sex']), observed=True)['frequency'].sum()
+    if 'country' in df.columns:
+        number_of_years = df.groupby('country', observed=True)['year'].nunique()
+        return (sums / number_of_years.reindex(sums.index.get_level_values('country')).to_numpy()).astype('float64')
+    return (sums / df['year'].nunique()).astype('float64')
+
+
+@profiled
+def top_n_names(frequency, n):
+    # top_n_from_frequency of every country (n can be a dict with a different n for every country)
+    if 'country' not in frequency.index.names:
+        return top_n_from_frequency(frequency, n)
+    return pd.concat({country: top_n_from_frequency(country_frequency.droplevel('country'),
+                                                    n[country] if isinstance(n, dict) else n)
+                      for country, country_frequency in frequency.groupby(level='country', observed=True)},
+                     names=['country'])
+
+
+@profiled
+def calculate_top_n_names(df, n):
+    return top_n_names(names_frequency(df), n)
+
+
+# Task 8
+@profiled
+def calculate_name_diversity(df, top_names):
+    # Check if the name is in the ranking of top n names (the lookup is done on the integer name ids)
+    df['in_top'] = in_ranking(df, top_names.index)
+
+    # Calculate the percentage of names in the top n ranking
+    diversity_pt = df.pivot_table(index=group_keys(df, ['year', 'sex']), columns='in_top', values='count', aggfunc='sum', fill_value=0,
+                                  observed=True)
+    diversity_pt['top_percentage'] = diversity_pt[True] / (diversity_pt[True] + diversity_pt[False])
+
+    # Calculate the difference in diversity between male and female names
+    reshaped = diversity_pt['top_percentage'].unstack(level='sex')
+    reshaped['difference'] = abs(reshaped['M'] - reshaped['F'])
+    return df, reshaped
+
+
+# Task 9
+@profiled
+def calculate_last_letter_distribution(df):
+    # Aggregate the births by year, sex and last letter and normalize by the number of births in each year
+    last_letter_df = df.groupby(group_keys(df, ['year', 'sex', 'last_letter']), observed=True)['count'].sum().unstack(level='last_letter', fill_value=0)
+    last_letter_df = last_letter_df.div(last_letter_df.sum(axis=1), axis=0)
+    return last_letter_df
+
+
+# Task 10
+@profiled
+def gender_ratio_from_counts(grouped_birth_name_df, only_top):
+    # grouped_birth_name_df - sum of 'count' and 'in_top' for every (name, sex) pair
+    grouped_birth_name_df = grouped_birth_name_df.unstack(level='sex')
+    # Drop rows where the name is not in the top 1000 (if only_top flag is True)
+    if only_top:
+        grouped_birth_name_df = grouped_birth_name_df[grouped_birth_name_df[('in_top', 'F')] + grouped_birth_name_df[('in_top', 'M')] > 0]
+    # Calculate the ratio of the name being given to males versus females
+    grouped_birth_name_df['p_m'] = grouped_birth_name_df[('count', 'M')] / (grouped_birth_name_df[('count', 'M')] + grouped_birth_name_df[('count', 'F')])
+    grouped_birth_name_df['p_f'] = 1 - grouped_birth_name_df['p_m']
+    # Drop unnecessary columns (if only_top flag is True)
+    if only_top:
+        grouped_birth_name_df = grouped_birth_name_df.drop(columns=[('count', 'F'), ('count', 'M'), ('in_top', 'F'), ('in_top', 'M')])
+
+    return grouped_birth_name_df
+
+
+@profiled
+def calculate_name_gender_ratio(df, start_year, end_year, only_top):
+    # Drop rows where year is not in the specified range
+    filtered_df = df[df['year'].between(start_year, end_year)]
+
+    # Group the data
+    grouped_birth_name_df = filtered_df.groupby(group_keys(filtered_df, ['name', 'sex']), observed=True)[['count', 'in_top']].sum().fillna(0)
+    return gender_ratio_from_counts(grouped_birth_name_df, only_top)
@@ -0,0 +1,428 @@
+import argparse
+import math
+import os
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+
+from analysis import calculate_frequency, calculate_name_diversity, calculate_top_n_names
+from name_table import encode_names
+from sources import DEFAULT_SOURCES, country_aliases, load_sources
+
+# Approximate mode - every (country, year) of the data is summarized once by small sketches of every sex, and the
+# unique names, the top n rankings and the diversity of any range of years are answered by merging the sketches
+# of its years (without the rows):
+#  - HyperLogLog of the names (unique names, relative standard error 1.04 / sqrt(2 ** HLL_PRECISION))
+#  - the HEAVY_HITTERS most popular names with their exact frequency (heavy hitters) and a Count-Min sketch of the
+#    frequency of all the names, which bounds the frequency of the names that aren't among the heavy hitters.
+# Every frequency is an upper bound of the exact value with a deterministic error: estimate - error <= exact <= estimate
+HLL_PRECISION = 14
+CMS_WIDTH = 2 ** 10
+CMS_DEPTH = 4
+HEAVY_HITTERS = 2000
+SKETCH_VERSION = 1
+SKETCHES_PATH = os.path.join('data', 'cache', 'sketches.pkl')
+# Length of the rankings of every country (the same as in main.py)
+TOP_N = {'USA': 1000, 'Poland': 200}
+
+# Odd multipliers of the multiply-shift hashes of the rows of the Count-Min sketch (fixed, so the sketches built
+# in different processes or runs can be merged)
+CMS_MULTIPLIERS = np.random.default_rng(0x5eed).integers(1, 2 ** 63, size=16, dtype=np.uint64) * np.uint64(2) + \
+    np.uint64(1)
+
+
+def name_hashes(names):
+    # 64-bit hash of every name (the same in every process and run)
+    return pd.util.hash_array(np.asarray(names, dtype=object))
+
+
+def bit_length(values):
+    # Number of bits of every uint64 value (0 for 0) - the halves are converted to float64 exactly
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xffffffff)).astype(np.float64)
+    return np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1])
+
+
+class HyperLogLog:
+    # Distinct count of the hashes - the registers of two sketches are merged with a maximum
+
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.registers = np.zeros(2 ** precision, dtype=np.uint8) if registers is None else registers
+
+    def add(self, hashes):
+        # The first bits select the register, the position of the first 1 bit of the rest is the rank
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.intp)
+        rest = hashes << np.uint64(self.precision)
+        ranks = np.minimum(64 - bit_length(rest) + 1, 64 - self.precision + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, ranks)
+
+    @classmethod
+    def merge(cls, sketches):
+        return cls(sketches[0].precision, np.maximum.reduce([sketch.registers for sketch in sketches]))
+
+    def count(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting for the small cardinalities
+            estimate = m * math.log(m / zeros)
+        return float(estimate)
+
+    def relative_error(self):
+        return 1.04 / math.sqrt(len(self.registers))
+
+
+class CountMinSketch:
+    # Sum of the weights of every hash - the estimate is never lower than the exact sum, and it's higher by at most
+    # e / width * total with the probability 1 - exp(-depth). The tables of two sketches are merged with a sum
+
+    def __init__(self, width=CMS_WIDTH, depth=CMS_DEPTH, table=None, total=0.0):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width)) if table is None else table
+        self.total = total
+
+    def columns(self, hashes, row):
+        # Multiply-shift hash of the row (the width is a power of 2)
+        return ((np.asarray(hashes, dtype=np.uint64) * CMS_MULTIPLIERS[row]) >>
+                np.uint64(64 - int(math.log2(self.width)))).astype(np.intp)
+
+    def add(self, hashes, weights):
+        for row in range(self.depth):
+            self.table[row] += np.bincount(self.columns(hashes, row), weights=weights, minlength=self.width)
+        self.total += float(np.sum(weights))
+
+    def estimate(self, hashes):
+        return np.min([self.table[row, self.columns(hashes, row)] for row in range(self.depth)], axis=0)
+
+    @classmethod
+    def merge(cls, sketches):
+        return cls(sketches[0].width, sketches[0].depth, np.sum([sketch.table for sketch in sketches], axis=0),
+                   sum(sketch.total for sketch in sketches))
+
+    def error_bound(self):
+        return math.e / self.width * self.total
+
+
+class NameSketch:
+    # Sketch of the names given to one sex in a part of the data: the heavy hitters (sorted by the hash) with their
+    # frequency and its error, and threshold - the upper bound of the frequency of any name that isn't among them
+
+    def __init__(self, hll, cms, keys, names, weights, errors, threshold):
+        self.hll = hll
+        self.cms = cms
+        self.keys = keys
+        self.names = names
+        self.weights = weights
+        self.errors = errors
+        self.threshold = threshold
+
+    @classmethod
+    def from_weights(cls, hashes, names, weights, heavy_hitters=HEAVY_HITTERS, precision=HLL_PRECISION,
+                     width=CMS_WIDTH, depth=CMS_DEPTH):
+        # Sketch of the rows of a part of the data (every name once) - the heavy hitters are exact
+        hll = HyperLogLog(precision)
+        hll.add(hashes)
+        cms = CountMinSketch(width, depth)
+        cms.add(hashes, weights)
+        return cls.top(hll, cms, hashes, names, weights, np.zeros(len(weights)), 0.0, heavy_hitters)
+
+    @classmethod
+    def top(cls, hll, cms, keys, names, weights, errors, threshold, heavy_hitters):
+        # Keep only the heavy_hitters names with the highest frequency, the others raise the threshold
+        if len(keys) > heavy_hitters:
+            kept = np.argpartition(-weights, heavy_hitters - 1)[:heavy_hitters]
+            dropped = np.ones(len(keys), dtype=bool)
+            dropped[kept] = False
+            threshold = max(threshold, float(weights[dropped].max()))
+            keys, names, weights, errors = keys[kept], names[kept], weights[kept], errors[kept]
+        order = np.argsort(keys)
+        return cls(hll, cms, keys[order], names[order], weights[order], errors[order], threshold)
+
+    def estimate(self, hashes):
+        # Upper bound of the frequency of every name and its error (estimate - error <= exact <= estimate)
+        positions = np.minimum(np.searchsorted(self.keys, hashes), max(len(self.keys) - 1, 0))
+        found = self.keys[positions] == hashes if len(self.keys) else np.zeros(len(hashes), dtype=bool)
+        weights = np.empty(len(hashes))
+        errors = np.empty(len(hashes))
+        weights[found] = self.weights[positions[found]]
+        errors[found] = self.errors[positions[found]]
+        # The other names - at most the threshold and the Count-Min estimate (0 is the lower bound)
+        bound = np.minimum(self.cms.estimate(hashes[~found]), self.threshold)
+        weights[~found] = bound
+        errors[~found] = bound
+        return weights, errors
+
+    @classmethod
+    def merge(cls, sketches, heavy_hitters=HEAVY_HITTERS):
+        # Sketch of the union of the parts - the frequencies of the heavy hitters of every part are summed over
+        # the parts in which they are heavy hitters, and the rest (the parts in which they aren't) is bounded by
+        # the sum of the thresholds of those parts and by the merged Count-Min estimate minus the lower bounds
+        # of the summed frequencies (the whole merge is a single grouped sum)
+        hll = HyperLogLog.merge([sketch.hll for sketch in sketches])
+        cms = CountMinSketch.merge([sketch.cms for sketch in sketches])
+        thresholds = np.array([sketch.threshold for sketch in sketches])
+        parts = np.repeat(np.arange(len(sketches)), [len(sketch.keys) for sketch in sketches])
+        keys, first, positions = np.unique(np.concatenate([sketch.keys for sketch in sketches]), return_index=True,
+                                           return_inverse=True)
+        names = np.concatenate([sketch.names for sketch in sketches])[first]
+        weights = np.concatenate([sketch.weights for sketch in sketches])
+        errors = np.concatenate([sketch.errors for sketch in sketches])
+
+        present_weights = np.bincount(positions, weights=weights, minlength=len(keys))
+        present_errors = np.bincount(positions, weights=errors, minlength=len(keys))
+        absent_thresholds = thresholds.sum() - np.bincount(positions, weights=thresholds[parts], minlength=len(keys))
+        rest = np.clip(np.minimum(absent_thresholds, cms.estimate(keys) - (present_weights - present_errors)), 0, None)
+        return cls.top(hll, cms, keys, names, present_weights + rest, present_errors + rest, thresholds.sum(),
+                       heavy_hitters)
+
+
+class PartitionSketch:
+    # Sketches of every sex of a part of the data (e.g. a year of a country) and the years it covers
+
+    def __init__(self, sexes, years):
+        self.sexes = sexes
+        self.years = frozenset(years)
+
+    @classmethod
+    def merge(cls, partitions, heavy_hitters=HEAVY_HITTERS):
+        sexes = sorted({sex for partition in partitions for sex in partition.sexes})
+        return cls({sex: NameSketch.merge([partition.sexes[sex] for partition in partitions if sex in partition.sexes],
+                                          heavy_hitters)
+                    for sex in sexes},
+                   frozenset().union(*(partition.years for partition in partitions)))
+
+
+def build_sketches(df, heavy_hitters=HEAVY_HITTERS, precision=HLL_PRECISION, width=CMS_WIDTH, depth=CMS_DEPTH):
+    # Sketch of every year of a DataFrame (with the encoded names and the 'frequency' column) - {year: PartitionSketch}
+    categories = df['name'].cat.categories
+    category_hashes = name_hashes(categories)
+    name_ids = df['name'].cat.codes.to_numpy()
+    years = df['year'].to_numpy()
+    sex_ids = df['sex'].cat.codes.to_numpy()
+    frequency = df['frequency'].to_numpy(dtype='float64')
+
+    # Rows sorted by (year, sex), so every part is a contiguous slice
+    order = np.lexsort((sex_ids, years))
+    groups = np.flatnonzero(np.r_[True, (np.diff(years[order]) != 0) | (np.diff(sex_ids[order]) != 0)])
+    sketches = {}
+    for start, end in zip(groups, np.r_[groups[1:], len(order)]):
+        rows = order[start:end]
+        year, sex = int(years[rows[0]]), df['sex'].cat.categories[sex_ids[rows[0]]]
+        sketch = NameSketch.from_weights(category_hashes[name_ids[rows]], np.asarray(categories[name_ids[rows]]),
+                                         frequency[rows], heavy_hitters, precision, width, depth)
+        sketches.setdefault(year, PartitionSketch({}, [year])).sexes[sex] = sketch
+    return sketches
+
+
+def build_country_sketches(sources=DEFAULT_SOURCES, heavy_hitters=HEAVY_HITTERS):
+    # {(country, year): PartitionSketch} of all the sources - every country is summarized separately
+    sketches = {}
+    for country, df in load_sources(sources).items():
+        df, _ = encode_names(df)
+        for year, sketch in build_sketches(calculate_frequency(df), heavy_hitters).items():
+            sketches[country, year] = sketch
+    return sketches
+
+
+def save_sketches(sketches, path, fingerprint=None):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({'version': SKETCH_VERSION, 'fingerprint': fingerprint, 'sketches': sketches}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_sketches(path=SKETCHES_PATH, sources=DEFAULT_SOURCES):
+    # The stored sketches, (re-)built first if they're missing or any of the sources has changed
+    fingerprint = {source.country: source.fingerprint() for source in sources}
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            stored = pickle.load(f)
+        if stored.get('version') == SKETCH_VERSION and stored.get('fingerprint') == fingerprint:
+            return stored['sketches']
+    sketches = build_country_sketches(sources)
+    save_sketches(sketches, path, fingerprint)
+    return sketches
+
+
+def select_partitions(sketches, country, start_year=None, end_year=None):
+    years = sorted(year for sketch_country, year in sketches if sketch_country == country
+                   and (start_year is None or year >= start_year) and (end_year is None or year <= end_year))
+    if not years:
+        raise ValueError(f'No sketches of {country} in the years {start_year}-{end_year}')
+    return [sketches[country, year] for year in years]
+
+
+# Approximate versions of the analyses
+
+def approximate_unique_names(sketches, country, start_year=None, end_year=None):
+    # Estimated number of the unique names (all and of every sex) with the relative standard error of the estimates
+    merged = {sex: HyperLogLog.merge([partition.sexes[sex].hll for partition in
+                                      select_partitions(sketches, country, start_year, end_year)
+                                      if sex in partition.sexes])
+              for sex in ['F', 'M']}
+    all_names = HyperLogLog.merge(list(merged.values()))
+    counts = pd.Series({'all': all_names.count(), **{sex: hll.count() for sex, hll in merged.items()}})
+    return counts, all_names.relative_error()
+
+
+def approximate_top_n_names(sketches, country, n, start_year=None, end_year=None):
+    # The ranking of calculate_top_n_names from the merged sketches - with the error of every score
+    # (exact score in [frequency - error, frequency])
+    merged = PartitionSketch.merge(select_partitions(sketches, country, start_year, end_year), max(n, HEAVY_HITTERS))
+    number_of_years = len(merged.years)
+    parts = []
+    for sex, column in [('M', 'frequency_male'), ('F', 'frequency_female')]:
+        sketch = merged.sexes[sex]
+        order = np.lexsort((sketch.names.astype(str), -sketch.weights))[:n]
+        index = pd.MultiIndex.from_arrays([sketch.names[order], np.full(len(order), sex)], names=['name', 'sex'])
+        scores = {'frequency_male': 0.0, 'frequency_female': 0.0}
+        scores[column] = sketch.weights[order] / number_of_years
+        parts.append(pd.DataFrame({**scores, 'error': sketch.errors[order] / number_of_years}, index=index))
+    return pd.concat(parts)
+
+
+def approximate_name_diversity(sketches, country, top_names, start_year=None, end_year=None):
+    # Percentage of the births of every year and sex given the names of the ranking (the same as the 'reshaped'
+    # table of calculate_name_diversity) from the sketch of every year, with the errors of the percentages
+    pairs = top_names.index.to_frame(index=False)
+    hashes = {sex: name_hashes(pairs.loc[pairs['sex'] == sex, 'name'].astype(str)) for sex in ['F', 'M']}
+    rows = {}
+    for partition in select_partitions(sketches, country, start_year, end_year):
+        row = {}
+        for sex in ['F', 'M']:
+            if sex in partition.sexes:
+                weights, errors = partition.sexes[sex].estimate(hashes[sex])
+                row[sex], row[f'{sex}_error'] = weights.sum(), errors.sum()
+        rows[min(partition.years)] = row
+    reshaped = pd.DataFrame.from_dict(rows, orient='index')
+    reshaped.index.name = 'year'
+    reshaped['difference'] = abs(reshaped['M'] - reshaped['F'])
+    return reshaped[['F', 'M', 'difference', 'F_error', 'M_error']]
+
+
+def validate(sketches, frames, n=None):
+    # Compare the approximate results with the exact ones (calculate_top_n_names, calculate_name_diversity and
+    # nunique) - returns the lines of the report. n is the length of the rankings (by default TOP_N of the country)
+    lines = []
+    for country, df in frames.items():
+        country_n = n or TOP_N.get(country, 1000)
+        df, _ = encode_names(df)
+        df = calculate_frequency(df)
+
+        start = time.perf_counter()
+        counts, relative_error = approximate_unique_names(sketches, country)
+        top_names = approximate_top_n_names(sketches, country, country_n)
+        reshaped = approximate_name_diversity(sketches, country, top_names)
+        approximate_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        exact_counts = pd.Series({'all': df['name'].nunique(),
+                                  **df.groupby('sex', observed=True)['name'].nunique().to_dict()})
+        exact_top_names = calculate_top_n_names(df, country_n)
+        _, exact_reshaped = calculate_name_diversity(df.copy(deep=False), exact_top_names)
+        exact_time = time.perf_counter() - start
+
+        lines.append(f'{country} (top {country_n}): approximate {approximate_time:.3f} s, exact {exact_time:.3f} s')
+        for key in ['all', 'F', 'M']:
+            lines.append(f'  unique names {key}: {counts[key]:.0f} (exact {exact_counts[key]}, '
+                         f'error {counts[key] / exact_counts[key] - 1:+.2%}, standard error {relative_error:.2%})')
+
+        # The exact scores of the names of the approximate ranking have to be within the bounds
+        exact_pairs = exact_top_names.index.to_frame(index=False)
+        scores = df.groupby(['name', 'sex'], observed=True)['frequency'].sum() / df['year'].nunique()
+        for sex, column in [('M', 'frequency_male'), ('F', 'frequency_female')]:
+            approximate = top_names[top_names.index.get_level_values('sex') == sex]
+            exact = exact_pairs[exact_pairs['sex'] == sex]
+            pairs = pd.MultiIndex.from_arrays([pd.Categorical(approximate.index.get_level_values('name'),
+                                                              categories=df['name'].cat.categories),
+                                               pd.Categorical(approximate.index.get_level_values('sex'),
+                                                              categories=df['sex'].cat.categories)])
+            exact_scores = scores.reindex(pairs, fill_value=0).to_numpy()
+            difference = approximate[column].to_numpy() - exact_scores
+            in_bounds = bool(np.all((difference >= -1e-12) & (difference <= approximate['error'].to_numpy() + 1e-12)))
+            overlap = len(set(approximate.index.get_level_values('name').astype(str)) &
+                          set(exact['name'].astype(str))) / max(len(exact), 1)
+            lines.append(f'  top {country_n} {sex}: overlap with the exact ranking {overlap:.2%}, '
+                         f'max score error {np.abs(difference).max(initial=0):.3g} '
+                         f'(max bound {approximate["error"].max():.3g}), within the bounds: {in_bounds}')
+
+        # The diversity of the approximate ranking compared with the exact diversity of the same ranking and with
+        # the exact diversity of the exact ranking
+        _, same_ranking = calculate_name_diversity(df.copy(deep=False), top_names_index(top_names, df))
+        for sex in ['F', 'M']:
+            difference = reshaped[sex] - same_ranking[sex].reindex(reshaped.index)
+            in_bounds = bool(np.all((difference >= -1e-12) & (difference <= reshaped[f'{sex}_error'] + 1e-12)))
+            total = (reshaped[sex] - exact_reshaped[sex].reindex(reshaped.index)).abs().max()
+            lines.append(f'  diversity {sex}: max error {difference.abs().max():.3g} '
+                         f'(max bound {reshaped[f"{sex}_error"].max():.3g}, within the bounds: {in_bounds}), '
+                         f'max difference from the exact ranking {total:.3g}')
+    return lines
+
+
+def top_names_index(top_names, df):
+    # The approximate ranking with the categories of the DataFrame (for in_ranking)
+    index = pd.MultiIndex.from_arrays(
+        [pd.Categorical(top_names.index.get_level_values('name'), categories=df['name'].cat.categories),
+         pd.Categorical(top_names.index.get_level_values('sex'), categories=df['sex'].cat.categories)],
+        names=['name', 'sex'])
+    return top_names.set_axis(index)
+
+
+def sketches_size(sketches):
+    return len(pickle.dumps(sketches, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Approximate answers from the sketches of every year')
+    parser.add_argument('--sketches', default=SKETCHES_PATH, help='file with the sketches (built when missing)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('build', help='build the sketches of all the sources')
+
+    query_parser = subparsers.add_parser('query', help='unique names, top n and diversity from the sketches')
+    query_parser.add_argument('--country', default='USA')
+    query_parser.add_argument('--top', type=int, default=10)
+    query_parser.add_argument('--start-year', type=int)
+    query_parser.add_argument('--end-year', type=int)
+    query_parser.add_argument('--diversity', action='store_true', help='also display the diversity of every year')
+
+    validate_parser = subparsers.add_parser('validate', help='compare the approximate results with the exact ones')
+    validate_parser.add_argument('--n', type=int, help='length of the rankings (default: 1000 for the USA, 200 for Poland)')
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    if args.command == 'build':
+        fingerprint = {source.country: source.fingerprint() for source in DEFAULT_SOURCES}
+        country_sketches = build_country_sketches()
+        save_sketches(country_sketches, args.sketches, fingerprint)
+        print(f'Sketches of {len(country_sketches)} years built in {time.perf_counter() - start_time:.2f} s '
+              f'({sketches_size(country_sketches) / 2 ** 20:.1f} MB) and saved to {args.sketches}')
+    elif args.command == 'query':
+        country_sketches = load_sketches(args.sketches)
+        aliases = country_aliases({country for country, _ in country_sketches})
+        if args.country.lower() not in aliases:
+            parser.error(f'unknown country {args.country!r}')
+        query_country = aliases[args.country.lower()]
+        unique_counts, unique_error = approximate_unique_names(country_sketches, query_country, args.start_year,
+                                                               args.end_year)
+        print(f'Unique names (standard error {unique_error:.2%}):')
+        print(unique_counts.round().astype('int64').to_string())
+        query_top_names = approximate_top_n_names(country_sketches, query_country, args.top, args.start_year,
+                                                  args.end_year)
+        print(f'Top {args.top} names (exact score in [frequency - error, frequency]):')
+        print(query_top_names.to_string())
+        if args.diversity:
+            print(approximate_name_diversity(country_sketches, query_country, query_top_names, args.start_year,
+                                             args.end_year).to_string())
+        print(f'Answered in {time.perf_counter() - start_time:.3f} s')
+    else:
+        country_sketches = load_sketches(args.sketches)
+        print('\n'.join(validate(country_sketches, load_sources(DEFAULT_SOURCES), args.n)))
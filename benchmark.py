@@ -0,0 +1,332 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import time
+
+import numpy as np
+import pandas as pd
+
+from analysis import (calculate_frequency, calculate_last_letter_distribution, calculate_name_diversity,
+                      calculate_name_gender_ratio, calculate_top_n_names)
+from approximate import approximate_top_n_names, build_sketches
+from connotation import ConnotationScan, sliding_windows
+from features import NameFeatures
+from loader import load_usa_names
+from name_table import encode_names, name_attribute
+from ranking import RankingEngine
+from shared_data import OPENED, export_dataset, open_dataset
+from sources import PL_SOURCE, load_source
+
+# Size of the synthetic dataset at scale 1 - the real SSA data has ~100k names over 144 years,
+# so names scale 10 is roughly the size of the production dataset
+BASE_NAMES = 10000
+BASE_YEARS = 144
+LAST_YEAR = 2023
+BASE_PL_NAMES = 2000
+BASE_PL_YEARS = 24
+
+# Names used directly by the tasks in main.py, so the synthetic data can also be used to run the whole script
+# (B - the name is given to both sexes, needed by the connotation tasks)
+FIXED_NAMES = {'John': 'M', 'Mary': 'F', 'Jordan': 'B', 'Taylor': 'B'}
+
+LETTERS = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+# Last letters are drawn from a skewed distribution, like in the real data
+LAST_LETTER_WEIGHTS = np.array([12, 1, 1, 6, 10, 1, 1, 3, 4, 1, 2, 4, 2, 14, 4, 1, 1, 6, 6, 4, 1, 1, 1, 1, 8, 1],
+                               dtype=float)
+
+
+# Synthetic data
+def random_names(rng, n):
+    # Unique capitalized names with 3-10 letters
+    names = dict.fromkeys(FIXED_NAMES)
+    while len(names) < n:
+        missing = n - len(names)
+        lengths = rng.integers(3, 11, size=missing)
+        letters = rng.choice(LETTERS, size=(missing, 10))
+        last = rng.choice(LETTERS, size=missing, p=LAST_LETTER_WEIGHTS / LAST_LETTER_WEIGHTS.sum())
+        for length, row, last_letter in zip(lengths, letters, last):
+            names[''.join(row[:length - 1]).capitalize() + last_letter] = None
+    return list(names)[:n]
+
+
+def synthetic_counts(rng, names, years, births_per_year, threshold, fixed):
+    # Counts of every (name, sex) pair in every year: popularity is Zipf-like, every name is used only in a random
+    # window of years (with a rise and fall of popularity) and ~5% of the names are given to both sexes.
+    # The fixed names (name: sex) are the most popular ones and are used in every year.
+    # Returns a list of (year, DataFrame with name, sex, count) sorted like the SSA files
+    n = len(names)
+    fixed_ids = [names.index(name) for name in fixed]
+    sexes = rng.choice(np.array(['F', 'M', 'B']), size=n, p=[0.6, 0.35, 0.05])
+    for name_id, sex in zip(fixed_ids, fixed.values()):
+        sexes[name_id] = sex
+    pair_names = np.concatenate([np.flatnonzero(sexes != 'M'), np.flatnonzero(sexes != 'F')])
+    pair_sexes = np.repeat(np.array(['F', 'M']), [(sexes != 'M').sum(), (sexes != 'F').sum()])
+
+    weights = 1 / rng.permutation(np.arange(1, len(pair_names) + 1)) ** 1.1
+    weights[np.isin(pair_names, fixed_ids)] = weights.max()
+    weights /= weights.sum()
+
+    peak = rng.uniform(years[0] - 20, years[-1] + 20, size=len(pair_names))
+    width = rng.uniform(5, 40, size=len(pair_names))
+    width[np.isin(pair_names, fixed_ids)] = 1e9
+
+    names = np.asarray(names, dtype=object)
+    result = []
+    for year in years:
+        lam = births_per_year * weights * np.exp(-((year - peak) / width) ** 2) * 2
+        counts = rng.poisson(lam)
+        keep = counts >= threshold(year)
+        df = pd.DataFrame({'name': names[pair_names[keep]], 'sex': pair_sexes[keep], 'count': counts[keep]})
+        result.append((year, df.sort_values(['sex', 'count'], ascending=[True, False], kind='stable')))
+    return result
+
+
+def generate_usa_files(data_dir, names_scale=1, years_scale=1, seed=0):
+    # yob*.txt files in the SSA format (name,sex,count without a header)
+    rng = np.random.default_rng(seed)
+    years = range(LAST_YEAR - BASE_YEARS * years_scale + 1, LAST_YEAR + 1)
+    names = random_names(rng, BASE_NAMES * names_scale)
+    os.makedirs(data_dir, exist_ok=True)
+    for year, df in synthetic_counts(rng, names, years, 40 * BASE_NAMES * names_scale, lambda year: 5,
+                                    FIXED_NAMES):
+        df.to_csv(os.path.join(data_dir, f'yob{year}.txt'), header=False, index=False)
+
+
+def generate_pl_database(db_path, names_scale=1, years_scale=1, seed=0):
+    # SQLite database with the same layout as names_pl_2000-23.sqlite (separate tables for girls and boys,
+    # the names are upper case, the minimum count is 5 before 2013 and 2 from 2013)
+    rng = np.random.default_rng(seed + 1)
+    years = range(LAST_YEAR - BASE_PL_YEARS * years_scale + 1, LAST_YEAR + 1)
+    names = [name.upper() for name in random_names(rng, BASE_PL_NAMES * names_scale)]
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+
+    conn = sqlite3.connect(db_path)
+    for table in ['females', 'males']:
+        conn.execute(f'CREATE TABLE {table} (Rok INTEGER, "Imię" TEXT, Liczba INTEGER, "Płeć" TEXT)')
+    counts = synthetic_counts(rng, names, years, 100 * BASE_PL_NAMES * names_scale,
+                              lambda year: 5 if year < 2013 else 2,
+                              {name.upper(): sex for name, sex in FIXED_NAMES.items()})
+    for year, df in counts:
+        for sex, table, code in [('F', 'females', 'K'), ('M', 'males', 'M')]:
+            rows = df[df['sex'] == sex]
+            conn.executemany(f'INSERT INTO {table} VALUES (?, ?, ?, ?)',
+                             zip([year] * len(rows), rows['name'], rows['count'].tolist(), [code] * len(rows)))
+    conn.commit()
+    conn.close()
+
+
+def dataset_paths(root, names_scale, years_scale):
+    directory = os.path.join(root, f'names_x{names_scale}_years_x{years_scale}')
+    return os.path.join(directory, 'names'), os.path.join(directory, 'names_pl.sqlite')
+
+
+def ensure_dataset(root, names_scale=1, years_scale=1, seed=0):
+    # Generate the dataset once - it's deterministic for the given scales and seed, so it's reused between runs
+    data_dir, db_path = dataset_paths(root, names_scale, years_scale)
+    marker = os.path.join(os.path.dirname(data_dir), 'seed.json')
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if json.load(f) == {'seed': seed}:
+                return data_dir, db_path
+    generate_usa_files(data_dir, names_scale, years_scale, seed)
+    generate_pl_database(db_path, names_scale, years_scale, seed)
+    with open(marker, 'w') as f:
+        json.dump({'seed': seed}, f)
+    return data_dir, db_path
+
+
+# Benchmarks
+def measure(func, setup=None, repeat=5):
+    # Run func repeat times (setup() is called before every run and isn't timed, its result is passed to func)
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times), 'mean': statistics.fmean(times),
+            'max': max(times), 'repeat': repeat}
+
+
+def benchmark_dataset(data_dir, db_path, repeat=5, n=1000, pl_n=200):
+    # Time every analysis function on its own, on the data prepared the same way as in main.py
+    results = {}
+    results['load_usa_names'] = measure(lambda: encode_names(load_usa_names(data_dir)), repeat=repeat)
+    df, names = encode_names(load_usa_names(data_dir))
+    years = sorted(df['year'].unique())
+
+    # Opening the dataset exported to the mapped files (as a new worker process does it)
+    shared_path = os.path.join(os.path.dirname(data_dir), 'shared')
+    export_dataset(df, shared_path)
+
+    def open_shared():
+        OPENED.clear()
+        open_dataset(shared_path).frame()
+    results['open_dataset[mapped]'] = measure(open_shared, repeat=repeat)
+    OPENED.clear()
+
+    results['calculate_frequency'] = measure(calculate_frequency, lambda: (df.copy(deep=False),), repeat)
+    df = calculate_frequency(df)
+    results['calculate_top_n_names'] = measure(lambda: calculate_top_n_names(df, n), repeat=repeat)
+    top_names = calculate_top_n_names(df, n)
+    results['RankingEngine'] = measure(lambda: RankingEngine(df), repeat=repeat)
+    engine = RankingEngine(df)
+
+    def clear_windows():
+        # Every run starts without the sorted ranking
+        engine.windows.clear()
+        return ()
+
+    def sweep():
+        # Top n for every n from 100 to 5000 (every ranking after the first one is only a slice)
+        for sweep_n in range(100, 5001, 100):
+            engine.top_n_names(sweep_n)
+    results['RankingEngine.top_n_names[sweep 100-5000]'] = measure(sweep, clear_windows, repeat)
+    results['RankingEngine.years_in_top'] = measure(lambda: engine.years_in_top(n), repeat=repeat)
+    results['calculate_name_diversity'] = measure(calculate_name_diversity, lambda: (df.copy(deep=False), top_names),
+                                                  repeat)
+    df, _ = calculate_name_diversity(df, top_names)
+    # The same ranges as in Task 10 (the first 41 and the last 24 years of the dataset)
+    for start_year, end_year in [(years[0], years[0] + 40), (years[-1] - 23, years[-1])]:
+        for only_top in [True, False]:
+            results[f'calculate_name_gender_ratio[{start_year}-{end_year},only_top={only_top}]'] = measure(
+                lambda: calculate_name_gender_ratio(df, start_year, end_year, only_top), repeat=repeat)
+
+    # Every pair of 10-year windows from the cumulative counts (instead of a groupby for every window)
+    windows = sliding_windows(years, 10)
+    results['ConnotationScan.scan[10-year windows]'] = measure(
+        lambda: ConnotationScan(df, top_names).scan(windows), repeat=repeat)
+
+    # Sketches of every year, and the top n from the merged sketches (approximate.py)
+    results['build_sketches'] = measure(lambda: build_sketches(df), repeat=repeat)
+    sketches = {('USA', year): sketch for year, sketch in build_sketches(df).items()}
+    results['approximate_top_n_names'] = measure(lambda: approximate_top_n_names(sketches, 'USA', n), repeat=repeat)
+
+    def last_letters(df):
+        df['last_letter'] = name_attribute(df, names, 'last_letter')
+        return calculate_last_letter_distribution(df)
+    results['last_letter_distribution'] = measure(last_letters, lambda: (df.copy(deep=False),), repeat)
+    # The same distribution aggregated on the codes of the name features (the feature is computed on the first call)
+    results['feature_distribution[last_letter]'] = measure(
+        lambda: NameFeatures(names).distribution(df, 'last_letter'), repeat=repeat)
+    results['feature_distribution[suffix2]'] = measure(lambda: NameFeatures(names).distribution(df, 'suffix2'),
+                                                       repeat=repeat)
+
+    pl_source = PL_SOURCE.with_options(path=db_path)
+    results['load_pl_names'] = measure(lambda: load_source(pl_source), repeat=repeat)
+    pl_df = calculate_frequency(encode_names(load_source(pl_source))[0])
+    results['calculate_top_n_names[pl]'] = measure(lambda: calculate_top_n_names(pl_df, pl_n), repeat=repeat)
+
+    sizes = {'usa_rows': len(df), 'usa_names': int(df['name'].nunique()), 'usa_years': len(years),
+             'pl_rows': len(pl_df)}
+    return results, sizes
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'pandas': pd.__version__,
+            'numpy': np.__version__, 'machine': platform.machine(), 'processor': platform.processor(),
+            'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def run_benchmarks(scales, years_scale=1, repeat=5, data_root=os.path.join('data', 'benchmark'), seed=0):
+    report = {'environment': environment(), 'runs': []}
+    for names_scale in scales:
+        data_dir, db_path = ensure_dataset(data_root, names_scale, years_scale, seed)
+        results, sizes = benchmark_dataset(data_dir, db_path, repeat)
+        report['runs'].append({'names_scale': names_scale, 'years_scale': years_scale, 'seed': seed,
+                               'sizes': sizes, 'results': results})
+    return report
+
+
+def format_report(report):
+    lines = []
+    for run in report['runs']:
+        lines.append(f"names x{run['names_scale']}, years x{run['years_scale']} ({run['sizes']['usa_rows']} USA rows, "
+                     f"{run['sizes']['pl_rows']} Polish rows)")
+        lines.append(f"{'Benchmark':<62}{'Min [s]':>10}{'Median [s]':>12}")
+        for name, result in run['results'].items():
+            lines.append(f"{name:<62}{result['min']:>10.4f}{result['median']:>12.4f}")
+    return '\n'.join(lines)
+
+
+def compare_reports(old, new, threshold=0.1):
+    # Compare the medians of the benchmarks present in both reports (for the same scales) -
+    # returns the lines of the comparison and the number of benchmarks slower by more than the threshold
+    lines = []
+    regressions = 0
+    old_runs = {(run['names_scale'], run['years_scale']): run for run in old['runs']}
+    for run in new['runs']:
+        old_run = old_runs.get((run['names_scale'], run['years_scale']))
+        if old_run is None:
+            continue
+        lines.append(f"names x{run['names_scale']}, years x{run['years_scale']}")
+        for name, result in run['results'].items():
+            if name not in old_run['results']:
+                continue
+            ratio = result['median'] / old_run['results'][name]['median']
+            flag = ''
+            if ratio > 1 + threshold:
+                flag = 'SLOWER'
+                regressions += 1
+            elif ratio < 1 - threshold:
+                flag = 'faster'
+            lines.append(f"{name:<62}{old_run['results'][name]['median']:>10.4f}{result['median']:>10.4f}"
+                         f"{ratio:>8.2f}x {flag}")
+    return lines, regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the analysis functions on synthetic data')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='generate the data (if needed) and run the benchmarks')
+    run_parser.add_argument('--scale', type=int, nargs='+', default=[1], help='names scales, e.g. 1 10 100')
+    run_parser.add_argument('--years-scale', type=int, default=1)
+    run_parser.add_argument('--repeat', type=int, default=5)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--data-dir', default=os.path.join('data', 'benchmark'))
+    run_parser.add_argument('--output', help='JSON file for the results (default: benchmarks/<commit>-<time>.json)')
+
+    generate_parser = subparsers.add_parser('generate', help='only generate the synthetic data')
+    generate_parser.add_argument('--scale', type=int, nargs='+', default=[1])
+    generate_parser.add_argument('--years-scale', type=int, default=1)
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.add_argument('--data-dir', default=os.path.join('data', 'benchmark'))
+
+    compare_parser = subparsers.add_parser('compare', help='compare two JSON results')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='relative change reported as a regression')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        report = run_benchmarks(args.scale, args.years_scale, args.repeat, args.data_dir, args.seed)
+        print(format_report(report))
+        output = args.output or os.path.join(
+            'benchmarks', f"{report['environment']['commit'] or 'results'}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Results saved to:', output)
+    elif args.command == 'generate':
+        for names_scale in args.scale:
+            print('Generated:', *ensure_dataset(args.data_dir, names_scale, args.years_scale, args.seed))
+    else:
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        lines, regressions = compare_reports(old, new, args.threshold)
+        print('\n'.join(lines))
+        raise SystemExit(1 if regressions else 0)
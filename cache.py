@@ -0,0 +1,211 @@
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from analysis import calculate_name_diversity, gender_ratio_from_counts, group_keys, names_frequency, top_n_names
+from name_table import in_ranking
+from profiling import profiled
+
+# Version of the cached results - change it when the analysis functions change, so that the old results are not used
+CACHE_VERSION = 1
+
+
+@profiled
+def frame_fingerprint(df, columns=None):
+    # Hash of the values (and types) of the given columns - the same data always gets the same fingerprint,
+    # no matter if it was loaded from the files, the Parquet cache or built in another process
+    columns = list(df.columns) if columns is None else list(columns)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr([(column, str(df[column].dtype)) for column in columns]).encode())
+    digest.update(pd.util.hash_pandas_object(df[columns], index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def index_fingerprint(index):
+    # Hash of an index (e.g. the (name, sex) pairs of a ranking)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(pd.util.hash_pandas_object(index.to_frame(index=False), index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def shallow_copy(value):
+    # The callers may add columns to the returned frames (e.g. Task 13) - with copy-on-write
+    # a shallow copy is enough to keep the cached result unchanged
+    return value.copy(deep=False) if isinstance(value, (pd.DataFrame, pd.Series)) else value
+
+
+def result_key(*parts):
+    return hashlib.blake2b(repr((CACHE_VERSION,) + parts).encode(), digest_size=16).hexdigest()
+
+
+def source_key(source):
+    # Key of the data loaded from a source - the fingerprint of its files (modification time and size), so it's
+    # calculated once per load without hashing the rows. Pass it as data_key to the cached functions below
+    return result_key('source', source.country, source.kind, source.fingerprint())
+
+
+def ranking_key(data_key, top_names):
+    # Key of the data with the in_top column of the given ranking (added by cached_name_diversity)
+    return result_key('in_top', data_key, index_fingerprint(top_names.index))
+
+
+def frame_key(df, columns, data_key=None):
+    # The key given by the caller, or the fingerprint of the columns the result depends on
+    return data_key if data_key is not None else frame_fingerprint(df, group_keys(df, columns))
+
+
+class ResultCache:
+    # Two level cache of the analysis results: the most recently used results are kept in memory
+    # (at most max_items of them) and all of them are stored on disk (at most max_bytes in total).
+    # The keys are hashes of the input data and of the arguments, so the results are reused between runs
+    # as long as the data doesn't change. cache_dir=None keeps the results only in memory
+
+    def __init__(self, cache_dir=None, max_items=32, max_bytes=512 * 2 ** 20):
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        # Only the settings are sent to other processes - they share the results through the disk
+        return {'cache_dir': self.cache_dir, 'max_items': self.max_items, 'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.pkl')
+
+    def get(self, key):
+        # Return the cached result, or None if there's no result for the key
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return shallow_copy(self.memory[key])
+        if self.cache_dir is not None and os.path.exists(self.path(key)):
+            try:
+                with open(self.path(key), 'rb') as f:
+                    value = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                # The file was evicted by another process in the meantime, or it's broken
+                value = None
+            if value is not None:
+                # Mark the file as recently used (the least recently used files are evicted first)
+                os.utime(self.path(key))
+                self.remember(key, value)
+                with self.lock:
+                    self.hits += 1
+                return shallow_copy(value)
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.remember(key, value)
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f'{self.path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path(key))
+            self.evict()
+        return shallow_copy(value)
+
+    def remember(self, key, value):
+        with self.lock:
+            self.memory[key] = value
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
+
+    def evict(self):
+        # Remove the least recently used files until the cache fits in max_bytes
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        if self.cache_dir is not None and os.path.isdir(self.cache_dir):
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.pkl'):
+                    os.remove(entry.path)
+
+    def cached(self, key, func, *args, **kwargs):
+        # Return the cached result for the key, or calculate it with func(*args, **kwargs) and store it
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, func(*args, **kwargs))
+        return value
+
+
+# Cached versions of the analysis functions.
+# The partial aggregates are cached separately from the final results, so that queries that differ only in
+# n (or only_top) reuse them - e.g. the top 1000 after the top 200 only has to sort the cached name frequencies.
+# data_key identifies the data of df (e.g. source_key of the source it was loaded from) - without it the columns
+# are hashed on every call
+
+@profiled
+def cached_top_n_names(df, n, cache, data_key=None):
+    data_key = frame_key(df, ['name', 'sex', 'year', 'frequency'], data_key)
+
+    def calculate():
+        # The frequency of every (name, sex) pair averaged over the years is the aggregate behind the ranking
+        return top_n_names(cache.cached(result_key('names_frequency', data_key), names_frequency, df), n)
+
+    return cache.cached(result_key('top_n_names', data_key, n), calculate)
+
+
+@profiled
+def cached_name_diversity(df, top_names, cache, data_key=None):
+    # Same as calculate_name_diversity - the in_top column is always added to df (it's cheap),
+    # only the percentages are taken from the cache
+    key = result_key('name_diversity', frame_key(df, ['name', 'sex', 'year', 'count'], data_key),
+                     index_fingerprint(top_names.index))
+    reshaped = cache.get(key)
+    if reshaped is None:
+        df, reshaped = calculate_name_diversity(df, top_names)
+        return df, cache.put(key, reshaped)
+    df['in_top'] = in_ranking(df, top_names.index)
+    return df, reshaped
+
+
+@profiled
+def cached_name_gender_ratio(df, start_year, end_year, only_top, cache, data_key=None):
+    # data_key has to cover the in_top column too (ranking_key)
+    data_key = frame_key(df, ['name', 'sex', 'year', 'count', 'in_top'], data_key)
+
+    def grouped_counts():
+        # Sum of 'count' and 'in_top' for every (name, sex) pair in the range - shared by both values of only_top
+        filtered_df = df[df['year'].between(start_year, end_year)]
+        grouped = filtered_df.groupby(group_keys(filtered_df, ['name', 'sex']), observed=True)
+        return grouped[['count', 'in_top']].sum().fillna(0)
+
+    def calculate():
+        grouped = cache.cached(result_key('grouped_counts', data_key, start_year, end_year), grouped_counts)
+        return gender_ratio_from_counts(grouped, only_top)
+
+    return cache.cached(result_key('name_gender_ratio', data_key, start_year, end_year, only_top), calculate)
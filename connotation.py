@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+
+from name_table import in_ranking
+
+# Memory used by a block of the window pairs in scan (window pairs x names scores)
+SCAN_BLOCK_BYTES = 64 * 2 ** 20
+
+
+def sliding_windows(years, length, step=None):
+    # Windows of 'length' consecutive years (start_year, end_year), every 'step' years (by default not overlapping)
+    years = np.sort(np.unique(years))
+    step = step or length
+    return [(int(start), int(start) + length - 1) for start in range(years[0], years[-1] - length + 2, step)]
+
+
+class ConnotationScan:
+    # Cumulative counts of every name for every sex over the years, built once from the DataFrame (with the encoded
+    # names), so p_m and p_f of any window are differences of two prefix sums instead of a filter, a groupby and
+    # an unstack of the rows (calculate_name_gender_ratio). Only the names given to both sexes are kept - for the
+    # other ones p_m is undefined in every window (the same as in gender_ratio_from_counts).
+    # With top_names, like only_top=True, a name is used in a window only if it has a row of a (name, sex) pair
+    # from the ranking in that window
+
+    def __init__(self, df, top_names=None):
+        self.years = np.sort(df['year'].unique())
+        self.name_dtype = df['name'].dtype
+        sexes = df['sex'].cat.categories
+        self.m, self.f = sexes.get_loc('M'), sexes.get_loc('F')
+
+        name_ids = df['name'].cat.codes.to_numpy().astype(np.int64)
+        sex_ids = df['sex'].cat.codes.to_numpy().astype(np.int64)
+        given = np.zeros((len(df['name'].cat.categories), len(sexes)), dtype=bool)
+        given[name_ids, sex_ids] = True
+        self.name_ids = np.flatnonzero(given.all(axis=1))
+
+        # Position of the name among the kept names (-1 for the other ones)
+        positions = np.full(len(given), -1)
+        positions[self.name_ids] = np.arange(len(self.name_ids))
+        rows = positions[name_ids] >= 0
+        year_ids = np.searchsorted(self.years, df['year'].to_numpy()[rows])
+        kept = positions[name_ids[rows]]
+
+        # counts[y, name, sex] - the sum of the years before y (the first row is 0)
+        shape = (len(self.years) + 1, len(self.name_ids), len(sexes))
+        counts = np.zeros(shape, dtype=np.int64)
+        np.add.at(counts, (year_ids + 1, kept, sex_ids[rows]), df['count'].to_numpy()[rows].astype(np.int64))
+        self.counts = np.cumsum(counts, axis=0)
+
+        self.in_top = None
+        if top_names is not None:
+            # Number of the rows of the (name, sex) pairs from the ranking, also cumulative over the years
+            in_top = np.zeros(shape[:2], dtype=np.int64)
+            np.add.at(in_top, (year_ids + 1, kept), in_ranking(df[rows], top_names.index).astype(np.int64))
+            self.in_top = np.cumsum(in_top, axis=0)
+
+    def year_ids(self, windows):
+        # Start and end (exclusive) of the windows as positions in the cumulative arrays
+        windows = np.asarray(windows).reshape(-1, 2)
+        return np.searchsorted(self.years, windows[:, 0], 'left'), np.searchsorted(self.years, windows[:, 1], 'right')
+
+    def p_m(self, windows):
+        # p_m of every kept name in every window (windows x names), NaN if the name wasn't given to both sexes
+        # in the window (or, with the ranking, none of its rows in the window is in the ranking)
+        starts, ends = self.year_ids(windows)
+        counts = (self.counts[ends] - self.counts[starts]).astype(np.float64)
+        male, female = counts[..., self.m], counts[..., self.f]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            p_m = male / (male + female)
+        valid = (male > 0) & (female > 0)
+        if self.in_top is not None:
+            valid &= self.in_top[ends] - self.in_top[starts] > 0
+        return np.where(valid, p_m, np.nan)
+
+    def names(self, positions):
+        return pd.Categorical.from_codes(self.name_ids[positions], dtype=self.name_dtype)
+
+    def window_ratio(self, start_year, end_year):
+        # p_m and p_f of the names in the window (the same values as calculate_name_gender_ratio)
+        p_m = self.p_m([(start_year, end_year)])[0]
+        valid = ~np.isnan(p_m)
+        index = pd.CategoricalIndex(self.names(np.flatnonzero(valid)), name='name')
+        return pd.DataFrame({'p_m': p_m[valid], 'p_f': 1 - p_m[valid]}, index=index)
+
+    def change(self, first_window, second_window):
+        # Change of the connotation from male to female between two windows - (p_m(X) + p_f(Y)) / 2, as in Task 10
+        p_m = self.p_m([first_window, second_window])
+        change = (p_m[0] + (1 - p_m[1])) / 2
+        valid = ~np.isnan(change)
+        return pd.Series(change[valid], index=pd.CategoricalIndex(self.names(np.flatnonzero(valid)), name='name'))
+
+    def scan(self, windows, min_gap=1):
+        # The names with the largest change of the connotation (male to female and female to male) for every pair
+        # of windows X, Y where Y starts at least min_gap years after the end of X. The scores of all the names are
+        # calculated for a block of the pairs at once (vectorized), the ties go to the first name like idxmax
+        windows = [tuple(window) for window in windows]
+        p_m = self.p_m(windows)
+        first, second = np.nonzero(np.array([[y[0] - x[1] >= min_gap for y in windows] for x in windows]))
+
+        results = []
+        block = max(SCAN_BLOCK_BYTES // (8 * max(len(self.name_ids), 1)), 1)
+        for start in range(0, len(first), block):
+            x, y = first[start:start + block], second[start:start + block]
+            change = (p_m[x] + (1 - p_m[y])) / 2
+            valid = ~np.isnan(change)
+            m2f = np.argmax(np.where(valid, change, -np.inf), axis=1)
+            f2m = np.argmin(np.where(valid, change, np.inf), axis=1)
+            rows = np.arange(len(x))
+            results.append(pd.DataFrame({
+                'x_start': [windows[i][0] for i in x], 'x_end': [windows[i][1] for i in x],
+                'y_start': [windows[i][0] for i in y], 'y_end': [windows[i][1] for i in y],
+                'names': valid.sum(axis=1),
+                'm2f_name': self.names(m2f), 'm2f_change': change[rows, m2f],
+                'f2m_name': self.names(f2m), 'f2m_change': 1 - change[rows, f2m]}))
+        if not results:
+            return pd.DataFrame(columns=['x_start', 'x_end', 'y_start', 'y_end', 'names', 'm2f_name', 'm2f_change',
+                                         'f2m_name', 'f2m_change'])
+        scan_df = pd.concat(results, ignore_index=True)
+        # Pairs of windows without any name given to both sexes in both of them
+        return scan_df[scan_df['names'] > 0].reset_index(drop=True)
@@ -0,0 +1,129 @@
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+
+from analysis import group_keys
+from name_table import name_codes
+
+# Letters counted as vowels in the vowel/consonant patterns (lowercase, with the Polish ones)
+VOWELS = 'aeiouyąęó'
+
+# Features with a length: suffix3 (last 3 letters), prefix2, cv_suffix3 (vowel/consonant pattern of the last 3 letters)
+SIZED_FEATURE = re.compile(r'(suffix|prefix|cv_suffix)(\d+)')
+
+
+def cv_pattern(names):
+    # Replace every vowel with 'V' and every other letter with 'C' (e.g. 'Anna' -> 'VCCV')
+    lower = names.str.lower()
+    letters = {char for name in lower for char in name if char.isalpha()}
+    table = str.maketrans({char: 'V' if char in VOWELS else 'C' for char in letters})
+    return lower.str.translate(table)
+
+
+def compute_feature(names, feature):
+    # Value of the feature for every name of the name table (a Series of unique names)
+    names = names.astype(str)
+    if feature == 'last_letter':
+        return names.str[-1]
+    if feature == 'first_letter':
+        return names.str[0]
+    if feature == 'length':
+        return names.str.len()
+    if feature == 'cv_pattern':
+        return cv_pattern(names)
+    match = SIZED_FEATURE.fullmatch(feature)
+    if match is None:
+        raise ValueError(f'Unknown feature {feature!r}')
+    kind, size = match.group(1), int(match.group(2))
+    if kind == 'suffix':
+        return names.str[-size:]
+    if kind == 'prefix':
+        return names.str[:size]
+    return cv_pattern(names.str[-size:])
+
+
+def key_codes(df, key):
+    # Integer codes of a grouping column and a function turning the codes back into the values - categorical columns
+    # use their codes, the integer ones (e.g. the year) are offset by their minimum, so no sorting or hashing is needed
+    values = df[key]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy(), len(values.cat.categories), \
+            lambda codes: pd.Categorical.from_codes(codes, dtype=values.dtype)
+    values = values.to_numpy()
+    low = values.min() if len(values) else 0
+    size = int(values.max() - low) + 1 if len(values) else 0
+    return (values - low).astype(np.intp), size, lambda codes: (codes + low).astype(values.dtype)
+
+
+class NameFeatures:
+    # Features of the names (suffixes, prefixes, first/last letter, length, vowel/consonant patterns) calculated once
+    # for every unique name of the name table instead of for every row, and stored as categorical codes.
+    # The distributions are aggregated with np.bincount on the integer codes (no string operations on the rows).
+    # The features are computed on the first use, so the object can be shared by the stages (and threads)
+
+    def __init__(self, table):
+        self.table = table
+        self.features = {}
+        self.lock = threading.Lock()
+
+    def get(self, feature):
+        # Categorical with the value of the feature for every name id
+        with self.lock:
+            if feature not in self.features:
+                if feature in self.table.columns and isinstance(self.table[feature].dtype, pd.CategoricalDtype):
+                    values = self.table[feature].array
+                else:
+                    values = pd.Categorical(compute_feature(self.table['name'], feature))
+                self.features[feature] = values
+            return self.features[feature]
+
+    def row_codes(self, df, feature):
+        # Code of the feature in every row (looked up by the name id)
+        return self.get(feature).codes[name_codes(df)]
+
+    def distribution(self, df, feature, keys=('year', 'sex'), years=None, sexes=None, normalize=True):
+        # Sum of the counts for every combination of the keys (by default year x sex, the country is added for
+        # a frame with several countries) and value of the feature - normalized by the births of every row
+        # (the same as calculate_last_letter_distribution for feature='last_letter')
+        if years is not None or sexes is not None:
+            mask = np.ones(len(df), dtype=bool)
+            if years is not None:
+                mask &= df['year'].isin(years).to_numpy()
+            if sexes is not None:
+                mask &= df['sex'].isin(sexes).to_numpy()
+            df = df[mask]
+        keys = group_keys(df, keys)
+        values = self.get(feature)
+
+        # Only the values of the feature that occur in the rows get a column (e.g. there are ~100k suffixes of 5 letters,
+        # but few of them in a single year)
+        feature_codes = self.row_codes(df, feature)
+        used = np.flatnonzero(np.bincount(feature_codes, minlength=len(values.categories)))
+        compact = np.zeros(len(values.categories), dtype=np.intp)
+        compact[used] = np.arange(len(used))
+
+        # A single integer code for every (keys..., feature) combination
+        codes = [key_codes(df, key) for key in keys]
+        codes.append((compact[feature_codes], len(used), None))
+        shape = [size for _, size, _ in codes]
+        flat = np.ravel_multi_index([key_code for key_code, _, _ in codes], shape) if len(df) else np.array([], np.intp)
+        counts = np.bincount(flat, weights=df['count'].to_numpy(dtype='float64'), minlength=int(np.prod(shape)))
+        counts = counts.reshape(-1, shape[-1])
+
+        # Only the combinations of the keys that occur in the data are kept
+        rows = np.flatnonzero(counts.sum(axis=1))
+        columns = np.flatnonzero(counts.any(axis=0))
+        counts = counts[np.ix_(rows, columns)]
+        if normalize:
+            counts = counts / counts.sum(axis=1, keepdims=True)
+        else:
+            counts = counts.astype('int64')
+
+        row_codes = np.unravel_index(rows, shape[:-1])
+        index = pd.MultiIndex.from_arrays([decode(level_codes) for (_, _, decode), level_codes in zip(codes, row_codes)],
+                                          names=keys)
+        columns = pd.CategoricalIndex(values.categories[used[columns]], categories=values.categories, name=feature)
+        return pd.DataFrame(counts, index=index, columns=columns)
+
@@ -0,0 +1,347 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from analysis import calculate_frequency, gender_ratio_from_counts, top_n_from_frequency
+from loader import SSA_DTYPES, list_year_files, load_year_file, source_fingerprint, year_from_path
+from name_table import build_name_table, encode_names, in_ranking, name_attribute
+from sources import USA_SOURCE
+
+NAME_KEYS = ['name', 'sex']
+# Suffix of the files written by an update that isn't committed yet, and the file marking the commit
+STAGED_SUFFIX = '.new'
+COMMIT_FILE = 'commit.json'
+STATE_DIR = os.path.join('data', 'cache', 'incremental')
+
+
+def plain(df):
+    # Categorical keys of different years have different categories - use plain values in the stored aggregates
+    for column in ['name', 'sex', 'last_letter']:
+        if column in df.columns:
+            df[column] = np.asarray(df[column], dtype=object)
+    return df
+
+
+def add_aggregates(total, part, keys, sign=1):
+    # Add (sign=1) or subtract (sign=-1) the partial aggregate of a year, dropping the keys that became empty.
+    # Every table has the integer count, which is exactly 0 when all the births of the key were subtracted
+    # (the float columns, like the frequency, can be left with a rounding residue)
+    part = part.set_index(keys)
+    if total is None:
+        return part * sign
+    # The alignment turns the integer columns into floats - they're turned back (the sums are whole numbers)
+    total = total.add(part * sign, fill_value=0).astype(part.dtypes.to_dict())
+    return total[total['count'] != 0]
+
+
+class IncrementalState:
+    # Persistent store of the aggregates of every ingested year. When new (or changed) yob*.txt files appear,
+    # only those years are read and folded into the aggregates - the historical years are not reprocessed.
+    #
+    # The store is a directory with:
+    #  - state.json - fingerprints of the ingested files, ranking size and the year ranges
+    #  - years/yobYYYY.parquet - (name, sex, count) of every ingested year, used to subtract a changed year
+    #    and to update the diversity of the historical years for the names that entered/left the ranking
+    #  - *.parquet - the aggregates: name totals, births, last letters, ranges and diversity
+    #
+    # An update writes every file next to its old version first (*.new), then the commit file with the list of
+    # the files to delete, and only then replaces the old files. A crash before the commit file leaves the old
+    # state (the *.new files are discarded by the next load), a crash after it is finished by the next load,
+    # so the snapshots of the years always match the aggregates and state.json
+
+    TABLES = {'name_totals': NAME_KEYS, 'births': ['year', 'sex'], 'last_letters': ['year', 'sex', 'last_letter'],
+              'diversity': ['year', 'sex']}
+
+    def __init__(self, state_dir, n=1000, ranges=((1880, 1920), (2000, 2023))):
+        self.state_dir = state_dir
+        self.n = n
+        self.ranges = [tuple(r) for r in ranges]
+        self.ingested = {}
+        self.tables = dict.fromkeys(self.TABLES)
+        self.range_tables = dict.fromkeys(self.ranges)
+        self.top_names = None
+
+    # Persistence
+    def table_path(self, name):
+        return os.path.join(self.state_dir, f'{name}.parquet')
+
+    def year_path(self, file_name):
+        return os.path.join(self.state_dir, 'years', file_name.replace('.txt', '.parquet'))
+
+    def staged_files(self):
+        directories = [self.state_dir, os.path.join(self.state_dir, 'years')]
+        return [os.path.join(directory, entry) for directory in directories if os.path.isdir(directory)
+                for entry in os.listdir(directory) if entry.endswith(STAGED_SUFFIX)]
+
+    def recover(self):
+        # Finish the committed update, or discard the files of the update that wasn't committed
+        commit_path = os.path.join(self.state_dir, COMMIT_FILE)
+        if not os.path.exists(commit_path):
+            for path in self.staged_files():
+                os.remove(path)
+            return
+        with open(commit_path) as f:
+            obsolete = json.load(f)
+        for path in self.staged_files():
+            os.replace(path, path[:-len(STAGED_SUFFIX)])
+        for path in obsolete:
+            if os.path.exists(path):
+                os.remove(path)
+        os.remove(commit_path)
+
+    @classmethod
+    def load(cls, state_dir, n=1000, ranges=((1880, 1920), (2000, 2023))):
+        # Load the state from the directory, or create an empty one if it doesn't exist
+        # (or was created for a different ranking size or different ranges)
+        state = cls(state_dir, n, ranges)
+        state.recover()
+        meta_path = os.path.join(state_dir, 'state.json')
+        if not os.path.exists(meta_path):
+            return state
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['n'] != n or [tuple(r) for r in meta['ranges']] != state.ranges:
+            return state
+
+        state.ingested = meta['ingested']
+        for name, keys in cls.TABLES.items():
+            if os.path.exists(state.table_path(name)):
+                state.tables[name] = pd.read_parquet(state.table_path(name)).set_index(keys)
+        for start_year, end_year in state.ranges:
+            path = state.table_path(f'range_{start_year}_{end_year}')
+            if os.path.exists(path):
+                state.range_tables[(start_year, end_year)] = pd.read_parquet(path).set_index(NAME_KEYS)
+        if os.path.exists(state.table_path('top_names')):
+            state.top_names = pd.read_parquet(state.table_path('top_names')).set_index(NAME_KEYS)
+        return state
+
+    def save(self, removed_years=()):
+        # Stage the aggregates and state.json (the snapshots of the new years are staged by update) and commit them
+        # together with the removal of the snapshots of the deleted years
+        os.makedirs(os.path.join(self.state_dir, 'years'), exist_ok=True)
+        tables = dict(self.tables, top_names=self.top_names)
+        tables.update({f'range_{start_year}_{end_year}': table
+                       for (start_year, end_year), table in self.range_tables.items()})
+        obsolete = [self.year_path(file_name) for file_name in removed_years]
+        for name, table in tables.items():
+            if table is not None:
+                table.reset_index().to_parquet(self.table_path(name) + STAGED_SUFFIX, index=False)
+            else:
+                obsolete.append(self.table_path(name))
+        with open(os.path.join(self.state_dir, 'state.json') + STAGED_SUFFIX, 'w') as f:
+            json.dump({'n': self.n, 'ranges': self.ranges, 'ingested': self.ingested}, f)
+
+        commit_path = os.path.join(self.state_dir, COMMIT_FILE)
+        with open(commit_path + '.tmp', 'w') as f:
+            json.dump(obsolete, f)
+        os.replace(commit_path + '.tmp', commit_path)
+        self.recover()
+
+    # Aggregates of a single year
+    def year_aggregates(self, df):
+        year = int(df['year'].iloc[0])
+        df = calculate_frequency(df)
+        # Signed counts, so that the aggregates of a changed or removed year can be subtracted
+        df['count'] = df['count'].astype('int64')
+        df['last_letter'] = name_attribute(df, build_name_table(df['name'].cat.categories), 'last_letter')
+        df['years'] = 1
+
+        aggregates = {
+            'name_totals': df.groupby(NAME_KEYS, observed=True)[['frequency', 'count', 'years']].sum().reset_index(),
+            'births': df.groupby(['year', 'sex'], observed=True)[['count']].sum().reset_index(),
+            'last_letters': df.groupby(['year', 'sex', 'last_letter'], observed=True)[['count']].sum().reset_index(),
+        }
+        ranges = {r: aggregates['name_totals'][NAME_KEYS + ['count', 'years']]
+                  for r in self.ranges if r[0] <= year <= r[1]}
+        return {name: plain(table) for name, table in aggregates.items()}, {r: plain(t.copy()) for r, t in ranges.items()}
+
+    def fold(self, dfs, sign=1):
+        # Add (or subtract) the aggregates of the given years - the years are combined first,
+        # so that the stored aggregates are aligned only once per table
+        if not dfs:
+            return
+        year_aggregates = [self.year_aggregates(df) for df in dfs]
+        for name, keys in self.TABLES.items():
+            parts = [aggregates[name] for aggregates, _ in year_aggregates if name in aggregates]
+            if parts:
+                part = pd.concat(parts).groupby(keys, as_index=False).sum()
+                self.tables[name] = add_aggregates(self.tables[name], part, keys, sign)
+        for r in self.ranges:
+            parts = [ranges[r] for _, ranges in year_aggregates if r in ranges]
+            if parts:
+                part = pd.concat(parts).groupby(NAME_KEYS, as_index=False).sum()
+                self.range_tables[r] = add_aggregates(self.range_tables[r], part, NAME_KEYS, sign)
+
+    def read_year(self, file_name, names=None):
+        # Read an ingested year from the store (optionally only the given names)
+        filters = [('name', 'in', list(names))] if names is not None else None
+        df = pd.read_parquet(self.year_path(file_name), filters=filters)
+        df['sex'] = df['sex'].astype(SSA_DTYPES['sex'])
+        df['year'] = df['year'].astype('int16')
+        df, _ = encode_names(df)
+        return df
+
+    # Update
+    def update(self, data_dir):
+        # Fold in the new and changed year files, and remove the years whose files were deleted.
+        # Returns the list of the years that were (re)ingested
+        files = {os.path.basename(file): file for file in list_year_files(data_dir)}
+        fingerprint = source_fingerprint(files.values())
+        changed = [name for name in files if self.ingested.get(name) != fingerprint[name]]
+        removed = [name for name in self.ingested if name not in files]
+
+        outdated = [file_name for file_name in changed + removed if file_name in self.ingested]
+        self.fold([self.read_year(file_name) for file_name in outdated], sign=-1)
+        for file_name in outdated:
+            self.drop_year_from_diversity(year_from_path(file_name))
+            del self.ingested[file_name]
+
+        new_years = []
+        os.makedirs(os.path.join(self.state_dir, 'years'), exist_ok=True)
+        for file_name in changed:
+            df = load_year_file(files[file_name])
+            # Staged - the old snapshot is needed until the update is committed
+            plain(df[['name', 'sex', 'count', 'year']].copy()).to_parquet(self.year_path(file_name) + STAGED_SUFFIX,
+                                                                          index=False)
+            df, _ = encode_names(df)
+            self.ingested[file_name] = fingerprint[file_name]
+            new_years.append(df)
+        self.fold(new_years)
+
+        if changed or removed or (self.ingested and self.top_names is None):
+            if self.ingested:
+                self.update_ranking(new_years)
+            else:
+                # All the files were deleted - nothing is left
+                self.tables = dict.fromkeys(self.TABLES)
+                self.range_tables = dict.fromkeys(self.ranges)
+                self.top_names = None
+            self.save(removed)
+        return [int(df['year'].iloc[0]) for df in new_years]
+
+    def drop_year_from_diversity(self, year):
+        diversity = self.tables['diversity']
+        if diversity is not None:
+            self.tables['diversity'] = diversity[diversity.index.get_level_values('year') != year]
+
+    def update_ranking(self, new_years):
+        # Recalculate the ranking from the name totals (one row per name, no need to read any year)
+        names_frequency = self.tables['name_totals']['frequency'] / len(self.ingested)
+        old_top_names = self.top_names
+        self.top_names = top_n_from_frequency(names_frequency, self.n)
+
+        # Diversity of the new years is calculated with the new ranking
+        new_year_values = {int(df['year'].iloc[0]) for df in new_years}
+        parts = [self.year_diversity(df, self.top_names) for df in new_years]
+        historical = [f for f in self.ingested if year_from_path(f) not in new_year_values]
+
+        diversity = self.tables['diversity']
+        if diversity is None or old_top_names is None:
+            # No usable diversity from before - calculate it for all the historical years
+            parts += [self.year_diversity(self.read_year(f), self.top_names) for f in historical]
+        else:
+            # The historical years only need a correction for the names that entered or left the ranking
+            parts.append(self.correct_diversity(diversity, old_top_names, historical))
+        self.tables['diversity'] = pd.concat(parts).sort_index() if parts else None
+
+    def correct_diversity(self, diversity, old_top_names, historical):
+        entered = self.top_names.index.difference(old_top_names.index)
+        left = old_top_names.index.difference(self.top_names.index)
+        if len(entered) == 0 and len(left) == 0:
+            return diversity
+
+        diversity = diversity.copy()
+        delta_names = set(entered.get_level_values('name')) | set(left.get_level_values('name'))
+        for file_name in historical:
+            df = self.read_year(file_name, delta_names)
+            if df.empty:
+                continue
+            gained = df['count'].where(in_ranking(df, entered), 0).astype('int64')
+            lost = df['count'].where(in_ranking(df, left), 0).astype('int64')
+            change = (gained - lost).groupby([df['year'], df['sex']], observed=True).sum()
+            for (year, sex), value in change.items():
+                diversity.loc[(int(year), sex), 'in_top_count'] += value
+        return diversity
+
+    @staticmethod
+    def year_diversity(df, top_names):
+        df = df.assign(in_top_count=df['count'].where(in_ranking(df, top_names.index), 0))
+        totals = df.groupby(['year', 'sex'], observed=True)[['in_top_count', 'count']].sum().astype('int64')
+        totals.index = pd.MultiIndex.from_arrays([totals.index.get_level_values('year').astype(int),
+                                                  np.asarray(totals.index.get_level_values('sex'), dtype=object)],
+                                                 names=['year', 'sex'])
+        return totals
+
+    # Derived outputs
+    def name_diversity(self):
+        diversity = self.tables['diversity']
+        reshaped = (diversity['in_top_count'] / diversity['count']).unstack(level='sex')
+        reshaped['difference'] = abs(reshaped['M'] - reshaped['F'])
+        return reshaped
+
+    def last_letter_distribution(self):
+        last_letter_df = self.tables['last_letters']['count'].unstack(level='last_letter', fill_value=0)
+        return last_letter_df.div(last_letter_df.sum(axis=1), axis=0)
+
+    def name_gender_ratio(self, start_year, end_year, only_top):
+        # Only the ranges given when the state was created are available
+        if (start_year, end_year) not in self.range_tables:
+            raise ValueError(f'The range {start_year}-{end_year} is not stored, available: {self.ranges}')
+        if self.range_tables[(start_year, end_year)] is None:
+            raise ValueError(f'No ingested year in the range {start_year}-{end_year}')
+        counts = self.range_tables[(start_year, end_year)].copy()
+        positions = counts.index.get_indexer(self.top_names.index)
+        in_top = np.zeros(len(counts), dtype=bool)
+        in_top[positions[positions >= 0]] = True
+        counts['in_top'] = counts['years'] * in_top
+        return gender_ratio_from_counts(counts[['count', 'in_top']], only_top)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fold the new and changed year files into the stored aggregates '
+                                                 'and display the answers of the USA tasks')
+    parser.add_argument('--data-dir', default=USA_SOURCE.options['path'], help='directory with the yob*.txt files')
+    parser.add_argument('--state', default=STATE_DIR, help='directory of the stored aggregates')
+    parser.add_argument('--n', type=int, default=1000, help='length of the ranking')
+    parser.add_argument('--top', type=int, default=10, help='number of the names of the ranking to display')
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    state = IncrementalState.load(args.state, args.n)
+    new_years = state.update(args.data_dir)
+    changes = f' ({min(new_years)}-{max(new_years)})' if new_years else ''
+    print(f'{len(new_years)} years ingested{changes}, {len(state.ingested)} in total, '
+          f'in {time.perf_counter() - start_time:.2f} s')
+    if not state.ingested:
+        parser.exit(1, f'No yob*.txt files in {args.data_dir}\n')
+
+    print(f'6. Top {args.top} of the {args.n} most popular names:')
+    print(state.top_names.head(args.top).to_string())
+
+    diversity = state.name_diversity()
+    max_diff_year = diversity['difference'].idxmax()
+    print('8. Year with the greatest difference in diversity was:', max_diff_year, 'and the difference was:',
+          diversity.loc[max_diff_year, 'difference'])
+
+    last_letters_male = state.last_letter_distribution().xs(key='M', level='sex').T
+    if {1910, 2023} <= set(last_letters_male.columns):
+        last_letter_diff = last_letters_male[2023] - last_letters_male[1910]
+        print('9. Letter with the greatest increase between 1910 and 2023:', last_letter_diff.idxmax(),
+              'and the increase was:', last_letter_diff.max())
+        print('Letter with the greatest decrease between 1910 and 2023:', last_letter_diff.idxmin(),
+              'and the decrease was:', last_letter_diff.min())
+
+    try:
+        name_ratios_1880_1920 = state.name_gender_ratio(1880, 1920, True)
+        name_ratios_2000_2023 = state.name_gender_ratio(2000, 2023, True)
+    except ValueError as e:
+        parser.exit(1, f'10. {e}\n')
+    m2f_change = (name_ratios_1880_1920['p_m'] + name_ratios_2000_2023['p_f']) / 2
+    print('10. Name with the largest change from being a female name to a male name is:', m2f_change.idxmin(),
+          'and the change of p_m is:', 1 - m2f_change.min())
+    print('Name with the largest change from being a male name to a female name is:', m2f_change.idxmax(),
+          'and the change of p_m is:', -m2f_change.max())
@@ -0,0 +1,111 @@
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from name_table import encode_names
+
+# dask (reading the files) and pyarrow (the cache) are imported only when they're used,
+# so the scripts that don't read the files start faster
+
+# Explicit schema of the SSA files, so that pandas doesn't have to infer the types for every file
+SSA_COLUMNS = ['name', 'sex', 'count']
+SSA_DTYPES = {'name': 'object', 'sex': pd.CategoricalDtype(['F', 'M']), 'count': 'uint32'}
+YEAR_DTYPE = 'int16'
+
+# Key under which the fingerprint of the source files is stored in the Parquet metadata
+FINGERPRINT_KEY = b'source_fingerprint'
+
+
+def year_from_path(file_path):
+    # Files are named yobYYYY.txt
+    return int(os.path.basename(file_path).split('yob')[1].split('.txt')[0])
+
+
+def list_year_files(data_dir):
+    # Sort the files by year, so that the frame (and the cache) is always in the same order
+    return sorted(glob.glob(os.path.join(data_dir, 'yob*.txt')), key=year_from_path)
+
+
+def load_year_file(file_path):
+    # Load a single file with an added 'year' column
+    df = pd.read_csv(file_path, names=SSA_COLUMNS, dtype=SSA_DTYPES, engine='c')
+    df['year'] = np.full(len(df), year_from_path(file_path), dtype=YEAR_DTYPE)
+    return df
+
+
+def source_fingerprint(files):
+    # Modification time and size of every source file - if any of them changes, the cache is rebuilt
+    return {os.path.basename(file): [os.stat(file).st_mtime_ns, os.stat(file).st_size] for file in files}
+
+
+def read_year_files(files, scheduler='threads', num_workers=None):
+    # Read all files concurrently (the C parser releases the GIL, so threads are enough)
+    import dask
+
+    tasks = [dask.delayed(load_year_file)(file) for file in files]
+    dfs = dask.compute(*tasks, scheduler=scheduler, num_workers=num_workers)
+    df = pd.concat(dfs, ignore_index=True)
+    # Concatenating categoricals with identical categories keeps the categorical dtype, but make sure of it
+    df['sex'] = df['sex'].astype(SSA_DTYPES['sex'])
+    # Store the names dictionary-encoded, so that the cache keeps every unique name only once
+    df, _ = encode_names(df)
+    return df
+
+
+def write_cache(df, cache_path, fingerprint):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[FINGERPRINT_KEY] = json.dumps(fingerprint).encode()
+    table = table.replace_schema_metadata(metadata)
+
+    # Write one row group per year, so that single years can be read without scanning the whole file
+    # (the size of the row group is the size of the year - by default pyarrow splits the tables above ~1M rows)
+    tmp_path = cache_path + '.tmp'
+    with pq.ParquetWriter(tmp_path, table.schema) as writer:
+        years = df['year'].to_numpy()
+        boundaries = np.flatnonzero(np.diff(years)) + 1
+        for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(df)]):
+            writer.write_table(table.slice(start, end - start), row_group_size=end - start)
+    # Replace the old cache atomically, so that a crash never leaves a half-written file behind
+    os.replace(tmp_path, cache_path)
+
+
+def read_cache(cache_path, fingerprint, years=None):
+    # Return None if there's no cache or it was built from different files
+    if not os.path.exists(cache_path):
+        return None
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(cache_path)
+    stored = (parquet_file.schema_arrow.metadata or {}).get(FINGERPRINT_KEY)
+    if stored is None or json.loads(stored) != fingerprint:
+        return None
+
+    filters = [('year', 'in', list(years))] if years is not None else None
+    df = pq.read_table(cache_path, filters=filters).to_pandas()
+    df['sex'] = df['sex'].astype(SSA_DTYPES['sex'])
+    return df
+
+
+def load_usa_names(data_dir, cache_path=None, scheduler='threads', num_workers=None):
+    # Load all yob*.txt files into a single typed DataFrame, using the columnar cache if it's up to date
+    files = list_year_files(data_dir)
+    fingerprint = source_fingerprint(files)
+
+    if cache_path is not None:
+        df = read_cache(cache_path, fingerprint)
+        if df is not None:
+            return df
+
+    df = read_year_files(files, scheduler=scheduler, num_workers=num_workers)
+
+    if cache_path is not None:
+        write_cache(df, cache_path, fingerprint)
+    return df
@@ -1,156 +1,104 @@
-import pandas as pd
-import dask.dataframe as dd
-import numpy as np
-import glob
-import matplotlib.pyplot as plt
-import os
-import sqlite3
-
-# Task 4
-def calculate_frequency(df):
-    # Sum the number of boys and girls born each year
-    df['total_births_by_sex'] = df.groupby(['year', 'sex'])['count'].transform('sum')
-    # Calculate the ratio between count of specific name to the total number of births for the gender
-    df['frequency_male'] = np.where(df['sex'] == 'M', df['count'] / df['total_births_by_sex'], 0)
-    df['frequency_female'] = np.where(df['sex'] == 'F', df['count'] / df['total_births_by_sex'], 0)
-    return df
-
-# Task 6
-def calculate_top_n_names(df, n):
-    # Get the number of years in the dataset
-    number_of_years = df['year'].nunique()
-
-    # Calculate the frequency of each name over the years
-    names_df = df.groupby(['name', 'sex'])[['frequency_male', 'frequency_female']].sum() / number_of_years
-
-    # Set the frequency columns to numeric
-    names_df['frequency_male'] = pd.to_numeric(names_df['frequency_male'])
-    names_df['frequency_female'] = pd.to_numeric(names_df['frequency_female'])
-
-    # Get the top n names for both genders separately and concatenate them
-    top_male_names = names_df.nlargest(n, 'frequency_male')
-    top_female_names = names_df.nlargest(n, 'frequency_female')
-    top_names = pd.concat([top_male_names, top_female_names])
-
-    return top_names
-
-# Task 8
-def calculate_name_diversity(df, top_names, n, country):
-    # Set the index and check if the name is in the ranking of top n names
-    df = df.set_index(['name', 'sex'])
-    df['in_top'] = df.index.isin(top_names.index)
-    df.reset_index(inplace=True)
-
-    # Calculate the percentage of names in the top n ranking
-    diversity_pt = df.pivot_table(index=['year', 'sex'], columns='in_top', values='count', aggfunc='sum', fill_value=0)
-    diversity_pt['top_percentage'] = diversity_pt[True] / (diversity_pt[True] + diversity_pt[False])
-
-    # Calculate the difference in diversity between male and female names
-    reshaped = diversity_pt['top_percentage'].unstack(level='sex')
-    reshaped['difference'] = abs(reshaped['M'] - reshaped['F'])
-
-    # Find the year with the greatest difference in diversity
-    max_diff_year = reshaped['difference'].idxmax()
-    # max_diff_value = reshaped.loc[max_diff_year, 'difference']
-
-    # Plot the percentage of names in the top n ranking
-    plt.figure(figsize=(10, 4))
-    plt.plot(reshaped.index, reshaped['M'], 'b', label='Male names')
-    plt.plot(reshaped.index, reshaped['F'], 'r', label='Female names')
-    plt.axvline(max_diff_year, color='g', label='Year with the greatest difference in diversity')
-    plt.title(f'Percentage of names in the top{n} ranking in {country}')
-    plt.xlabel('Year')
-    plt.ylabel('Percentage')
-    plt.legend()
-    return df, reshaped
-
-# Task 10
-def calculate_name_gender_ratio(df, start_year, end_year, only_top):
-    # Drop rows where year is not in the specified range
-    filtered_df = df[df['year'].between(start_year, end_year)]
-
-    # Group the data
-    grouped_birth_name_df = filtered_df.groupby(['name', 'sex'])[['count', 'in_top']].sum().fillna(0)
-    grouped_birth_name_df = grouped_birth_name_df.unstack(level='sex')
-    # Drop rows where the name is not in the top 1000 (if only_top flag is True)
-    if only_top:
-        grouped_birth_name_df = grouped_birth_name_df[grouped_birth_name_df[('in_top', 'F')] + grouped_birth_name_df[('in_top', 'M')] > 0]
-    # Calculate the ratio of the name being given to males versus females
-    grouped_birth_name_df['p_m'] = grouped_birth_name_df[('count', 'M')] / (grouped_birth_name_df[('count', 'M')] + grouped_birth_name_df[('count', 'F')])
-    grouped_birth_name_df['p_f'] = 1 - grouped_birth_name_df['p_m']
-    # Drop unnecessary columns (if only_top flag is True)
-    if only_top:
-        grouped_birth_name_df = grouped_birth_name_df.drop(columns=[('count', 'F'), ('count', 'M'), ('in_top', 'F'), ('in_top', 'M')])
-
-    return grouped_birth_name_df
-
-def main():
-    # Initialize the timer
-    test_time = pd.Timestamp.now()
-
-    # 1. Load the data from all files to a single pandas DataFrame
-
-    # Get list of files
-    usa_files = glob.glob(os.path.join('data', 'names', 'yob*.txt'))
-
-    # Function to load a single file with an added 'year' column
-    def load_file(file_path):
-        year = int(os.path.basename(file_path).split('yob')[1].split('.txt')[0])
-        df = pd.read_csv(file_path, names=['name', 'sex', 'count'])
-        df['year'] = year
-        return df
+import time
 
-    # Create a Dask DataFrame by concatenating all files in parallel
-    dask_dfs = [dd.from_pandas(load_file(file), npartitions=1) for file in usa_files]
-    dask_df = dd.concat(dask_dfs)
+# Start of the script - the time of the imports and of the whole startup (until the first stage) is displayed at the end
+START_TIME = time.perf_counter()
 
-    # Convert to Pandas DataFrame
-    usa_df = dask_df.compute()
-
-    # 2. Determine the number of unique names in the whole dataset
+import pandas as pd
+import argparse
+import os
 
-    print("-------------------------------------------------")
-    print("2. Number of unique names:", usa_df['name'].nunique())
+from analysis import calculate_frequency
+from cache import (ResultCache, cached_name_diversity, cached_name_gender_ratio, cached_top_n_names, ranking_key,
+                   source_key)
+from connotation import ConnotationScan, sliding_windows
+from features import NameFeatures
+from name_table import encode_names, in_ranking
+from name_index import NameIndex
+from pipeline import Stage, format_timings, required_stages, run_stages
+from profiling import Profiler
+from rendering import FigureRenderer, InteractiveFigures
+from shared_data import load_shared
+from sources import PL_SOURCE, USA_SOURCE, country_aliases, load_source
+from tensor import CountTensor
+
+# dask (reading the USA files), sqlite3 (the Polish database) and matplotlib (the figures) are imported
+# only by the stages using them, so a run of a few tasks doesn't pay for the imports of the others
+IMPORT_TIME = time.perf_counter() - START_TIME
+
+SEPARATOR = "-------------------------------------------------"
+
+# Tasks of every country (the number of the task is the prefix of the name of its stages)
+TASK_COUNTRIES = {'USA': range(1, 11), 'Poland': range(11, 14)}
+# The Polish tasks answering the same questions as the USA tasks - with --country Poland, --tasks 6,8 runs Task 12
+# (the top 200 and the diversity) and 10 runs Task 13 (the connotation)
+TASK_EQUIVALENTS = {'Poland': {1: 11, 6: 12, 8: 12, 10: 13}}
+
+
+def report(*lines):
+    # Text of a task's answer - the values in every line are joined the same way as print() does it
+    return '\n'.join([SEPARATOR] + [' '.join(str(value) for value in line) for line in lines])
+
+# 1. Load the data from all files to a single pandas DataFrame
+def load_usa_data(shared_data):
+    # Key of the loaded data for the cached results (the fingerprint of the files, so the rows are never hashed)
+    usa_data_key = source_key(USA_SOURCE)
+    if shared_data is not None:
+        # The dataset exported to memory-mapped files (in shared_data.py) is opened instead of loading the files -
+        # the process pool sends only its path to the workers, and all of them map the same pages
+        dataset = load_shared(USA_SOURCE, shared_data)
+        return {'usa_df': dataset.frame(), 'usa_names': dataset.names, 'usa_data_key': usa_data_key}
+
+    # The files are read concurrently with an explicit schema, and stored in a columnar (Parquet) cache,
+    # which is rebuilt automatically when any of the source files changes (the 'csv_dir' adapter in sources.py)
+    usa_df = load_source(USA_SOURCE)
+
+    # Build the dictionary of names - from now on the names are stored as integer ids (categorical codes)
+    # and the per-name attributes (e.g. the last letter) are computed only once for every unique name
+    usa_df, usa_names = encode_names(usa_df)
+    return {'usa_df': usa_df, 'usa_names': usa_names, 'usa_data_key': usa_data_key}
+
+# 2. Determine the number of unique names in the whole dataset
+# 3. Determine the number of unique names for each sex
+def task_unique_names(usa_df):
+    text = report(("2. Number of unique names:", usa_df['name'].nunique()))
 
     ### Output:
     ### Number of unique names: 103564
 
-    # 3. Determine the number of unique names for each sex
-
-    print("-------------------------------------------------")
-    print("3. Number of unique names by sex:", usa_df.groupby('sex')['name'].nunique())
+    text += '\n' + report(("3. Number of unique names by sex:", usa_df.groupby('sex', observed=True)['name'].nunique()))
 
     ### Output:
     ### Number of unique names by sex: Sex
     ### F    70903
     ### M    44261
 
-    # 4. Create new columns ("frequency_male" and "frequency female"), and determine the popularity of each name in each
-    #    year by dividing number of times the name was given by the total number of births for that gender in that year
+    return {'report_2': text}
 
-    # The method is implemented in the calculate_frequency function (above the main function)
+# 4. Create new columns ("frequency_male" and "frequency female"), and determine the popularity of each name in each
+#    year by dividing number of times the name was given by the total number of births for that gender in that year
+def task_frequency(usa_df, engine):
+    # The method is implemented in the calculate_frequency function (in analysis.py)
     # it's done this way to be more universal and to be able to use it with other datasets
-
-    usa_df = calculate_frequency(usa_df)
-
-    # 5. Determine and display a plot consisting of two subplot, where the x-axis is the time scale and the y-axis represents:
-    #    - the number of births for each year (top subplot)
-    #    - the ratio of the number of female to male births in each year (bottom subplot)
-    #    Which year had the smallest and largest difference in the number of births between male and female
-    #    (the question concerns the subplot showing the ratio of births)? Determine and display the answer on the screen
-
-    # Prepare the plot
-    fig, axs = plt.subplots(2, 1, figsize=(10, 9))
-    axs[0].plot(usa_df.groupby('year')['count'].sum())
-    axs[0].set_title('Number of births per year')
-    axs[0].set_xlabel('Year')
-    axs[0].set_ylabel('Number of births')
-
-    # Adjust the space between the subplots so they don't overlap each other
-    plt.subplots_adjust(hspace=0.5)
+    # To save memory, a single 'frequency' column is stored - the frequency_male and frequency_female columns
+    # are available through usa_df.legacy['frequency_male'] and usa_df.legacy['frequency_female']
+
+    # The column is added to a (shallow) copy, so the stages reading the loaded DataFrame at the same time aren't affected
+    # (the exported dataset already has it)
+    if 'frequency' not in usa_df.columns:
+        usa_df = calculate_frequency(usa_df.copy(deep=False))
+    usa_tensor = CountTensor(usa_df) if engine == 'tensor' else None
+    return {'usa_frequency_df': usa_df, 'usa_tensor': usa_tensor}
+
+# 5. Determine and display a plot consisting of two subplot, where the x-axis is the time scale and the y-axis represents:
+#    - the number of births for each year (top subplot)
+#    - the ratio of the number of female to male births in each year (bottom subplot)
+#    Which year had the smallest and largest difference in the number of births between male and female
+#    (the question concerns the subplot showing the ratio of births)? Determine and display the answer on the screen
+def task_births(usa_df):
+    births_per_year = usa_df.groupby('year')['count'].sum()
 
     # Calculate the ratio of the number of born females to males
-    birth_ratio_df = usa_df.groupby(['year', 'sex'])[['count']].sum().unstack()
+    birth_ratio_df = usa_df.groupby(['year', 'sex'], observed=True)[['count']].sum().unstack()
     birth_ratio_df['ratio'] = birth_ratio_df['count']['F'] / birth_ratio_df['count']['M']
     birth_ratio_df = birth_ratio_df.reset_index()
 
@@ -158,110 +106,92 @@ def main():
     min_diff_year = birth_ratio_df.loc[birth_ratio_df['ratio'].idxmin()]['year'].values[0]
     max_diff_year = birth_ratio_df.loc[birth_ratio_df['ratio'].idxmax()]['year'].values[0]
 
-    # Plot the ratio of the number of births
-    axs[1].plot(birth_ratio_df['year'], birth_ratio_df['ratio'])
-    axs[1].plot(min_diff_year, birth_ratio_df.loc[birth_ratio_df['ratio'].idxmin()]['ratio'],
-                'go', markerfacecolor='none',  label='Min ratio')
-    axs[1].plot(max_diff_year, birth_ratio_df.loc[birth_ratio_df['ratio'].idxmax()]['ratio'],
-                'ro', markerfacecolor='none', label='Max ratio')
-    axs[1].legend()
-    axs[1].set_title('Ratio of the number of female to male births per year')
-    axs[1].set_xlabel('Year')
-    axs[1].set_ylabel('Ratio')
-
-    print("-------------------------------------------------")
-    print("5. Year with the smallest difference in the ratio of births between female and male:", min_diff_year,
-          "and the ratio was:", birth_ratio_df.loc[birth_ratio_df['ratio'].idxmin()]['ratio'].values[0])
-    print("Year with the largest difference in the ratio of births between female and male:", max_diff_year,
-          "and the ratio was:", birth_ratio_df.loc[birth_ratio_df['ratio'].idxmax()]['ratio'].values[0])
+    text = report(("5. Year with the smallest difference in the ratio of births between female and male:", min_diff_year,
+                   "and the ratio was:", birth_ratio_df.loc[birth_ratio_df['ratio'].idxmin()]['ratio'].values[0]),
+                  ("Year with the largest difference in the ratio of births between female and male:", max_diff_year,
+                   "and the ratio was:", birth_ratio_df.loc[birth_ratio_df['ratio'].idxmax()]['ratio'].values[0]))
 
     ### Output:
     ### 5. Year with the smallest difference in the ratio of births between female and male: 1880 and the ratio was: 0.8235496425015838
     ### Year with the largest difference in the ratio of births between female and male: 1901 and the ratio was: 2.2480674763072126
 
-    # 6. Determine the 1000 most popular names for each gender in the entire time range, the method should consist
-    #    in determining the 1000 most popular names for each year and for each gender separately. The most popular names
-    #    should be those that have been high on the ranking list for the longest time, to avoid the influence
-    #    of the number of births in a given year on the result (the number of births is decreasing, an incorrectly performed
-    #    procedure may cause names given during the baby boom and used at that time to dominate the ranking)
-    #    Please define the Top1000 ranking as a weighted sum of the relative popularity of a given name in a given year
-
-    # The function is implemented in the calculate_top_n_names function (above the main function)
-
-    top_1000_usa_names = calculate_top_n_names(usa_df, 1000)
-
-    # 7. Display the changes for the male name John and the first female name in the top-1000 ranking on a single graph
-    #    (provide the graph with an appropriate legend):
-    #    - on the Y-axis on the left, the number of times the name was given in each year
-    #    (display how many times this name was given in 1934, 1980, and 2022)?
-    #    - on the Y-axis on the right, the popularity of these names in each of these years
-
-    # Sort usa_df by year column
-    usa_df = usa_df.sort_values(by=['year', 'sex', 'count'], ascending=[True, True, False])
-
+    return {'births_per_year': births_per_year, 'birth_ratio_df': birth_ratio_df, 'report_5': text}
+
+def plot_births(figures, births_per_year, birth_ratio_df):
+    # The figures are drawn in rendering.py
+    figures.plot('births', births_per_year=births_per_year, birth_ratio_df=birth_ratio_df)
+
+# 6. Determine the 1000 most popular names for each gender in the entire time range, the method should consist
+#    in determining the 1000 most popular names for each year and for each gender separately. The most popular names
+#    should be those that have been high on the ranking list for the longest time, to avoid the influence
+#    of the number of births in a given year on the result (the number of births is decreasing, an incorrectly performed
+#    procedure may cause names given during the baby boom and used at that time to dominate the ranking)
+#    Please define the Top1000 ranking as a weighted sum of the relative popularity of a given name in a given year
+def task_top_names(usa_frequency_df, usa_tensor, usa_data_key, cache):
+    # The function is implemented in the calculate_top_n_names function (in analysis.py)
+    # the results are cached (in cache.py), so they are calculated only once for the same data
+    if usa_tensor is not None:
+        top_1000_usa_names = usa_tensor.top_n_names(1000)
+    else:
+        top_1000_usa_names = cached_top_n_names(usa_frequency_df, 1000, cache, usa_data_key)
+    return {'top_1000_usa_names': top_1000_usa_names}
+
+def task_name_index(usa_df):
+    # Build the index of the name time series, so that the series of a name (and the count in a single year)
+    # can be looked up without scanning the whole DataFrame
+    return {'usa_index': NameIndex(usa_df)}
+
+# 7. Display the changes for the male name John and the first female name in the top-1000 ranking on a single graph
+#    (provide the graph with an appropriate legend):
+#    - on the Y-axis on the left, the number of times the name was given in each year
+#    (display how many times this name was given in 1934, 1980, and 2022)?
+#    - on the Y-axis on the right, the popularity of these names in each of these years
+def task_name_trend(usa_index, top_1000_usa_names):
     # Find the most popular female name in the top 1000 ranking
     top_female_name_usa = top_1000_usa_names.nlargest(1, 'frequency_female').reset_index()['name'].values[0]
-
-    # Prepare the title
-    plt_title = "Count and popularity of the names John and " + top_female_name_usa
-
-    # Prepare the plot
-    plt.figure(figsize=(10, 4))
-    plt.title(plt_title)
-    plt.xlabel('Year')
-
-    # Left y-axis
-    ax1 = plt.gca()
-    ax1.plot(usa_df.loc[(usa_df['name'] == 'John') & (usa_df['sex'] == 'M')]['year'],
-             usa_df.loc[(usa_df['name'] == 'John') & (usa_df['sex'] == 'M')]['count'], 'b', label='John count')
-    ax1.plot(usa_df.loc[(usa_df['name'] == top_female_name_usa) & (usa_df['sex'] == 'F')]['year'],
-             usa_df.loc[(usa_df['name'] == top_female_name_usa) & (usa_df['sex'] == 'F')]['count'], 'r',
-             label=f'{top_female_name_usa} count')
-    ax1.set_ylabel('Number of times the name was given in each year')
-    ax1.legend(loc='center left')
-    #
-    # Right y-axis
-    ax2 = ax1.twinx()
-    ax2.plot(usa_df.loc[(usa_df['name'] == 'John') & (usa_df['sex'] == 'M')]['year'],
-             usa_df.loc[(usa_df['name'] == 'John') & (usa_df['sex'] == 'M')]['frequency_male'], 'b--', label='John popularity')
-    ax2.plot(usa_df.loc[(usa_df['name'] == top_female_name_usa) & (usa_df['sex'] == 'F')]['year'],
-             usa_df.loc[(usa_df['name'] == top_female_name_usa) & (usa_df['sex'] == 'F')]['frequency_female'], 'r--', label=f'{top_female_name_usa} popularity')
-    ax2.set_ylabel('Popularity of the name in each year')
-    ax2.legend(loc='center right')
+    john_series = usa_index.series('John', 'M')
+    top_female_series = usa_index.series(top_female_name_usa, 'F')
 
     # Display the count of the names in 1934, 1980, and 2022
-    print("-------------------------------------------------")
-    print("7. Count of the name John in 1934, 1980 and 2022 was respectively:",
-          usa_df.loc[(usa_df['name'] == 'John') & (usa_df['year'] == 1934) & (usa_df['sex'] == 'M')]['count'].values[0],
-          usa_df.loc[(usa_df['name'] == 'John') & (usa_df['year'] == 1980) & (usa_df['sex'] == 'M')]['count'].values[0],
-          usa_df.loc[(usa_df['name'] == 'John') & (usa_df['year'] == 2022) & (usa_df['sex'] == 'M')]['count'].values[0])
-    print("Count of the name", top_female_name_usa, "in 1934, 1980 and 2022 was respectively:",
-          usa_df.loc[(usa_df['name'] == top_female_name_usa) & (usa_df['year'] == 1934) & (usa_df['sex'] == 'F')]['count'].values[0],
-          usa_df.loc[(usa_df['name'] == top_female_name_usa) & (usa_df['year'] == 1980) & (usa_df['sex'] == 'F')]['count'].values[0],
-          usa_df.loc[(usa_df['name'] == top_female_name_usa) & (usa_df['year'] == 2022) & (usa_df['sex'] == 'F')]['count'].values[0])
+    text = report(("7. Count of the name John in 1934, 1980 and 2022 was respectively:",
+                   usa_index.get('John', 'M', 1934), usa_index.get('John', 'M', 1980), usa_index.get('John', 'M', 2022)),
+                  ("Count of the name", top_female_name_usa, "in 1934, 1980 and 2022 was respectively:",
+                   usa_index.get(top_female_name_usa, 'F', 1934), usa_index.get(top_female_name_usa, 'F', 1980),
+                   usa_index.get(top_female_name_usa, 'F', 2022)))
 
     ### Output:
     ### 7. Count of the name John in 1934, 1980 and 2022 was respectively: 46739 35280 7978
     ### Count of the name Mary in 1934, 1980 and 2022 was respectively: 56931 11474 2114
 
-    # 8. Plot a graph divided by year and gender, containing information about the percentage of names in a given year
-    #    that belonged to the top1000 ranking (determined for the entire set from Task 6).
-    #    This graph should present the change in the diversity of names in subsequent years, divided by gender.
-    #    Highlight on the graph and display in the console the year in which the greatest difference in diversity
-    #    between male and female names was observed.
-    #    Answer the question by displaying the appropriate text in the script:
-    #    “What has changed over the last 140 years in terms of name diversity? Does diversity depend on gender?”
-
-    # The method is implemented in the calculate_name_diversity function (above the main function)
-
-    usa_df, top_1000_percentage_usa = calculate_name_diversity(usa_df, top_1000_usa_names, 1000, 'USA')
+    return {'top_female_name_usa': top_female_name_usa, 'john_series': john_series,
+            'top_female_series': top_female_series, 'report_7': text}
+
+def plot_name_trend(figures, top_female_name_usa, john_series, top_female_series):
+    figures.plot('name_trend', top_female_name_usa=top_female_name_usa, john_series=john_series,
+                 top_female_series=top_female_series)
+
+# 8. Plot a graph divided by year and gender, containing information about the percentage of names in a given year
+#    that belonged to the top1000 ranking (determined for the entire set from Task 6).
+#    This graph should present the change in the diversity of names in subsequent years, divided by gender.
+#    Highlight on the graph and display in the console the year in which the greatest difference in diversity
+#    between male and female names was observed.
+#    Answer the question by displaying the appropriate text in the script:
+#    “What has changed over the last 140 years in terms of name diversity? Does diversity depend on gender?”
+def task_diversity(usa_frequency_df, usa_tensor, top_1000_usa_names, usa_data_key, cache):
+    # The method is implemented in the calculate_name_diversity function (in analysis.py)
+    usa_df = usa_frequency_df.copy(deep=False)
+    if usa_tensor is not None:
+        usa_df['in_top'] = in_ranking(usa_df, top_1000_usa_names.index)
+        top_1000_percentage_usa = usa_tensor.name_diversity(top_1000_usa_names)
+    else:
+        usa_df, top_1000_percentage_usa = cached_name_diversity(usa_df, top_1000_usa_names, cache, usa_data_key)
 
     # Find the year with the greatest difference in diversity and the value of the difference
     max_diff_year = top_1000_percentage_usa['difference'].idxmax()
     max_diff_value = top_1000_percentage_usa.loc[max_diff_year, 'difference']
 
-    print("-------------------------------------------------")
-    print("8. Year with the greatest difference in diversity was:", max_diff_year, "and the difference was:", max_diff_value)
+    text = report(("8. Year with the greatest difference in diversity was:", max_diff_year, "and the difference was:",
+                   max_diff_value))
 
     ### Output:
     ### 8. Year with the greatest difference in diversity was: 2008 and the difference was: 0.16952209755307035
@@ -278,23 +208,26 @@ def main():
     ## The conclusions obtained from the analysis are consistent with the information provided on
     ## https://en.wikipedia.org/wiki/Naming_in_the_United_States#Gender, which confirms their validity and reliability.
 
-    # 9. Verify the hypothesis: is it true that the distribution of the last letters of male names has changed
-    #    significantly in the observed period? For this purpose:
-    #    - aggregate all births in the full data set by year, gender and last letter,
-    #    - extract data for years 1910, 1970, 2023
-    #    - normalize the data by the total number of birthdays in a given year
-    #    - display letter popularity data for men in the form of a bar chart containing individual years and where the bars
-    #      are grouped by letter. View which letter experienced the greatest increase/decrease between 1910 and 2023)
-    #    - for the 3 letters for which the greatest change was observed, display the popularity trend over
-    #      the entire period of time
-
-    # Prepare the last letter column
-    usa_df['last_letter'] = usa_df['name'].str[-1]
+    return {'usa_top_df': usa_df, 'top_1000_percentage_usa': top_1000_percentage_usa, 'report_8': text}
+
+# 9. Verify the hypothesis: is it true that the distribution of the last letters of male names has changed
+#    significantly in the observed period? For this purpose:
+#    - aggregate all births in the full data set by year, gender and last letter,
+#    - extract data for years 1910, 1970, 2023
+#    - normalize the data by the total number of birthdays in a given year
+#    - display letter popularity data for men in the form of a bar chart containing individual years and where the bars
+#      are grouped by letter. View which letter experienced the greatest increase/decrease between 1910 and 2023)
+#    - for the 3 letters for which the greatest change was observed, display the popularity trend over
+#      the entire period of time
+def task_last_letters(usa_df, usa_names):
+    # The last letter is taken from the name table (computed once for every unique name instead of slicing
+    # the string in every row) and the births are aggregated on the integer codes (in features.py)
+    usa_features = NameFeatures(usa_names)
 
     # # Method 1
     # start_time = pd.Timestamp.now()
     # for i in range(100):
-    #     last_letter_df = usa_df.groupby(['year', 'sex', 'last_letter'])['count'].sum().unstack(level='last_letter', fill_value=0)
+    #     last_letter_df = usa_df.groupby(['year', 'sex', 'last_letter'], observed=True)['count'].sum().unstack(level='last_letter', fill_value=0)
     #     last_letter_df = last_letter_df.div(last_letter_df.sum(axis=1), axis=0)
     #     end_time = pd.Timestamp.now()
     # print("Method 1 execution time:", end_time - start_time)
@@ -311,17 +244,10 @@ def main():
     # # After comparing the execution time of the two methods, the first method (with groupby and normalizing by dividing)
     # # was chosen because it is faster
 
-    # Calculate the popularity of the last letters
-    last_letter_df = usa_df.groupby(['year', 'sex', 'last_letter'])['count'].sum().unstack(level='last_letter', fill_value=0)
-    last_letter_df = last_letter_df.div(last_letter_df.sum(axis=1), axis=0)
+    # Calculate the popularity of the last letters (the same as calculate_last_letter_distribution in analysis.py)
+    last_letter_df = usa_features.distribution(usa_df, 'last_letter')
     last_letter_selected_years_df = last_letter_df.loc[last_letter_df.index.get_level_values('year').isin([1910, 1970, 2023])]
-
-    # Plot the popularity of the last letters in 1910, 1970, and 2023
     last_letter_selected_years_male = last_letter_selected_years_df.xs(key='M', level='sex').T
-    last_letter_selected_years_male.plot(kind='bar', figsize=(10, 4), width=0.8)
-    plt.title('Popularity of the last letters of male names in 1910, 1970 and 2023')
-    plt.xlabel('Last letter')
-    plt.ylabel('Popularity')
 
     # Calculate the difference in popularity between 1910 and 2023
     last_letter_diff = last_letter_selected_years_male[2023] - last_letter_selected_years_male[1910]
@@ -330,24 +256,16 @@ def main():
     greatest_decrease_letter = last_letter_diff.idxmin()
     greatest_decrease_letter_value = last_letter_diff.min()
 
-    print("-------------------------------------------------")
-    print("9. Letter with the greatest increase between 1910 and 2023:", greatest_increase_letter,
-          "and the increase was:", greatest_increase_letter_value)
-    print("Letter with the greatest decrease between 1910 and 2023:", greatest_decrease_letter,
-            "and the decrease was:", greatest_decrease_letter_value)
+    text = report(("9. Letter with the greatest increase between 1910 and 2023:", greatest_increase_letter,
+                   "and the increase was:", greatest_increase_letter_value),
+                  ("Letter with the greatest decrease between 1910 and 2023:", greatest_decrease_letter,
+                   "and the decrease was:", greatest_decrease_letter_value))
 
-    # Plot the popularity trend of the 3 names with the greatest change
+    # Find the 3 letters with the greatest change (their popularity trend is plotted)
     last_letter_diff_abs = pd.to_numeric(last_letter_diff.abs())
     max_diff_letters = last_letter_diff_abs.nlargest(3).index.to_list()
-
     last_letter_selected_letters_df = last_letter_df.loc[:, max_diff_letters]
 
-    last_letter_selected_letters_df.xs(key='M', level='sex').plot(kind='line', figsize=(10, 4))
-    plt.title('Popularity trend of the 3 last letters of male names with the greatest change between 1910 and 2023')
-    plt.xlabel('Year')
-    plt.ylabel('Popularity')
-    plt.legend()
-
     ### Output:
     ### 9. Letter with the greatest increase between 1910 and 2023: n and the increase was: 0.14847000759222678
     ### Letter with the greatest decrease between 1910 and 2023: d and the decrease was: -0.09149648988599028
@@ -358,20 +276,31 @@ def main():
     ## 0.1-0.15, and in 2023 the popularity graph was dominated by the letter 'n',
     ## which was the last letter of names given to almost 30% of boys, and second most popular last letter was 'r'.
 
-    # 10. Find names in the top1000 ranking that were given to both girls and boys (the ratio of male and female names
-    # given). Choose 2 names (one that used to be typically male and is now a female name and the other that used to be
-    # typically female and is currently typically male). A typically male name is one for which the quotient of the
-    # names given to boys to the total number of names is close to 1 (p_m), similarly the quotient can be defined for
-    # girls (p_f). The largest change between year X and year Y can be defined as the average of the sum
-    # (p_m(X)+p_f(Y))/2.
-    # To analyze the change in name connotations, use two ranges: aggregated data up to 1920 and from 2000.
-    # - display these names
-    # - plot the trend for these names illustrating the change in the connotation of a given name over the years
-
-    # The method is implemented in the calculate_name_gender_ratio function (above the main function)
-
-    name_ratios_usa_1880_1920 = calculate_name_gender_ratio(usa_df, 1880, 1920, True)
-    name_ratios_usa_2000_2023 = calculate_name_gender_ratio(usa_df, 2000, 2023, True)
+    return {'last_letter_selected_years_male': last_letter_selected_years_male,
+            'last_letter_selected_letters_df': last_letter_selected_letters_df, 'report_9': text}
+
+def plot_last_letters(figures, last_letter_selected_years_male, last_letter_selected_letters_df):
+    figures.plot('last_letters', last_letter_selected_years_male=last_letter_selected_years_male)
+    figures.plot('last_letter_trend', last_letter_selected_letters_df=last_letter_selected_letters_df)
+
+# 10. Find names in the top1000 ranking that were given to both girls and boys (the ratio of male and female names
+# given). Choose 2 names (one that used to be typically male and is now a female name and the other that used to be
+# typically female and is currently typically male). A typically male name is one for which the quotient of the
+# names given to boys to the total number of names is close to 1 (p_m), similarly the quotient can be defined for
+# girls (p_f). The largest change between year X and year Y can be defined as the average of the sum
+# (p_m(X)+p_f(Y))/2.
+# To analyze the change in name connotations, use two ranges: aggregated data up to 1920 and from 2000.
+# - display these names
+# - plot the trend for these names illustrating the change in the connotation of a given name over the years
+def task_connotation(usa_top_df, usa_tensor, top_1000_usa_names, usa_index, usa_data_key, cache):
+    # The method is implemented in the calculate_name_gender_ratio function (in analysis.py)
+    if usa_tensor is not None:
+        name_ratios_usa_1880_1920 = usa_tensor.name_gender_ratio(1880, 1920, True, top_1000_usa_names)
+        name_ratios_usa_2000_2023 = usa_tensor.name_gender_ratio(2000, 2023, True, top_1000_usa_names)
+    else:
+        top_key = ranking_key(usa_data_key, top_1000_usa_names)
+        name_ratios_usa_1880_1920 = cached_name_gender_ratio(usa_top_df, 1880, 1920, True, cache, top_key)
+        name_ratios_usa_2000_2023 = cached_name_gender_ratio(usa_top_df, 2000, 2023, True, cache, top_key)
 
     # Calculate the change in connotation for the names
     m2f_change = (name_ratios_usa_1880_1920['p_m'] + name_ratios_usa_2000_2023['p_f']) / 2
@@ -383,95 +312,89 @@ def main():
     max_f2m_change_name = m2f_change.idxmin()
     max_f2m_change_value = (1 - m2f_change.min())
 
-    # Plot the trend of connotation for the names with the largest change in connotation
-    name_trend_usa_df = usa_df[(usa_df['name'] == max_m2f_change_name) | (usa_df['name'] == max_f2m_change_name)]
-    name_trend_usa_df = name_trend_usa_df.groupby(['year', 'name', 'sex'])['count'].sum()
+    # Calculate the trend of connotation for the names with the largest change in connotation
+    name_trend_usa_df = usa_index.series_many([max_m2f_change_name, max_f2m_change_name])['count']
     name_trend_usa_df = name_trend_usa_df.unstack(level='sex')
     name_trend_usa_df = name_trend_usa_df.div(name_trend_usa_df.sum(axis=1), axis=0)
     name_trend_usa_df = name_trend_usa_df.unstack(level='name')
 
-    # Prepare plot
-    # plt.figure(figsize=(10, 4))
-    name_trend_usa_df['M'].plot(kind='line', figsize=(10, 4))
-    plt.ylabel('p_m')
-    plt.xlabel('Year')
-    plt.title('p_m trend for the names with the largest change in connotation')
-
-    print('-------------------------------------------------')
-    print('10. Name with the largest change from being a female name to a male name is:', max_f2m_change_name,
-          'and the change of p_m is:', max_f2m_change_value)
-    print('Name with the largest change from being a male name to a female name is:', max_m2f_change_name,
-          'and the change of p_m is:', -max_m2f_change_value)
+    text = report(('10. Name with the largest change from being a female name to a male name is:', max_f2m_change_name,
+                   'and the change of p_m is:', max_f2m_change_value),
+                  ('Name with the largest change from being a male name to a female name is:', max_m2f_change_name,
+                   'and the change of p_m is:', -max_m2f_change_value))
 
     ### Output:
     ### 10. Name with the largest change from being a female name to a male name is: Donnie and the change of p_m is: 0.8817976850735472
     ### Name with the largest change from being a male name to a female name is: Ashley and the change of p_m is: -0.9933546933773039
 
-    # 11. Load a dataset from the database names_pl_2000-23.sqlite containing the number of names given
-    #     in the period 2000-2023 in Poland. The sql query should create a single table containing the name, year,
-    #     and the number of names given for girls and boys. There are 2 separate tables in the database for each gender.
-
-    # Prepare the query and load the data
-    conn = sqlite3.connect('data/names_pl_2000-23.sqlite')
-    query = """
-            SELECT Rok AS year, Imię AS name, Liczba AS count, 
-                   CASE Płeć WHEN 'K' THEN 'F' ELSE Płeć END AS sex 
-            FROM females
-            UNION ALL
-            SELECT Rok AS year, Imię AS name, Liczba AS count, Płeć AS sex
-            FROM males
-        """
-    pl_df = pd.read_sql_query(query, conn)
-    conn.close()
-
-    # 12. Create a ranking of the top 200 names and compare whether the observations from task 8.
-    #     regarding trends in naming in the USA are also observable in Poland.
-    #     Take 2000, 2013, 2023 as reference years.
-    #     Using a histogram, try to answer the question of what changed between 2000 and 2013,
-    #     whether the change in the trend results only from changing naming trends or other factors.
-
-    # Calculate the frequency of the names
-    pl_df = calculate_frequency(pl_df)
-    # Calculate the top 200 names ranking
-    top_200_pl_names = calculate_top_n_names(pl_df, 200)
-    # Calculate the diversity of the names
-    pl_df, top_200_percentage_pl = calculate_name_diversity(pl_df, top_200_pl_names, 200, 'Poland')
-
-    # Prepare the plot for histograms
-    fig, axs = plt.subplots(3, 2, figsize=(13, 9))
-    plt.subplots_adjust(hspace=0.5)
-    # Calculate the bins for the histograms
-    bins = np.histogram_bin_edges(pl_df[f'frequency_female'], bins=20)
-
-    # Loop through the years given in the task
-    for i, year in enumerate([2000, 2013, 2023]):
-
-        # Filter the data for the given year
-        pl_df_year = pl_df[pl_df['year'] == year]
-
-        # Plot histograms for each gender separately
-        for j, gender in enumerate(['F', 'M']):
-            if gender == 'F':
-                gender_full = 'female'
-            else:
-                gender_full = 'male'
-
-            # Plot the histograms of the names in the top 200 and not in the top 200 on the same plot
-            axs[i, j].hist(pl_df_year[(pl_df_year['sex'] == gender) & (pl_df_year['in_top'] == False)]
-                           [f'frequency_{gender_full}'], bins=bins, color='b', alpha=0.5, label='Not in top')
-            axs[i, j].hist(
-                pl_df_year[(pl_df_year['sex'] == gender) & (pl_df_year['in_top'])][f'frequency_{gender_full}'],
-                bins=bins, color='r', alpha=0.5, label='In top')
-            axs[i, j].set_title(f'Frequency distribution of {gender_full} names in {year}')
-            axs[i, j].set_xlabel('Frequency')
-            axs[i, j].set_ylabel('Number of names')
-            axs[i, j].legend()
-
-    # Find the lowest count in each year
-    lowest_count = pl_df.groupby('year')['count'].min()
-    print("-------------------------------------------------")
-    print("12. Lowest count of names in Poland in 2000, 2013 and 2023 was respectively:",
-          lowest_count[2000], lowest_count[2013], lowest_count[2023])
+    return {'name_trend_usa_df': name_trend_usa_df, 'report_10': text}
+
+def plot_connotation(figures, name_trend_usa_df):
+    figures.plot('connotation', name_trend_usa_df=name_trend_usa_df)
+
+def task_connotation_scan(usa_top_df, top_1000_usa_names, connotation_window):
+    # Instead of the 2 ranges of Task 10, compare every pair of windows of connotation_window years
+    # (p_m and p_f of every window are calculated from the cumulative counts in connotation.py)
+    scan = ConnotationScan(usa_top_df, top_1000_usa_names)
+    scan_df = scan.scan(sliding_windows(scan.years, connotation_window))
+    m2f = scan_df.loc[scan_df['m2f_change'].idxmax()]
+    f2m = scan_df.loc[scan_df['f2m_change'].idxmax()]
+
+    text = report((f'10. Comparing all pairs of {connotation_window}-year windows ({len(scan_df)} pairs):',),
+                  ('Name with the largest change from being a female name to a male name is:', f2m['f2m_name'],
+                   'between', f"{f2m['x_start']}-{f2m['x_end']}", 'and', f"{f2m['y_start']}-{f2m['y_end']}",
+                   'and the change of p_m is:', f2m['f2m_change']),
+                  ('Name with the largest change from being a male name to a female name is:', m2f['m2f_name'],
+                   'between', f"{m2f['x_start']}-{m2f['x_end']}", 'and', f"{m2f['y_start']}-{m2f['y_end']}",
+                   'and the change of p_m is:', -m2f['m2f_change']))
+    return {'report_10_scan': text}
+
+# 11. Load a dataset from the database names_pl_2000-23.sqlite containing the number of names given
+#     in the period 2000-2023 in Poland. The sql query should create a single table containing the name, year,
+#     and the number of names given for girls and boys. There are 2 separate tables in the database for each gender.
+def load_pl_data(pl_engine, pl_index):
+    db_path = PL_SOURCE.options['path']
+    if pl_engine == 'sqlite':
+        # The aggregations of Tasks 12 and 13 are calculated by SQLite (in sqlite_engine.py),
+        # only the database is opened here
+        from sqlite_engine import SQLiteNames
+
+        return {'pl_df': None, 'pl_db': SQLiteNames(db_path, index=pl_index), 'pl_data_key': None}
+
+    # The 'sqlite' adapter (in sources.py) selects the name, year, count and sex from both tables with UNION ALL
+    # and normalizes them to the schema of the USA dataset, the names are encoded the same way
+    pl_data_key = source_key(PL_SOURCE)
+    pl_df, _ = encode_names(load_source(PL_SOURCE))
+    return {'pl_df': pl_df, 'pl_db': None, 'pl_data_key': pl_data_key}
+
+# 12. Create a ranking of the top 200 names and compare whether the observations from task 8.
+#     regarding trends in naming in the USA are also observable in Poland.
+#     Take 2000, 2013, 2023 as reference years.
+#     Using a histogram, try to answer the question of what changed between 2000 and 2013,
+#     whether the change in the trend results only from changing naming trends or other factors.
+def task_pl_diversity(pl_df, pl_db, pl_data_key, engine, cache):
+    histogram_years = [2000, 2013, 2023]
+    pl_tensor = None
+    if pl_db is not None:
+        # Calculate the top 200 names ranking and the diversity of the names in SQLite
+        top_200_pl_names = pl_db.top_n_names(200)
+        top_200_percentage_pl = pl_db.name_diversity(top_200_pl_names)
+        # Only the rows of the years shown on the histograms are loaded
+        pl_histogram_df = pl_db.frequency_rows(histogram_years, top_200_pl_names)
+        pl_histogram_range = pl_db.female_frequency_range()
+        lowest_count = pl_db.lowest_count()
+        pl_df = None
+    else:
+        pl_df, pl_tensor, top_200_pl_names, top_200_percentage_pl = pl_diversity_in_memory(pl_df, pl_data_key,
+                                                                                            engine, cache)
+        pl_histogram_df = pl_df.loc[pl_df['year'].isin(histogram_years), ['year', 'sex', 'frequency', 'in_top']]
+        frequency_female = pl_df.legacy['frequency_female']
+        pl_histogram_range = (frequency_female.min(), frequency_female.max())
+        # Find the lowest count in each year
+        lowest_count = pl_df.groupby('year')['count'].min()
+
+    text = report(("12. Lowest count of names in Poland in 2000, 2013 and 2023 was respectively:",
+                   lowest_count[2000], lowest_count[2013], lowest_count[2023]))
 
     ### Output:
     ### 12. Lowest count of names in Poland in 2000, 2013 and 2023 was respectively: 5 2 2
@@ -488,10 +411,42 @@ def main():
     ## narrowed (with a slight uptick in 2023). The overall percentage of female names in the top 200 rankings
     ## was slightly lower than that of male names, but the difference was not significant.
 
-    # 13. Find 2 names that were relatively often given to girls and boys in Poland.
+    return {'pl_top_df': pl_df, 'pl_tensor': pl_tensor, 'top_200_pl_names': top_200_pl_names,
+            'top_200_percentage_pl': top_200_percentage_pl, 'pl_histogram_df': pl_histogram_df,
+            'pl_histogram_range': pl_histogram_range, 'report_12': text}
 
+def pl_diversity_in_memory(pl_df, pl_data_key, engine, cache):
+    # Calculate the frequency of the names
+    pl_df = calculate_frequency(pl_df.copy(deep=False))
+    pl_tensor = None
+    if engine == 'tensor':
+        pl_tensor = CountTensor(pl_df)
+        # Calculate the top 200 names ranking
+        top_200_pl_names = pl_tensor.top_n_names(200)
+        # Calculate the diversity of the names
+        pl_df['in_top'] = in_ranking(pl_df, top_200_pl_names.index)
+        top_200_percentage_pl = pl_tensor.name_diversity(top_200_pl_names)
+    else:
+        # Calculate the top 200 names ranking
+        top_200_pl_names = cached_top_n_names(pl_df, 200, cache, pl_data_key)
+        # Calculate the diversity of the names
+        pl_df, top_200_percentage_pl = cached_name_diversity(pl_df, top_200_pl_names, cache, pl_data_key)
+    return pl_df, pl_tensor, top_200_pl_names, top_200_percentage_pl
+
+def plot_pl_histograms(figures, pl_histogram_df, pl_histogram_range):
+    # Only the rows and columns used in the histograms are sent to the renderer
+    figures.plot('pl_histograms', pl_df=pl_histogram_df, value_range=pl_histogram_range)
+
+# 13. Find 2 names that were relatively often given to girls and boys in Poland.
+def task_pl_connotation(pl_top_df, pl_tensor, pl_db, top_200_pl_names, pl_data_key, cache):
     # Calculate the connotation
-    name_ratios_pl_2000_2023 = calculate_name_gender_ratio(pl_df, 2000, 2023, False)
+    if pl_db is not None:
+        name_ratios_pl_2000_2023 = pl_db.name_gender_ratio(2000, 2023, False, top_200_pl_names)
+    elif pl_tensor is not None:
+        name_ratios_pl_2000_2023 = pl_tensor.name_gender_ratio(2000, 2023, False, top_200_pl_names)
+    else:
+        name_ratios_pl_2000_2023 = cached_name_gender_ratio(pl_top_df, 2000, 2023, False, cache,
+                                                           ranking_key(pl_data_key, top_200_pl_names))
 
     # Calculate the ratio of the name being given to boys and girls
     name_ratios_pl_2000_2023['ratio'] = abs(name_ratios_pl_2000_2023['p_m'] - name_ratios_pl_2000_2023['p_f'])
@@ -504,13 +459,144 @@ def main():
     name_ratios_pl_2000_2023['total_count'] = name_ratios_pl_2000_2023['count']['F'] + name_ratios_pl_2000_2023['count']['M']
     names_with_similar_ratio = name_ratios_pl_2000_2023.nlargest(2, 'total_count').index.to_list()
 
-    print("-------------------------------------------------")
-    print("13. Names that were relatively often given to both boys and girls in Poland:",
-          names_with_similar_ratio[0], "and", names_with_similar_ratio[1])
+    text = report(("13. Names that were relatively often given to both boys and girls in Poland:",
+                   names_with_similar_ratio[0], "and", names_with_similar_ratio[1]))
 
     ### Output:
     ### 13. Names that were relatively often given to both boys and girls in Poland: ANDREA YUVAL
 
+    return {'report_13': text}
+
+def plot_usa_diversity(figures, top_1000_percentage_usa):
+    figures.plot('usa_diversity', reshaped=top_1000_percentage_usa, n=1000, country='USA')
+
+def plot_pl_diversity(figures, top_200_percentage_pl):
+    figures.plot('pl_diversity', reshaped=top_200_percentage_pl, n=200, country='Poland')
+
+def build_stages(plots=True, connotation_scan=False):
+    # The tasks with their inputs and outputs - the stages that don't depend on each other
+    # (e.g. the whole Polish part and the USA part) can run at the same time.
+    stages = [
+        Stage('1. load USA', load_usa_data, ['shared_data'], ['usa_df', 'usa_names', 'usa_data_key']),
+        Stage('2-3. unique names', task_unique_names, ['usa_df'], ['report_2']),
+        Stage('4. frequency', task_frequency, ['usa_df', 'engine'], ['usa_frequency_df', 'usa_tensor']),
+        Stage('5. births', task_births, ['usa_df'], ['births_per_year', 'birth_ratio_df', 'report_5']),
+        Stage('6. top 1000', task_top_names, ['usa_frequency_df', 'usa_tensor', 'usa_data_key', 'cache'],
+              ['top_1000_usa_names']),
+        Stage('7. name index', task_name_index, ['usa_df'], ['usa_index']),
+        Stage('7. name trend', task_name_trend, ['usa_index', 'top_1000_usa_names'],
+              ['top_female_name_usa', 'john_series', 'top_female_series', 'report_7']),
+        Stage('8. diversity', task_diversity,
+              ['usa_frequency_df', 'usa_tensor', 'top_1000_usa_names', 'usa_data_key', 'cache'],
+              ['usa_top_df', 'top_1000_percentage_usa', 'report_8']),
+        Stage('9. last letters', task_last_letters, ['usa_df', 'usa_names'],
+              ['last_letter_selected_years_male', 'last_letter_selected_letters_df', 'report_9']),
+        Stage('10. connotation', task_connotation,
+              ['usa_top_df', 'usa_tensor', 'top_1000_usa_names', 'usa_index', 'usa_data_key', 'cache'],
+              ['name_trend_usa_df', 'report_10']),
+    ]
+    if connotation_scan:
+        stages.append(Stage('10. connotation scan', task_connotation_scan,
+                            ['usa_top_df', 'top_1000_usa_names', 'connotation_window'], ['report_10_scan']))
+    stages += [
+        Stage('11. load Poland', load_pl_data, ['pl_engine', 'pl_index'], ['pl_df', 'pl_db', 'pl_data_key']),
+        Stage('12. Poland diversity', task_pl_diversity, ['pl_df', 'pl_db', 'pl_data_key', 'engine', 'cache'],
+              ['pl_top_df', 'pl_tensor', 'top_200_pl_names', 'top_200_percentage_pl', 'pl_histogram_df',
+               'pl_histogram_range', 'report_12']),
+        Stage('13. Poland connotation', task_pl_connotation,
+              ['pl_top_df', 'pl_tensor', 'pl_db', 'top_200_pl_names', 'pl_data_key', 'cache'], ['report_13']),
+    ]
+    if plots:
+        # The plot stages only pass the data to the renderer (in rendering.py), so they run in the main thread
+        # (the interactive figures use the stateful pyplot API, and the renderer draws them in its own pool)
+        stages += [
+            Stage('5. plot', plot_births, ['figures', 'births_per_year', 'birth_ratio_df'], main_thread=True),
+            Stage('7. plot', plot_name_trend, ['figures', 'top_female_name_usa', 'john_series', 'top_female_series'],
+                  main_thread=True),
+            Stage('8. plot', plot_usa_diversity, ['figures', 'top_1000_percentage_usa'], main_thread=True),
+            Stage('9. plot', plot_last_letters,
+                  ['figures', 'last_letter_selected_years_male', 'last_letter_selected_letters_df'], main_thread=True),
+            Stage('10. plot', plot_connotation, ['figures', 'name_trend_usa_df'], main_thread=True),
+            Stage('12. plot diversity', plot_pl_diversity, ['figures', 'top_200_percentage_pl'], main_thread=True),
+            Stage('12. plot histograms', plot_pl_histograms, ['figures', 'pl_histogram_df', 'pl_histogram_range'],
+                  main_thread=True),
+        ]
+    return stages
+
+def stage_tasks(stage):
+    # Numbers of the tasks of a stage, from its name ('2-3. unique names' -> 2, 3)
+    first, _, last = stage.name.split('.')[0].partition('-')
+    return set(range(int(first), int(last or first) + 1))
+
+def select_stages(stages, tasks=None, countries=None):
+    # The stages of the given tasks (of the given countries) with the stages they depend on
+    wanted = set(tasks) if tasks is not None else set(range(1, 14))
+    if countries is not None:
+        wanted = {task for country in countries for task in TASK_COUNTRIES[country]
+                  if task in wanted or task in {TASK_EQUIVALENTS.get(country, {}).get(number) for number in wanted}}
+    selected = [stage for stage in stages if stage_tasks(stage) & wanted]
+    if not selected:
+        raise ValueError(f'No tasks to run (tasks: {tasks}, countries: {countries})')
+    return required_stages(stages, selected)
+
+def parse_tasks(text):
+    # '6,8' or '2-5,9' -> the numbers of the tasks
+    tasks = set()
+    for part in text.split(','):
+        first, _, last = part.partition('-')
+        tasks.update(range(int(first), int(last or first) + 1))
+    return sorted(tasks)
+
+class ReportPrinter:
+    # Prints the answers in the order of the tasks, as soon as all the previous answers are available
+
+    def __init__(self, order):
+        self.order = list(order)
+        self.reports = {}
+
+    def __call__(self, stage, result):
+        self.reports.update({name: value for name, value in result.items() if name in self.order})
+        while self.order and self.order[0] in self.reports:
+            print(self.reports.pop(self.order.pop(0)))
+
+def main(engine='pandas', executor='thread', max_workers=None, cache_dir=os.path.join('data', 'cache', 'results'),
+         plots='show', figures_dir='figures', figure_formats=('png',), profiler=None, profile_output=None,
+         pl_engine='pandas', pl_index=False, connotation_window=None, shared_data=None, tasks=None, countries=None):
+    # The statistics can be calculated either with pandas (engine='pandas')
+    # or on a dense years x names x sexes matrix of counts (engine='tensor').
+    # The independent tasks run concurrently in a thread pool (executor='thread'), a process pool (executor='process')
+    # or one after another (executor=None)
+    # The results of the pandas engine are cached in cache_dir (cache_dir=None keeps them only in memory)
+    # plots='show' displays the figures at the end, plots='save' renders them in the background and writes them
+    # to figures_dir (in every format from figure_formats), plots=None skips the figures (matplotlib isn't imported)
+    # profiler - profiling.Profiler recording the time, memory and rows of every stage and analysis function,
+    # the report is displayed at the end and saved to profile_output (JSON)
+    # pl_engine='sqlite' calculates the aggregations of the Polish tasks in the database instead of loading all the rows,
+    # pl_index=True adds the indexes for its queries to the database first (it's not modified otherwise)
+    # connotation_window - length of the windows of years compared pairwise in the connotation scan (None skips it)
+    # shared_data - directory of the memory-mapped USA dataset (exported on the first run), None loads the files
+    # tasks, countries - run only the given tasks (numbers) of the given countries and the stages they depend on
+
+    # Initialize the timer
+    test_time = pd.Timestamp.now()
+
+    stages = build_stages(plots is not None, connotation_window is not None)
+    if tasks is not None or countries is not None:
+        stages = select_stages(stages, tasks, countries)
+    printer = ReportPrinter([output for stage in stages for output in stage.outputs if output.startswith('report_')])
+    initial = {'engine': engine, 'pl_engine': pl_engine, 'pl_index': pl_index, 'cache': ResultCache(cache_dir),
+               'connotation_window': connotation_window, 'shared_data': shared_data}
+    if plots == 'save':
+        initial['figures'] = FigureRenderer(figures_dir, figure_formats)
+    elif plots == 'show':
+        initial['figures'] = InteractiveFigures()
+    startup_time = time.perf_counter() - START_TIME
+    values, timings = run_stages(stages, initial, executor=executor, max_workers=max_workers, on_complete=printer,
+                                 profiler=profiler)
+
+    # Wait for the rendered figures
+    figure_files = initial['figures'].finish() if plots == 'save' else {}
+
     # Stop the timer and display the execution time
     test_end_time = pd.Timestamp.now()
     print("-------------------------------------------------")
@@ -519,8 +605,81 @@ def main():
     ### Script execution time: 0 days 00:00:04.618503
     ### On average the script execution time is around 4.7 seconds on Ryzen 5 5600H
 
-    plt.show()
-    
+    # Display the time of every stage
+    print("-------------------------------------------------")
+    print(format_timings(stages, timings))
+    print(f"{'Imports':<28}{IMPORT_TIME:>36.3f}")
+    print(f"{'Startup':<28}{startup_time:>36.3f}")
+
+    if figure_files:
+        print("-------------------------------------------------")
+        print("Figures saved to:", ', '.join(path for paths in figure_files.values() for path in paths))
+
+    # Display (and save) the profiling report
+    if profiler is not None:
+        print("-------------------------------------------------")
+        print(profiler.format_report())
+        if profile_output is not None:
+            profiler.save(profile_output)
+            print("Profiling report saved to:", profile_output)
+    if plots == 'show':
+        initial['figures'].finish()
+
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Analysis of the names given in the USA and in Poland')
+    parser.add_argument('--engine', choices=['pandas', 'tensor'], default='pandas')
+    parser.add_argument('--pl-engine', choices=['pandas', 'sqlite'], default='pandas',
+                        help='sqlite - calculate the Polish aggregations in the database')
+    parser.add_argument('--pl-index', action='store_true',
+                        help='with --pl-engine sqlite, add the indexes for the queries to the Polish database '
+                             '(modifies the file, needed only once)')
+    parser.add_argument('--connotation-scan', type=int, metavar='YEARS',
+                        help='also compare the connotation of the names in all pairs of windows of YEARS years')
+    parser.add_argument('--tasks', type=parse_tasks, metavar='LIST',
+                        help='run only these tasks (e.g. 6,8 or 2-5) and the stages they depend on')
+    parser.add_argument('--country', action='append', metavar='COUNTRY',
+                        help='run only the tasks of the country (USA / us, Poland / pl), can be given more than once')
+    parser.add_argument('--executor', choices=['thread', 'process', 'none'], default='thread')
+    parser.add_argument('--shared-data', metavar='DIR',
+                        help='map the USA dataset from DIR (exported there on the first run) instead of loading it, '
+                             'the worker processes share it without copying')
+    parser.add_argument('--no-plots', action='store_true', help="don't draw the figures (matplotlib isn't imported)")
+    parser.add_argument('--save-figures', metavar='DIR', help='render the figures without a display and save them to DIR')
+    parser.add_argument('--format', action='append', choices=['png', 'svg', 'pdf'],
+                        help='format of the saved figures (can be given more than once, default: png)')
+    parser.add_argument('--profile', action='store_true',
+                        help='record the time, CPU time, memory and rows of every stage and analysis function')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='measure the memory of the stages with tracemalloc (slower, use with --executor none)')
+    parser.add_argument('--profile-stage', action='append', default=[], metavar='STAGE',
+                        help='run the stage (e.g. "6. top 1000") under cProfile, can be given more than once')
+    parser.add_argument('--profile-output', metavar='FILE', help='save the profiling report as JSON')
+    parser.add_argument('--profile-dir', default='profiles', help='directory for the cProfile statistics')
+    args = parser.parse_args()
+    aliases = country_aliases(TASK_COUNTRIES)
+    countries = None
+    if args.country:
+        unknown = [country for country in args.country if country.lower() not in aliases]
+        if unknown:
+            parser.error(f'unknown country {unknown[0]!r}, available: {", ".join(TASK_COUNTRIES)}')
+        countries = [aliases[country.lower()] for country in args.country]
+    if args.tasks is not None or countries is not None:
+        try:
+            select_stages(build_stages(), args.tasks, countries)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.no_plots:
+        plots = None
+    elif args.save_figures:
+        plots = 'save'
+    else:
+        plots = 'show'
+    profiler = None
+    if args.profile or args.trace_memory or args.profile_stage or args.profile_output:
+        profiler = Profiler('tracemalloc' if args.trace_memory else 'rss', args.profile_stage, args.profile_dir)
+    main(args.engine, None if args.executor == 'none' else args.executor, plots=plots,
+         figures_dir=args.save_figures, figure_formats=args.format or ('png',), profiler=profiler,
+         profile_output=args.profile_output, pl_engine=args.pl_engine, pl_index=args.pl_index,
+         connotation_window=args.connotation_scan, shared_data=args.shared_data, tasks=args.tasks, countries=countries)
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+
+
+class NameIndex:
+    # Index of the (name, sex) time series, built once from the DataFrame (with the encoded names).
+    # The rows are sorted by (name, sex, year) and the series of every (name, sex) pair is stored as a contiguous
+    # slice, so getting the series is O(1) and getting a single year is a binary search within the slice
+
+    def __init__(self, df):
+        self.names = df['name'].cat.categories
+        self.sexes = df['sex'].cat.categories
+        self.name_dtype = df['name'].dtype
+        self.sex_dtype = df['sex'].dtype
+
+        name_ids = df['name'].cat.codes.to_numpy().astype(np.int64)
+        sex_ids = df['sex'].cat.codes.to_numpy().astype(np.int64)
+        years = df['year'].to_numpy()
+        counts = df['count'].to_numpy()
+
+        # Total number of births for each year and sex, used to calculate the popularity of the names
+        all_years, year_ids = np.unique(years, return_inverse=True)
+        totals = np.bincount(year_ids * len(self.sexes) + sex_ids, weights=counts,
+                             minlength=len(all_years) * len(self.sexes))
+
+        slots = name_ids * len(self.sexes) + sex_ids
+        order = np.lexsort((years, slots))
+        self.years = years[order]
+        self.counts = counts[order]
+        self.frequency = counts[order] / totals[(year_ids * len(self.sexes) + sex_ids)[order]]
+        # Start of the slice of every (name, sex) pair - the slice of the pair 'slot' is offsets[slot]:offsets[slot + 1]
+        self.offsets = np.searchsorted(slots[order], np.arange(len(self.names) * len(self.sexes) + 1))
+
+    def slot(self, name, sex):
+        # Position of the (name, sex) pair - raises KeyError for unknown names
+        return self.names.get_loc(name) * len(self.sexes) + self.sexes.get_loc(sex)
+
+    def slots(self, names, sexes):
+        # Vectorized version of slot, -1 for the unknown names
+        name_ids = self.names.get_indexer(names)
+        sex_ids = self.sexes.get_indexer(sexes)
+        return np.where((name_ids >= 0) & (sex_ids >= 0), name_ids * len(self.sexes) + sex_ids, -1)
+
+    def series(self, name, sex):
+        # Count and popularity of the name in every year in which it was given
+        slot = self.slot(name, sex)
+        rows = slice(self.offsets[slot], self.offsets[slot + 1])
+        return pd.DataFrame({'count': self.counts[rows], 'frequency': self.frequency[rows]},
+                            index=pd.Index(self.years[rows], name='year'))
+
+    def get(self, name, sex, year, column='count'):
+        # Value for a single year (0 if the name wasn't given in that year)
+        slot = self.slot(name, sex)
+        start, end = self.offsets[slot], self.offsets[slot + 1]
+        position = start + np.searchsorted(self.years[start:end], year)
+        if position == end or self.years[position] != year:
+            return 0
+        return self.counts[position] if column == 'count' else self.frequency[position]
+
+    def series_many(self, names, sexes=None):
+        # Series of many names at once, in a long DataFrame indexed by (name, sex, year).
+        # If sexes is None, both sexes are returned for every name, unknown names are skipped
+        if sexes is None:
+            names, sexes = np.repeat(np.asarray(names, dtype=object), len(self.sexes)), np.tile(self.sexes, len(names))
+        elif isinstance(sexes, str):
+            sexes = [sexes] * len(names)
+        slots = self.slots(names, sexes)
+        slots = slots[slots >= 0]
+
+        # Gather the slices of all pairs without a Python loop
+        starts = self.offsets[slots]
+        lengths = self.offsets[slots + 1] - starts
+        positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+
+        slot_of_row = np.repeat(slots, lengths)
+        index = pd.MultiIndex.from_arrays([pd.Categorical.from_codes(slot_of_row // len(self.sexes), dtype=self.name_dtype),
+                                           pd.Categorical.from_codes(slot_of_row % len(self.sexes), dtype=self.sex_dtype),
+                                           self.years[positions]], names=['name', 'sex', 'year'])
+        return pd.DataFrame({'count': self.counts[positions], 'frequency': self.frequency[positions]}, index=index)
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+
+
+def build_name_table(names):
+    # Build the dictionary of unique names, sorted alphabetically, where the position of the name is its id
+    # (the ids are the codes of the categorical 'name' column - int32 for datasets with 100k+ names)
+    names = pd.Index(pd.unique(np.asarray(names, dtype=object))).sort_values()
+    names.name = 'name'
+    table = pd.DataFrame({'name': names})
+    table.index.name = 'name_id'
+
+    # Per-name attributes are computed once for every unique name instead of once for every row
+    table['last_letter'] = names.str[-1].astype('category')
+    table['length'] = names.str.len().astype('int16')
+    return table
+
+
+def encode_names(df, table=None):
+    # Replace the 'name' column with a categorical column whose codes are the ids from the name table,
+    # so that grouping, indexing and comparing the names is done on integers instead of strings
+    if table is None:
+        names = df['name'].cat.categories if isinstance(df['name'].dtype, pd.CategoricalDtype) else df['name']
+        table = build_name_table(names)
+    df['name'] = pd.Categorical(df['name'], categories=table['name'])
+    return df, table
+
+
+def name_codes(df):
+    # Integer ids of the names in every row
+    return df['name'].cat.codes.to_numpy()
+
+
+def name_attribute(df, table, attribute):
+    # Broadcast a per-name attribute to every row of the DataFrame using the integer ids
+    values = table[attribute]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return pd.Categorical.from_codes(values.cat.codes.to_numpy()[name_codes(df)], dtype=values.dtype)
+    return values.to_numpy()[name_codes(df)]
+
+
+def in_ranking(df, ranking_index):
+    # Check if the (name, sex) pair of every row is in the ranking, using a names x sexes lookup table
+    # (countries x names x sexes for a ranking of every country)
+    levels = ['country', 'name', 'sex'] if 'country' in ranking_index.names else ['name', 'sex']
+    categories = [df[level].cat.categories for level in levels]
+    ids = [values.get_indexer(ranking_index.get_level_values(level)) for level, values in zip(levels, categories)]
+    found = np.logical_and.reduce([level_ids >= 0 for level_ids in ids])
+
+    lookup = np.zeros([len(values) for values in categories], dtype=bool)
+    lookup[tuple(level_ids[found] for level_ids in ids)] = True
+    return lookup[tuple(df[level].cat.codes.to_numpy() for level in levels)]
+
@@ -0,0 +1,370 @@
+import argparse
+import os
+import pickle
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from analysis import (calculate_frequency, calculate_last_letter_distribution, calculate_name_diversity,
+                      calculate_name_gender_ratio, calculate_top_n_names, group_keys)
+from approximate import PartitionSketch, approximate_top_n_names, build_sketches
+from benchmark import ensure_dataset
+from connotation import ConnotationScan
+from features import NameFeatures, compute_feature
+from incremental import IncrementalState
+from loader import list_year_files, load_usa_names
+from name_table import encode_names, name_attribute
+from ranking import RankingEngine
+from shared_data import OPENED, export_dataset, open_dataset
+from streaming import (stream_last_letter_distribution, stream_name_diversity, stream_name_gender_ratio,
+                       stream_top_n_names, stream_unique_names, year_partitions)
+from sources import PL_SOURCE, USA_SOURCE, combine_sources, load_source, load_sources
+from sqlite_engine import SQLiteNames
+from tensor import CountTensor
+
+
+def check_tensor_parity(df, n):
+    # Compare the results of the tensor engine with the pandas functions (df must have the frequency column)
+    tensor = CountTensor(df)
+    top_names = calculate_top_n_names(df, n)
+    pd.testing.assert_frame_equal(tensor.top_n_names(n), top_names, check_index_type=False)
+
+    df, reshaped = calculate_name_diversity(df.copy(), top_names)
+    np.testing.assert_allclose(tensor.name_diversity(top_names)[['F', 'M']].to_numpy(), reshaped[['F', 'M']].to_numpy())
+
+    years = df['year'].agg(['min', 'max']).to_list()
+    for only_top in [True, False]:
+        ratio_df = calculate_name_gender_ratio(df, years[0], years[1], only_top)
+        pd.testing.assert_frame_equal(tensor.name_gender_ratio(years[0], years[1], only_top, top_names), ratio_df,
+                                      check_dtype=False, check_index_type=False, check_column_type=False)
+
+
+def check_streaming_parity(data_dir, cache_path, n, start_year, end_year):
+    # Compare the results of the streaming (year by year) functions with the in-memory pandas functions
+    df, names = encode_names(load_usa_names(data_dir, cache_path=cache_path))
+    df = calculate_frequency(df)
+    df['last_letter'] = name_attribute(df, names, 'last_letter')
+
+    unique_names, unique_names_by_sex = stream_unique_names(year_partitions(data_dir, cache_path))
+    assert unique_names == df['name'].nunique()
+    assert unique_names_by_sex.to_dict() == df.groupby('sex', observed=True)['name'].nunique().to_dict()
+
+    top_names = calculate_top_n_names(df, n)
+    stream_top_names = stream_top_n_names(year_partitions(data_dir, cache_path), n)
+    assert stream_top_names.index.to_list() == top_names.index.to_list()
+    np.testing.assert_allclose(stream_top_names.to_numpy(), top_names.to_numpy())
+
+    df, reshaped = calculate_name_diversity(df, top_names)
+    stream_reshaped = stream_name_diversity(year_partitions(data_dir, cache_path), top_names)
+    np.testing.assert_allclose(stream_reshaped[['F', 'M']].to_numpy(), reshaped[['F', 'M']].to_numpy())
+
+    last_letter_df = calculate_last_letter_distribution(df)
+    stream_last_letter_df = stream_last_letter_distribution(year_partitions(data_dir, cache_path))
+    np.testing.assert_allclose(stream_last_letter_df[last_letter_df.columns.to_list()].to_numpy(), last_letter_df.to_numpy())
+
+    for only_top in [True, False]:
+        ratio_df = calculate_name_gender_ratio(df, start_year, end_year, only_top)
+        stream_ratio_df = stream_name_gender_ratio(year_partitions(data_dir, cache_path), start_year, end_year, only_top,
+                                                   top_names)
+        pd.testing.assert_frame_equal(stream_ratio_df, ratio_df, check_dtype=False, check_index_type=False,
+                                      check_column_type=False, check_categorical=False)
+
+
+def check_incremental_parity(data_dir, n, ranges, new_files=2):
+    # Ingest all but the last new_files years, then fold in the remaining ones and compare the results
+    # with the pandas functions run on the whole dataset
+    df, names = encode_names(load_usa_names(data_dir))
+    df = calculate_frequency(df)
+    df['last_letter'] = name_attribute(df, names, 'last_letter')
+    top_names = calculate_top_n_names(df, n)
+    df, reshaped = calculate_name_diversity(df, top_names)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files_dir = os.path.join(tmp_dir, 'names')
+        os.makedirs(files_dir)
+        files = list_year_files(data_dir)
+        for file in files[:-new_files]:
+            os.symlink(os.path.abspath(file), os.path.join(files_dir, os.path.basename(file)))
+        IncrementalState.load(os.path.join(tmp_dir, 'state'), n, ranges).update(files_dir)
+
+        for file in files[-new_files:]:
+            os.symlink(os.path.abspath(file), os.path.join(files_dir, os.path.basename(file)))
+        state = IncrementalState.load(os.path.join(tmp_dir, 'state'), n, ranges)
+        assert len(state.update(files_dir)) == new_files
+
+        assert state.top_names.index.to_list() == top_names.index.to_list()
+        np.testing.assert_allclose(state.top_names.to_numpy(), top_names.to_numpy())
+        np.testing.assert_allclose(state.name_diversity()[['F', 'M']].to_numpy(), reshaped[['F', 'M']].to_numpy())
+        last_letter_df = calculate_last_letter_distribution(df)
+        np.testing.assert_allclose(state.last_letter_distribution()[last_letter_df.columns.to_list()].to_numpy(),
+                                   last_letter_df.to_numpy())
+        for start_year, end_year in ranges:
+            for only_top in [True, False]:
+                pd.testing.assert_frame_equal(state.name_gender_ratio(start_year, end_year, only_top),
+                                              calculate_name_gender_ratio(df, start_year, end_year, only_top),
+                                              check_dtype=False, check_index_type=False, check_column_type=False,
+                                              check_categorical=False)
+
+        # Removing the new years again must leave the same state as never ingesting them
+        for file in files[-new_files:]:
+            os.remove(os.path.join(files_dir, os.path.basename(file)))
+        state.update(files_dir)
+        fresh_state = IncrementalState.load(os.path.join(tmp_dir, 'fresh_state'), n, ranges)
+        fresh_state.update(files_dir)
+        for name, table in fresh_state.tables.items():
+            pd.testing.assert_frame_equal(state.tables[name].sort_index(), table.sort_index(), check_exact=False)
+        assert state.top_names.index.to_list() == fresh_state.top_names.index.to_list()
+
+
+def check_sqlite_parity(db_path, n, start_year, end_year):
+    # Compare the aggregations calculated by SQLite with the pandas functions run on the loaded database
+    df = calculate_frequency(encode_names(load_source(PL_SOURCE.with_options(path=db_path)))[0])
+    db = SQLiteNames(db_path)
+    top_names = calculate_top_n_names(df, n)
+    sqlite_top_names = db.top_n_names(n)
+    assert [tuple(map(str, key)) for key in sqlite_top_names.index] == [tuple(map(str, key)) for key in top_names.index]
+    np.testing.assert_allclose(sqlite_top_names.to_numpy(), top_names.to_numpy())
+
+    df, reshaped = calculate_name_diversity(df, top_names)
+    np.testing.assert_allclose(db.name_diversity(top_names)[['F', 'M']].to_numpy(), reshaped[['F', 'M']].to_numpy())
+    assert db.lowest_count().to_dict() == df.groupby('year')['count'].min().to_dict()
+
+    for only_top in [True, False]:
+        ratio_df = calculate_name_gender_ratio(df, start_year, end_year, only_top)
+        sqlite_ratio_df = db.name_gender_ratio(start_year, end_year, only_top, top_names)
+        assert sqlite_ratio_df.index.astype(str).to_list() == ratio_df.index.astype(str).to_list()
+        np.testing.assert_allclose(sqlite_ratio_df.to_numpy(dtype=float), ratio_df.to_numpy(dtype=float))
+
+    years = sorted(df['year'].unique())[::5]
+    rows = db.frequency_rows(years, top_names)
+    expected = df[df['year'].isin(years)]
+    assert len(rows) == len(expected) and rows['in_top'].sum() == expected['in_top'].sum()
+    np.testing.assert_allclose(np.sort(rows['frequency'].to_numpy()), np.sort(expected['frequency'].to_numpy()))
+    frequency_female = df['frequency'].where(df['sex'] == 'F', 0)
+    np.testing.assert_allclose(db.female_frequency_range(), (frequency_female.min(), frequency_female.max()))
+    db.close()
+
+
+def check_country_parity(sources, n, start_year, end_year):
+    # Compare the analyses of several countries calculated in one grouped pass with every country analyzed on its own
+    frames = load_sources(sources)
+    df, names = combine_sources(frames)
+    df['last_letter'] = name_attribute(df, names, 'last_letter')
+    df = calculate_frequency(df)
+    top_names = calculate_top_n_names(df, n)
+    df, reshaped = calculate_name_diversity(df, top_names)
+    last_letters = calculate_last_letter_distribution(df)
+    ratio_df = calculate_name_gender_ratio(df, start_year, end_year, False)
+
+    for country, country_df in frames.items():
+        country_df, country_names = encode_names(country_df.copy())
+        country_df['last_letter'] = name_attribute(country_df, country_names, 'last_letter')
+        country_df = calculate_frequency(country_df)
+        country_top_names = calculate_top_n_names(country_df, n)
+        pd.testing.assert_frame_equal(top_names.xs(country, level='country'), country_top_names,
+                                      check_index_type=False, check_categorical=False)
+        country_df, country_reshaped = calculate_name_diversity(country_df, country_top_names)
+        pd.testing.assert_frame_equal(reshaped.xs(country, level='country'), country_reshaped, check_names=False)
+        # The letters of the other countries are 0
+        country_letters = last_letters.xs(country, level='country')
+        pd.testing.assert_frame_equal(country_letters.loc[:, (country_letters != 0).any()],
+                                      calculate_last_letter_distribution(country_df),
+                                      check_categorical=False, check_column_type=False, check_names=False)
+        pd.testing.assert_frame_equal(ratio_df.xs(country, level='country').dropna(how='all'),
+                                      calculate_name_gender_ratio(country_df, start_year, end_year, False),
+                                      check_dtype=False, check_index_type=False, check_categorical=False)
+
+
+def check_feature_parity(df, names, features=('last_letter', 'first_letter', 'suffix2', 'length', 'cv_suffix3'),
+                         years=None):
+    # Compare the distributions aggregated on the codes of the name features with a groupby on the feature
+    # calculated from the name of every row
+    name_features = NameFeatures(names)
+    if years is not None:
+        df = df[df['year'].isin(years)]
+    for feature in features:
+        row_values = pd.Categorical(compute_feature(df['name'], feature).to_numpy())
+        expected = df.assign(**{feature: row_values}).groupby(group_keys(df, ['year', 'sex', feature]),
+                                                              observed=True)['count'].sum()
+        expected = expected.unstack(level=feature, fill_value=0)
+        expected = expected.div(expected.sum(axis=1), axis=0)
+        pd.testing.assert_frame_equal(name_features.distribution(df, feature, years=years).sort_index(axis=1),
+                                      expected.sort_index(axis=1), check_categorical=False,
+                                      check_column_type=False, check_index_type=False)
+
+
+def check_ranking_parity(df, ns, windows):
+    # Compare the rankings of the engine with calculate_top_n_names on the rows of every window (the scores
+    # are differences of prefix sums, so they can differ from the groupby sums in the last bits)
+    engine = RankingEngine(df)
+    for start_year, end_year in windows:
+        window_df = df[df['year'].between(start_year, end_year)]
+        for n in ns:
+            top_names = calculate_top_n_names(window_df, n)
+            engine_top_names = engine.top_n_names(n, start_year, end_year)
+            assert engine_top_names.index.to_list() == top_names.index.to_list()
+            np.testing.assert_allclose(engine_top_names.to_numpy(), top_names.to_numpy(), rtol=1e-9, atol=1e-15)
+
+    # Ranks within every (year, sex) - by the frequency, ties by the name id
+    ranked = df.assign(name_id=df['name'].cat.codes).sort_values(['year', 'sex', 'frequency', 'name_id'],
+                                                                 ascending=[True, True, False, True])
+    ranked['rank'] = ranked.groupby(['year', 'sex'], observed=True).cumcount() + 1
+    for name, sex in ranked[ranked['rank'] <= 3][['name', 'sex']].drop_duplicates().itertuples(index=False):
+        expected = ranked[(ranked['name'] == name) & (ranked['sex'] == sex)].set_index('year')['rank']
+        trajectory = engine.rank_trajectory(name, sex)
+        assert trajectory.dropna().astype('int64').to_dict() == expected.astype('int64').to_dict()
+    for n in ns:
+        in_top = ranked[ranked['rank'] <= n].groupby(['name', 'sex'], observed=True)['rank'].agg(['size', 'min'])
+        years_in_top = engine.years_in_top(n)
+        assert years_in_top['years_in_top'].to_list() == in_top['size'].to_list()
+        assert years_in_top['best_rank'].to_list() == in_top['min'].to_list()
+        year, sex = df['year'].iloc[0], df['sex'].iloc[0]
+        year_ranked = ranked[(ranked['year'] == year) & (ranked['sex'] == sex)]
+        assert engine.year_top(year, sex, n).to_list() == year_ranked['name'].iloc[:n].to_list()
+
+
+def check_connotation_parity(df, top_names, windows):
+    # Compare p_m / p_f and the changes of the connotation from the prefix sums with calculate_name_gender_ratio
+    # (df with the in_top column of the ranking)
+    scan = ConnotationScan(df, top_names)
+    ratios = {}
+    for start_year, end_year in windows:
+        ratio_df = calculate_name_gender_ratio(df, start_year, end_year, True)
+        ratio_df = ratio_df[ratio_df['p_m'].notna()]
+        ratios[start_year, end_year] = ratio_df
+        window_df = scan.window_ratio(start_year, end_year)
+        assert window_df.index.astype(str).to_list() == ratio_df.index.astype(str).to_list()
+        np.testing.assert_array_equal(window_df['p_m'].to_numpy(), ratio_df['p_m'].to_numpy())
+
+    scan_df = scan.scan(windows).set_index(['x_start', 'x_end', 'y_start', 'y_end'])
+    for first in windows:
+        for second in windows:
+            if second[0] <= first[1]:
+                continue
+            # The same as Task 10 in main.py
+            change = ((ratios[first]['p_m'] + ratios[second]['p_f']) / 2).dropna()
+            if change.empty:
+                continue
+            row = scan_df.loc[first + second]
+            assert str(row['m2f_name']) == str(change.idxmax()) and row['m2f_change'] == change.max()
+            assert str(row['f2m_name']) == str(change.idxmin()) and row['f2m_change'] == 1 - change.min()
+
+
+def check_shared_parity(data_dir, n):
+    # Export the dataset to the mapped files and compare the opened frame (also in a worker process, which gets
+    # only its path) with the loaded one
+    df, names = encode_names(load_usa_names(data_dir))
+    df = calculate_frequency(df)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'usa')
+        export_dataset(df, path)
+        OPENED.clear()
+        dataset = open_dataset(path)
+        shared_df = dataset.frame()
+        pd.testing.assert_frame_equal(pd.DataFrame(shared_df), df[shared_df.columns])
+        pd.testing.assert_frame_equal(dataset.names, names)
+        np.testing.assert_array_equal(dataset.births_by_sex().to_numpy(),
+                                      df.groupby(['year', 'sex'], observed=True)['count'].sum().to_numpy())
+        assert len(pickle.dumps(shared_df)) < 1024
+
+        with ProcessPoolExecutor(max_workers=2) as pool:
+            top_names = pool.submit(calculate_top_n_names, shared_df, n).result()
+        pd.testing.assert_frame_equal(top_names, calculate_top_n_names(df, n))
+
+        # Once a column is changed in place, the frame is pickled with its data instead of the path
+        shared_df['count'] = shared_df['count'] * 2
+        pd.testing.assert_frame_equal(pickle.loads(pickle.dumps(shared_df)), pd.DataFrame(shared_df))
+        OPENED.clear()
+
+
+def check_approximate_bounds(df, n, heavy_hitters=500):
+    # The exact scores of the approximate ranking have to be within its error bounds - also when the sketches
+    # of the years are merged in two steps (by decades first), like the sketches of separate partitions
+    # (df must have the frequency column)
+    sketches = {('USA', year): sketch for year, sketch in build_sketches(df, heavy_hitters).items()}
+    decades = {}
+    for (country, year), sketch in sketches.items():
+        decades.setdefault((country, year // 10 * 10), []).append(sketch)
+    merged = {key: PartitionSketch.merge(parts, heavy_hitters) for key, parts in decades.items()}
+    scores = df.groupby(['name', 'sex'], observed=True)['frequency'].sum() / df['year'].nunique()
+    scores.index = scores.index.set_levels(scores.index.levels[0].astype(str), level='name')
+    for country_sketches in [sketches, merged]:
+        top_names = approximate_top_n_names(country_sketches, 'USA', n)
+        exact = scores.reindex(top_names.index, fill_value=0).to_numpy()
+        estimate = top_names[['frequency_male', 'frequency_female']].sum(axis=1).to_numpy()
+        assert np.all(estimate - top_names['error'].to_numpy() <= exact + 1e-12)
+        assert np.all(exact <= estimate + 1e-12)
+
+
+def split_row_groups(cache_path, split_path, rows):
+    # Copy of the Parquet cache with every year split into row groups of at most the given number of rows
+    # (like pyarrow does with the years above ~1M rows when the size of the row groups isn't given)
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(cache_path)
+    years = table['year'].to_numpy()
+    boundaries = np.flatnonzero(np.diff(years)) + 1
+    with pq.ParquetWriter(split_path, table.schema) as writer:
+        for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(table)]):
+            writer.write_table(table.slice(start, end - start), row_group_size=rows)
+
+
+def run_checks(data_dir, db_path, n=1000, pl_n=200):
+    # Run every check on the dataset - returns the names of the failed checks
+    df, names = encode_names(load_usa_names(data_dir))
+    df = calculate_frequency(df)
+    top_names = calculate_top_n_names(df, n)
+    top_df, _ = calculate_name_diversity(df.copy(deep=False), top_names)
+    years = sorted(int(year) for year in df['year'].unique())
+    windows = [(years[0], years[0] + 19), (years[0] + 20, years[0] + 39), (years[-1] - 19, years[-1])]
+    sources = [USA_SOURCE.with_options(path=data_dir, cache_path=None), PL_SOURCE.with_options(path=db_path)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_path = os.path.join(tmp_dir, 'usa_names.parquet')
+        load_usa_names(data_dir, cache_path=cache_path)
+        split_path = os.path.join(tmp_dir, 'usa_names_split.parquet')
+        split_row_groups(cache_path, split_path, len(df) // len(years) // 3)
+        checks = [
+            ('tensor', lambda: check_tensor_parity(df, n)),
+            ('streaming (files)', lambda: check_streaming_parity(data_dir, None, n, *windows[0])),
+            ('streaming (Parquet cache)', lambda: check_streaming_parity(data_dir, cache_path, n, *windows[-1])),
+            ('streaming (split years)', lambda: check_streaming_parity(data_dir, split_path, n, *windows[-1])),
+            ('incremental', lambda: check_incremental_parity(data_dir, n, windows[::2])),
+            ('sqlite', lambda: check_sqlite_parity(db_path, pl_n, years[-1] - 23, years[-1])),
+            ('countries', lambda: check_country_parity(sources, pl_n, years[-1] - 23, years[-1])),
+            ('features', lambda: check_feature_parity(df, names)),
+            ('ranking', lambda: check_ranking_parity(df, [10, n], [(years[0], years[-1])] + windows)),
+            ('connotation', lambda: check_connotation_parity(top_df, top_names, windows)),
+            ('shared data', lambda: check_shared_parity(data_dir, n)),
+            ('approximate', lambda: check_approximate_bounds(df, n)),
+        ]
+        failed = []
+        for name, check in checks:
+            start_time = time.perf_counter()
+            try:
+                check()
+            except Exception:
+                failed.append(name)
+                print(f'{name:<28}FAILED')
+                traceback.print_exc()
+            else:
+                print(f'{name:<28}ok{time.perf_counter() - start_time:>10.2f} s')
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the results of the optimized engines with the pandas '
+                                                 'functions on synthetic data')
+    parser.add_argument('--scale', type=int, default=1, help='names scale of the synthetic data (see benchmark.py)')
+    parser.add_argument('--years-scale', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=os.path.join('data', 'benchmark'))
+    args = parser.parse_args()
+
+    failed = run_checks(*ensure_dataset(args.data_dir, args.scale, args.years_scale, args.seed))
+    if failed:
+        parser.exit(1, f'{len(failed)} checks failed: {", ".join(failed)}\n')
@@ -0,0 +1,149 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from profiling import count_rows
+
+
+class Stage:
+    # A single step of the analysis - func is called with the values of the inputs (as keyword arguments)
+    # and returns a dict with the values of the outputs. Stages with main_thread=True (e.g. the ones using
+    # the stateful matplotlib API) are run in the main thread instead of the pool
+
+    def __init__(self, name, func, inputs=(), outputs=(), main_thread=False):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.main_thread = main_thread
+
+    def __repr__(self):
+        return f'Stage({self.name!r}, inputs={self.inputs}, outputs={self.outputs})'
+
+
+def run_stage(stage, values, profiler=None):
+    # Returns the outputs, the start and end time and the profiling record (None without a profiler)
+    start = time.perf_counter()
+    record = None
+    if profiler is None:
+        result = stage.func(**{name: values[name] for name in stage.inputs}) or {}
+    else:
+        with profiler.stage(stage.name) as record:
+            result = stage.func(**{name: values[name] for name in stage.inputs}) or {}
+    missing = set(stage.outputs) - set(result)
+    if missing:
+        raise ValueError(f'Stage {stage.name} did not return {sorted(missing)}')
+    return result, start, time.perf_counter(), record
+
+
+def check_stages(stages, initial=()):
+    # Every output has to be produced by exactly one stage and every input has to be produced by some stage
+    # (or be one of the initial values)
+    producers = {name: '<initial>' for name in initial}
+    for stage in stages:
+        for output in stage.outputs:
+            if output in producers:
+                raise ValueError(f'{output} is produced by both {producers[output]} and {stage.name}')
+            producers[output] = stage.name
+    for stage in stages:
+        for name in stage.inputs:
+            if name not in producers:
+                raise ValueError(f'Input {name} of stage {stage.name} is not produced by any stage')
+    return producers
+
+
+def run_stages(stages, initial=None, executor='thread', max_workers=None, on_complete=None, profiler=None):
+    # Run the stages as soon as all of their inputs are available - independent stages run concurrently
+    # in a thread (executor='thread') or process (executor='process') pool, or one after another (executor=None).
+    # on_complete(stage, result) is called in the main thread after each stage. initial - values available from the start.
+    # profiler - profiling.Profiler recording the time, memory and rows of every stage (None - no profiling).
+    # Returns the values of all outputs and the timings of the stages: {name: (start, end)} relative to the start
+    values = dict(initial or {})
+    check_stages(stages, values)
+    timings = {}
+    pending = list(stages)
+    running = {}
+    t0 = time.perf_counter()
+
+    pool = None
+    if executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+    elif executor == 'process':
+        pool = ProcessPoolExecutor(max_workers=max_workers)
+
+    def finish(stage, result, start, end, record):
+        values.update(result)
+        timings[stage.name] = (start - t0, end - t0)
+        if record is not None:
+            profiler.add(record, {name: count_rows(value) for name, value in result.items()
+                                  if count_rows(value) is not None})
+        if on_complete is not None:
+            on_complete(stage, result)
+
+    try:
+        while pending or running:
+            ready = [stage for stage in pending if all(name in values for name in stage.inputs)]
+            for stage in ready:
+                pending.remove(stage)
+                if pool is None or stage.main_thread:
+                    continue
+                running[pool.submit(run_stage, stage, {name: values[name] for name in stage.inputs}, profiler)] = stage
+
+            # Stages that have to run in the main thread are run while the pool works on the others
+            main_thread_stages = [stage for stage in ready if pool is None or stage.main_thread]
+            for stage in main_thread_stages:
+                finish(stage, *run_stage(stage, values, profiler))
+            if main_thread_stages:
+                continue
+
+            if not running:
+                if pending:
+                    raise ValueError(f'Stages {[stage.name for stage in pending]} can never run (dependency cycle)')
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                finish(running.pop(future), *future.result())
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    return values, timings
+
+
+def required_stages(stages, selected):
+    # The selected stages with all the stages producing their inputs (recursively), in the original order
+    producers = {output: stage for stage in stages for output in stage.outputs}
+    needed = set()
+    pending = list(selected)
+    while pending:
+        stage = pending.pop()
+        if stage.name not in needed:
+            needed.add(stage.name)
+            pending.extend(producers[name] for name in stage.inputs if name in producers)
+    return [stage for stage in stages if stage.name in needed]
+
+
+def critical_path(stages, timings):
+    # Longest chain of dependent stages (by their duration) - the lower bound of the wall time
+    producers = {output: stage for stage in stages for output in stage.outputs}
+    longest = {}
+
+    def path_length(stage):
+        if stage.name not in longest:
+            start, end = timings[stage.name]
+            parents = {producers[name].name: producers[name] for name in stage.inputs if name in producers}
+            longest[stage.name] = (end - start) + max((path_length(parent) for parent in parents.values()), default=0)
+        return longest[stage.name]
+
+    return max((path_length(stage) for stage in stages), default=0)
+
+
+def format_timings(stages, timings):
+    # Table with the start, end and duration of every stage (in the order of the start)
+    lines = [f"{'Stage':<28}{'Start [s]':>12}{'End [s]':>12}{'Time [s]':>12}"]
+    for name, (start, end) in sorted(timings.items(), key=lambda item: item[1][0]):
+        lines.append(f'{name:<28}{start:>12.3f}{end:>12.3f}{end - start:>12.3f}')
+    total = max((end for _, end in timings.values()), default=0)
+    lines.append(f"{'Wall time':<28}{total:>36.3f}")
+    lines.append(f"{'Sum of the stages':<28}{sum(end - start for start, end in timings.values()):>36.3f}")
+    lines.append(f"{'Critical path':<28}{critical_path(stages, timings):>36.3f}")
+    return '\n'.join(lines)
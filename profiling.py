@@ -0,0 +1,190 @@
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows - the peak RSS isn't recorded there
+    resource = None
+
+class StageContext(threading.local):
+    # Record of the stage that is running in the current thread (None when the profiling is disabled),
+    # the instrumented functions add their measurements to it. The defaults are class attributes, so reading them
+    # in a thread that never profiled anything doesn't raise (and catch) an AttributeError
+    record = None
+    depth = 0
+
+
+_local = StageContext()
+
+
+def current_rss():
+    # Resident set size of the process in bytes (None if it can't be read on this platform)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss():
+    # Peak resident set size of the process in bytes (ru_maxrss is in kilobytes on Linux and in bytes on macOS)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def count_rows(value):
+    # Number of rows of a DataFrame or a Series (None for other values)
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    if isinstance(value, tuple):
+        rows = [count_rows(item) for item in value]
+        return next((row for row in rows if row is not None), None)
+    return None
+
+
+def profiled(func):
+    # Decorator of the analysis functions - when a stage is profiled, the wall time, CPU time and the number of rows
+    # of the input and the output are recorded. Otherwise it only costs a single attribute lookup
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        record = _local.record
+        if record is None:
+            return func(*args, **kwargs)
+        # The entry is added before the call, so the functions called inside follow it (with a greater depth)
+        entry = {'name': func.__name__, 'depth': _local.depth,
+                 'rows_in': count_rows(args[0]) if args else None}
+        record['functions'].append(entry)
+        _local.depth = entry['depth'] + 1
+        start, start_cpu = time.perf_counter(), time.thread_time()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            entry['wall'] = time.perf_counter() - start
+            entry['cpu'] = time.thread_time() - start_cpu
+            _local.depth = entry['depth']
+        entry['rows_out'] = count_rows(result)
+        return result
+    return wrapper
+
+
+class Profiler:
+    # Records the wall time, CPU time (of the thread running the stage), memory and row counts of every stage
+    # and of the instrumented functions called inside it.
+    #  - memory='rss' - RSS at the start and the end of the stage and the peak RSS of the process (cheap)
+    #  - memory='tracemalloc' - peak of the memory allocated by Python during the stage; it slows down the
+    #    allocations and the peak is shared by the stages running at the same time, so use it with executor=None
+    #  - profile_stages - names of the stages run under cProfile, the statistics are saved to profile_dir
+    # Only the settings are sent to worker processes - the records are returned together with the results
+
+    def __init__(self, memory='rss', profile_stages=(), profile_dir=None, top_functions=15):
+        self.memory = memory
+        self.profile_stages = set(profile_stages)
+        self.profile_dir = profile_dir
+        self.top_functions = top_functions
+        self.records = []
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'memory': self.memory, 'profile_stages': self.profile_stages, 'profile_dir': self.profile_dir,
+                'top_functions': self.top_functions}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @contextmanager
+    def stage(self, name):
+        record = {'stage': name, 'pid': os.getpid(), 'functions': []}
+        previous = _local.record
+        _local.record = record
+
+        if self.memory == 'tracemalloc':
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            start_traced = tracemalloc.get_traced_memory()[0]
+        elif self.memory == 'rss':
+            record['rss_start'] = current_rss()
+        profile = cProfile.Profile() if name in self.profile_stages else None
+        start, start_cpu = time.perf_counter(), time.thread_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile is not None:
+                profile.disable()
+            record['wall'] = time.perf_counter() - start
+            record['cpu'] = time.thread_time() - start_cpu
+            if self.memory == 'tracemalloc':
+                record['traced_peak'] = tracemalloc.get_traced_memory()[1] - start_traced
+            elif self.memory == 'rss':
+                record['rss_end'] = current_rss()
+                record['peak_rss'] = peak_rss()
+            if profile is not None:
+                record['profile'] = self.save_profile(name, profile)
+            _local.record = previous
+
+    def save_profile(self, name, profile):
+        # Save the statistics (for snakeviz, pstats etc.) and keep the most expensive functions in the record
+        path = None
+        if self.profile_dir is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, ''.join(c if c.isalnum() else '_' for c in name) + '.prof')
+            profile.dump_stats(path)
+        text = io.StringIO()
+        pstats.Stats(profile, stream=text).sort_stats('cumulative').print_stats(self.top_functions)
+        return {'path': path, 'top': text.getvalue()}
+
+    def add(self, record, rows=None):
+        if rows:
+            record['rows'] = rows
+        with self.lock:
+            self.records.append(record)
+
+    def report(self):
+        return {'memory': self.memory, 'peak_rss': peak_rss(), 'stages': list(self.records)}
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def format_report(self):
+        # Console table with the stages (and the instrumented functions called inside them)
+        memory_column = 'Peak [MB]' if self.memory == 'tracemalloc' else 'RSS [MB]'
+        lines = [f"{'Stage / function':<34}{'Wall [s]':>10}{'CPU [s]':>10}{memory_column:>11}{'Rows':>11}"]
+        for record in sorted(self.records, key=lambda r: -r['wall']):
+            if self.memory == 'tracemalloc':
+                memory = record.get('traced_peak')
+            else:
+                memory = record.get('rss_end')
+            memory = f'{memory / 2 ** 20:>11.1f}' if memory is not None else f"{'-':>11}"
+            rows = sum(record.get('rows', {}).values()) or '-'
+            lines.append(f"{record['stage']:<34}{record['wall']:>10.3f}{record['cpu']:>10.3f}{memory}{rows:>11}")
+            for function in record['functions']:
+                rows = function.get('rows_out') if function.get('rows_out') is not None else '-'
+                name = '  ' * (function['depth'] + 1) + function['name']
+                lines.append(f"{name:<34}{function['wall']:>10.3f}{function['cpu']:>10.3f}{'':>11}{rows:>11}")
+        peak = peak_rss()
+        if peak is not None:
+            lines.append(f'Peak RSS of the process: {peak / 2 ** 20:.1f} MB')
+        for record in self.records:
+            if 'profile' in record:
+                lines.append(f"cProfile of {record['stage']}" +
+                             (f" (saved to {record['profile']['path']})" if record['profile']['path'] else ''))
+                lines.append(record['profile']['top'].strip('\n'))
+        return '\n'.join(lines)
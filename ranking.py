@@ -0,0 +1,172 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from analysis import FREQUENCY_COLUMNS
+
+
+def sort_order(columns, sizes):
+    # Order of the rows sorted by several non-negative integer columns (the first one is the most significant).
+    # The columns are combined into a single int64 key when it fits - sorting it is much faster than np.lexsort
+    if np.prod([float(size) for size in sizes]) < 2 ** 63:
+        key = np.zeros(len(columns[0]), dtype=np.int64)
+        for column, size in zip(columns, sizes):
+            key = key * size + column
+        return np.argsort(key)
+    return np.lexsort(columns[::-1])
+
+
+class RankingEngine:
+    # Rankings of the names built once from the DataFrame (with the encoded names and the 'frequency' column):
+    #  - the rank of every row within its (year, sex) - the position of the name in the ranking of that year
+    #    (ties resolved in favour of the lower name id, the same way as nlargest does it)
+    #  - prefix sums of the frequency of every (name, sex) pair over the years, so the score of calculate_top_n_names
+    #    for any window of years is a difference of two prefix sums instead of a groupby over the rows.
+    # The rows are stored sorted by (name, sex, year), so the rows of every pair are a contiguous slice (like
+    # in NameIndex). The sorted ranking of a window is kept, so the top n for any other n is only a slice of it
+
+    def __init__(self, df):
+        self.names = df['name'].cat.categories
+        self.sexes = df['sex'].cat.categories
+        self.name_dtype = df['name'].dtype
+        self.sex_dtype = df['sex'].dtype
+        self.years = np.sort(df['year'].unique())
+
+        name_ids = df['name'].cat.codes.to_numpy().astype(np.int64)
+        sex_ids = df['sex'].cat.codes.to_numpy().astype(np.int64)
+        year_ids = np.searchsorted(self.years, df['year'].to_numpy())
+        frequency = df['frequency'].to_numpy(dtype='float64')
+        counts = df['count'].to_numpy().astype(np.int64)
+        sexes, years = len(self.sexes), len(self.years)
+
+        # Ranks within every (year, sex) group - a single sort of all the rows by (group, -frequency, name id).
+        # The frequency is the count divided by the total of the group, so the count gives the same order
+        groups = year_ids * sexes + sex_ids
+        max_count = int(counts.max(initial=0))
+        by_rank = sort_order([groups, max_count - counts, name_ids], [years * sexes, max_count + 1, len(self.names)])
+        self.group_offsets = np.searchsorted(groups[by_rank], np.arange(years * sexes + 1))
+        ranks = np.empty(len(df), dtype=np.uint32)
+        ranks[by_rank] = np.arange(len(df)) - self.group_offsets[groups[by_rank]] + 1
+        # Name ids of every (year, sex) group in the order of the ranking
+        self.ranked_names = name_ids[by_rank].astype(np.int32)
+
+        # Rows sorted by (name, sex, year) - the key of a row is (slot, year id) as a single integer
+        slots = name_ids * sexes + sex_ids
+        order = sort_order([slots, year_ids], [len(self.names) * sexes, years])
+        self.keys = slots[order] * years + year_ids[order]
+        self.ranks = ranks[order]
+
+        # Prefix sums of the frequency within every pair - the sum of the rows of the pair before the row (before)
+        # and including the row (through). They are accumulated in extended precision and the sum of the previous
+        # pairs is subtracted, so their rounding error is relative to the sum of the pair, not of the whole dataset
+        frequency = frequency[order]
+        cumulative = np.cumsum(frequency, dtype=np.longdouble)
+        new_pair = np.diff(self.keys // years, prepend=-1) != 0
+        first_rows = np.flatnonzero(new_pair)
+        baseline = (cumulative[first_rows] - frequency[first_rows])[np.cumsum(new_pair) - 1]
+        self.through = (cumulative - baseline).astype(np.float64)
+        self.before = self.through - frequency
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # The sorted rankings of the windows are only a cache
+        state = self.__dict__.copy()
+        state['windows'] = {}
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def year_window(self, start_year=None, end_year=None):
+        # Range of the year ids of the window (the whole dataset by default)
+        low = 0 if start_year is None else np.searchsorted(self.years, start_year, 'left')
+        high = len(self.years) if end_year is None else np.searchsorted(self.years, end_year, 'right')
+        return int(low), int(high)
+
+    def window_scores(self, low, high):
+        # Sum of the frequency of every (name, sex) pair in the years low:high divided by the number of years
+        # (the same as calculate_top_n_names on the rows of the window) - two binary searches per pair
+        first_keys = np.arange(len(self.names) * len(self.sexes)) * len(self.years)
+        starts = np.searchsorted(self.keys, first_keys + low)
+        ends = np.searchsorted(self.keys, first_keys + high)
+        observed = ends > starts
+        scores = np.zeros(len(first_keys))
+        scores[observed] = (self.through[ends[observed] - 1] - self.before[starts[observed]]) / max(high - low, 1)
+        return scores.reshape(-1, len(self.sexes)), observed.reshape(-1, len(self.sexes))
+
+    def window_ranking(self, start_year=None, end_year=None):
+        # Scores of the (name, sex) pairs given in the window and the pairs sorted by the score of every sex
+        # (computed once for every window). Like in top_n_from_frequency, the pairs of the other sex are ranked
+        # too (with the score 0), after all the pairs of the sex
+        window = self.year_window(start_year, end_year)
+        with self.lock:
+            if window not in self.windows:
+                scores, observed = self.window_scores(*window)
+                slots = np.flatnonzero(observed.ravel())
+                # The differences of the prefix sums differ from the sums of the rows in the last bits, so scores
+                # closer than their rounding error are treated as a tie (resolved by the position, like nlargest)
+                tolerance = 8 * np.finfo(np.float64).eps * self.through.max(initial=0) / max(window[1] - window[0], 1)
+                ranked = {}
+                for s, sex in enumerate(self.sexes):
+                    values = np.where(slots % len(self.sexes) == s, scores.ravel()[slots], 0.0)
+                    order = np.argsort(-values, kind='stable')
+                    ties = np.r_[0, np.cumsum(-np.diff(values[order]) > tolerance)]
+                    ranked[sex] = slots[order[np.lexsort((order, ties))]]
+                self.windows[window] = scores, ranked
+            return self.windows[window]
+
+    def top_n_names(self, n, start_year=None, end_year=None):
+        # The same ranking as calculate_top_n_names (on the rows of the window) - n is only a slice of the sorted pairs
+        scores, ranked = self.window_ranking(start_year, end_year)
+        parts = []
+        for sex in ['M', 'F']:
+            slots = ranked[sex][:n]
+            names, sexes = slots // len(self.sexes), slots % len(self.sexes)
+            index = pd.MultiIndex.from_arrays([pd.Categorical.from_codes(names, dtype=self.name_dtype),
+                                               pd.Categorical.from_codes(sexes, dtype=self.sex_dtype)],
+                                              names=['name', 'sex'])
+            parts.append(pd.DataFrame({name: np.where(sexes == self.sexes.get_loc(column_sex), scores[names, sexes], 0.0)
+                                       for name, column_sex in FREQUENCY_COLUMNS.items()}, index=index))
+        return pd.concat(parts)
+
+    def year_top(self, year, sex, n):
+        # Names with the n highest ranks in a single year, in the order of the ranking
+        group = np.searchsorted(self.years, year) * len(self.sexes) + self.sexes.get_loc(sex)
+        start, end = self.group_offsets[group], self.group_offsets[group + 1]
+        ids = self.ranked_names[start:min(start + n, end)]
+        return pd.CategoricalIndex(pd.Categorical.from_codes(ids, dtype=self.name_dtype), name='name')
+
+    def rank_trajectory(self, name, sex):
+        # Rank of the name in every year (NaN in the years in which the name wasn't given)
+        slot = self.names.get_loc(name) * len(self.sexes) + self.sexes.get_loc(sex)
+        start, end = np.searchsorted(self.keys, [slot * len(self.years), (slot + 1) * len(self.years)])
+        ranks = np.full(len(self.years), np.nan)
+        ranks[self.keys[start:end] - slot * len(self.years)] = self.ranks[start:end]
+        return pd.Series(ranks, index=pd.Index(self.years, name='year'), name='rank')
+
+    def rank_trajectories(self, pairs):
+        # Ranks of several (name, sex) pairs - one column for every pair
+        return pd.DataFrame({pair: self.rank_trajectory(*pair) for pair in pairs})
+
+    def years_in_top(self, n, start_year=None, end_year=None):
+        # Number of years (in the window) in which every (name, sex) pair was in the top n of its year,
+        # with its best rank - only the pairs that were in the top n at least once
+        low, high = self.year_window(start_year, end_year)
+        year_ids = self.keys % len(self.years)
+        selected = (self.ranks <= n) & (year_ids >= low) & (year_ids < high)
+        slots = self.keys[selected] // len(self.years)
+        ranks = self.ranks[selected]
+
+        # The selected rows are still sorted by the pair, so every pair is a contiguous run
+        starts = np.flatnonzero(np.r_[True, slots[1:] != slots[:-1]]) if len(slots) else np.array([], np.intp)
+        pairs = slots[starts]
+        index = pd.MultiIndex.from_arrays(
+            [pd.Categorical.from_codes(pairs // len(self.sexes), dtype=self.name_dtype),
+             pd.Categorical.from_codes(pairs % len(self.sexes), dtype=self.sex_dtype)], names=['name', 'sex'])
+        return pd.DataFrame({'years_in_top': np.diff(np.r_[starts, len(slots)]),
+                             'best_rank': np.minimum.reduceat(ranks, starts) if len(starts) else ranks[:0]},
+                            index=index)
@@ -0,0 +1,205 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+# matplotlib is imported only when a figure is drawn, so the analyses can run without it (--no-plots)
+
+# Every figure is drawn on a given matplotlib Figure with the object-oriented API (no global pyplot state),
+# so the figures can be rendered in parallel - in worker processes or threads
+
+
+def draw_births(fig, births_per_year, birth_ratio_df):
+    axs = fig.subplots(2, 1)
+    axs[0].plot(births_per_year)
+    axs[0].set_title('Number of births per year')
+    axs[0].set_xlabel('Year')
+    axs[0].set_ylabel('Number of births')
+
+    # Adjust the space between the subplots so they don't overlap each other
+    fig.subplots_adjust(hspace=0.5)
+
+    # Find the year with the smallest and largest difference in the ratio of births
+    min_diff_year = birth_ratio_df.loc[birth_ratio_df['ratio'].idxmin()]['year'].values[0]
+    max_diff_year = birth_ratio_df.loc[birth_ratio_df['ratio'].idxmax()]['year'].values[0]
+
+    # Plot the ratio of the number of births
+    axs[1].plot(birth_ratio_df['year'], birth_ratio_df['ratio'])
+    axs[1].plot(min_diff_year, birth_ratio_df.loc[birth_ratio_df['ratio'].idxmin()]['ratio'],
+                'go', markerfacecolor='none',  label='Min ratio')
+    axs[1].plot(max_diff_year, birth_ratio_df.loc[birth_ratio_df['ratio'].idxmax()]['ratio'],
+                'ro', markerfacecolor='none', label='Max ratio')
+    axs[1].legend()
+    axs[1].set_title('Ratio of the number of female to male births per year')
+    axs[1].set_xlabel('Year')
+    axs[1].set_ylabel('Ratio')
+
+
+def draw_name_trend(fig, top_female_name_usa, john_series, top_female_series):
+    # Left y-axis
+    ax1 = fig.subplots()
+    ax1.set_title("Count and popularity of the names John and " + top_female_name_usa)
+    ax1.set_xlabel('Year')
+    ax1.plot(john_series.index, john_series['count'], 'b', label='John count')
+    ax1.plot(top_female_series.index, top_female_series['count'], 'r', label=f'{top_female_name_usa} count')
+    ax1.set_ylabel('Number of times the name was given in each year')
+    ax1.legend(loc='center left')
+
+    # Right y-axis
+    ax2 = ax1.twinx()
+    ax2.plot(john_series.index, john_series['frequency'], 'b--', label='John popularity')
+    ax2.plot(top_female_series.index, top_female_series['frequency'], 'r--', label=f'{top_female_name_usa} popularity')
+    ax2.set_ylabel('Popularity of the name in each year')
+    ax2.legend(loc='center right')
+
+
+def draw_name_diversity(fig, reshaped, n, country):
+    # Find the year with the greatest difference in diversity
+    max_diff_year = reshaped['difference'].idxmax()
+
+    # Plot the percentage of names in the top n ranking
+    ax = fig.subplots()
+    ax.plot(reshaped.index, reshaped['M'], 'b', label='Male names')
+    ax.plot(reshaped.index, reshaped['F'], 'r', label='Female names')
+    ax.axvline(max_diff_year, color='g', label='Year with the greatest difference in diversity')
+    ax.set_title(f'Percentage of names in the top{n} ranking in {country}')
+    ax.set_xlabel('Year')
+    ax.set_ylabel('Percentage')
+    ax.legend()
+
+
+def draw_last_letters(fig, last_letter_selected_years_male):
+    # Plot the popularity of the last letters in 1910, 1970, and 2023
+    ax = fig.subplots()
+    last_letter_selected_years_male.plot(kind='bar', width=0.8, ax=ax)
+    ax.set_title('Popularity of the last letters of male names in 1910, 1970 and 2023')
+    ax.set_xlabel('Last letter')
+    ax.set_ylabel('Popularity')
+
+
+def draw_last_letter_trend(fig, last_letter_selected_letters_df):
+    # Plot the popularity trend of the 3 names with the greatest change
+    ax = fig.subplots()
+    last_letter_selected_letters_df.xs(key='M', level='sex').plot(kind='line', ax=ax)
+    ax.set_title('Popularity trend of the 3 last letters of male names with the greatest change between 1910 and 2023')
+    ax.set_xlabel('Year')
+    ax.set_ylabel('Popularity')
+    ax.legend()
+
+
+def draw_connotation(fig, name_trend_usa_df):
+    ax = fig.subplots()
+    name_trend_usa_df['M'].plot(kind='line', ax=ax)
+    ax.set_ylabel('p_m')
+    ax.set_xlabel('Year')
+    ax.set_title('p_m trend for the names with the largest change in connotation')
+
+
+def draw_pl_histograms(fig, pl_df, value_range, years=(2000, 2013, 2023)):
+    # pl_df - year, sex, frequency and in_top of the Polish names (at least in the given years)
+    axs = fig.subplots(3, 2)
+    fig.subplots_adjust(hspace=0.5)
+    # Calculate the bins for the histograms - value_range is the range of the frequency of the female names
+    # in the whole dataset (0 for the male ones), so only the rows of the plotted years are needed
+    bins = np.histogram_bin_edges([], bins=20, range=value_range)
+
+    # Loop through the years given in the task
+    for i, year in enumerate(years):
+
+        # Filter the data for the given year
+        pl_df_year = pl_df[pl_df['year'] == year]
+
+        # Plot histograms for each gender separately
+        for j, gender in enumerate(['F', 'M']):
+            if gender == 'F':
+                gender_full = 'female'
+            else:
+                gender_full = 'male'
+
+            # Plot the histograms of the names in the top 200 and not in the top 200 on the same plot
+            axs[i, j].hist(pl_df_year[(pl_df_year['sex'] == gender) & (pl_df_year['in_top'] == False)]
+                           ['frequency'], bins=bins, color='b', alpha=0.5, label='Not in top')
+            axs[i, j].hist(
+                pl_df_year[(pl_df_year['sex'] == gender) & (pl_df_year['in_top'])]['frequency'],
+                bins=bins, color='r', alpha=0.5, label='In top')
+            axs[i, j].set_title(f'Frequency distribution of {gender_full} names in {year}')
+            axs[i, j].set_xlabel('Frequency')
+            axs[i, j].set_ylabel('Number of names')
+            axs[i, j].legend()
+
+
+# Name of the figure: (draw function, figure size, file name - the same as the files in figures/)
+FIGURES = {
+    'births': (draw_births, (10, 9), '1_Number_of_births_per_year'),
+    'name_trend': (draw_name_trend, (10, 4), '2_Count_and_popularity_John_Mary'),
+    'usa_diversity': (draw_name_diversity, (10, 4), '3_Diversity_USA'),
+    'last_letters': (draw_last_letters, (10, 4), '4_Last_letters_of_male_names'),
+    'last_letter_trend': (draw_last_letter_trend, (10, 4), '5_Popularity_trend_for_last_names'),
+    'connotation': (draw_connotation, (10, 4), '6_p_m_biggest_change'),
+    'pl_diversity': (draw_name_diversity, (10, 4), '7_Percentage_of_names_in_ranking_PL'),
+    'pl_histograms': (draw_pl_histograms, (13, 9), '8_Histograms_for_polish_names'),
+}
+
+
+def use_agg():
+    # Non-interactive backend - nothing is displayed, the figures are only written to files
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def render_figure(name, paths, data, dpi=100):
+    # Draw a single figure and save it to the given paths (the format is taken from the extension)
+    from matplotlib.figure import Figure
+
+    draw, figsize, _ = FIGURES[name]
+    fig = Figure(figsize=figsize)
+    draw(fig, **data)
+    for path in paths:
+        fig.savefig(path, dpi=dpi)
+    return paths
+
+
+class FigureRenderer:
+    # Renders the figures in the background and writes them to output_dir as soon as their data is ready.
+    # The figures are independent, so they are drawn in a pool of processes (executor='process', matplotlib
+    # holds the GIL while drawing) or threads (executor='thread')
+
+    def __init__(self, output_dir='figures', formats=('png',), executor='process', max_workers=None, dpi=100):
+        self.output_dir = output_dir
+        self.formats = tuple(formats)
+        self.dpi = dpi
+        self.futures = {}
+        os.makedirs(output_dir, exist_ok=True)
+        if executor == 'process':
+            self.pool = ProcessPoolExecutor(max_workers=max_workers, initializer=use_agg)
+        else:
+            use_agg()
+            self.pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def plot(self, name, **data):
+        file_name = FIGURES[name][2]
+        paths = [os.path.join(self.output_dir, f'{file_name}.{file_format}') for file_format in self.formats]
+        self.futures[name] = self.pool.submit(render_figure, name, paths, data, self.dpi)
+
+    def finish(self):
+        # Wait for all the figures - returns {name: list of the written files}
+        try:
+            return {name: future.result() for name, future in self.futures.items()}
+        finally:
+            self.pool.shutdown()
+
+
+class InteractiveFigures:
+    # Draws the figures with pyplot and displays all of them at the end (the original behaviour of the script)
+
+    def plot(self, name, **data):
+        import matplotlib.pyplot as plt
+
+        draw, figsize, _ = FIGURES[name]
+        draw(plt.figure(figsize=figsize), **data)
+
+    def finish(self):
+        import matplotlib.pyplot as plt
+
+        plt.show()
+        return {}
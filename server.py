@@ -0,0 +1,256 @@
+import argparse
+import asyncio
+import base64
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from analysis import calculate_frequency, calculate_name_diversity, calculate_name_gender_ratio
+from cache import ResultCache, result_key
+from features import NameFeatures
+from name_index import NameIndex
+from name_table import encode_names, in_ranking
+from ranking import RankingEngine
+from sources import DEFAULT_SOURCES, country_aliases, load_sources
+
+# Query server - the data is loaded and indexed once, then the analyses are answered over a TCP or a Unix socket.
+# The protocol is one JSON object per line, a request is either a single query or a batch:
+#   {"id": 1, "queries": [{"query": "top_n", "country": "USA", "n": 10}, ...], "format": "json"}
+# and the response (one line) has the results in the same order:
+#   {"id": 1, "results": [{"result": {...}, "ms": 0.4, "coalesced": false}, ...]}
+# With "format": "arrow" the tables are sent as base64-encoded Arrow IPC streams instead of JSON
+DEFAULT_PORT = 8765
+
+
+class CountryData:
+    # Data of a single country with the indexes used by the queries (built once when the server starts)
+
+    def __init__(self, df):
+        df, self.names = encode_names(df)
+        self.df = calculate_frequency(df)
+        self.index = NameIndex(self.df)
+        self.ranking = RankingEngine(self.df)
+        self.features = NameFeatures(self.names)
+
+    def with_ranking(self, n):
+        # Shallow copy with the in_top column of the top n ranking (for the diversity and the connotation)
+        return self.df.assign(in_top=in_ranking(self.df, self.ranking.top_n_names(n).index))
+
+
+# Queries: name -> function(data, **arguments) returning a DataFrame, a Series or a JSON value
+
+def query_top_n(data, n=1000, start_year=None, end_year=None):
+    return data.ranking.top_n_names(n, start_year, end_year)
+
+
+def query_diversity(data, n=1000):
+    _, reshaped = calculate_name_diversity(data.df.copy(deep=False), data.ranking.top_n_names(n))
+    return reshaped
+
+
+def query_gender_ratio(data, start_year, end_year, only_top=True, n=1000):
+    return calculate_name_gender_ratio(data.with_ranking(n), start_year, end_year, only_top)
+
+
+def query_name_trend(data, name, sex, years=None):
+    series = data.index.series(name, sex)
+    return series.loc[series.index.isin(years)] if years is not None else series
+
+
+def query_rank_trajectory(data, name, sex):
+    return data.ranking.rank_trajectory(name, sex)
+
+
+def query_features(data, feature='last_letter', years=None, sexes=None):
+    return data.features.distribution(data.df, feature, years=years, sexes=sexes)
+
+
+QUERIES = {
+    'top_n': query_top_n,
+    'diversity': query_diversity,
+    'gender_ratio': query_gender_ratio,
+    'name_trend': query_name_trend,
+    'rank_trajectory': query_rank_trajectory,
+    'last_letters': lambda data, years=None, sexes=None: query_features(data, 'last_letter', years, sexes),
+    'features': query_features,
+}
+
+
+def flat_frame(value):
+    # DataFrame with the index as columns and the multi-level column names joined with '_' (for JSON and Arrow)
+    df = value.to_frame() if isinstance(value, pd.Series) else value.copy(deep=False)
+    df.columns = ['_'.join(str(part) for part in column if str(part)) if isinstance(column, tuple) else str(column)
+                  for column in df.columns]
+    df = df.reset_index() if any(name is not None for name in df.index.names) else df.reset_index(drop=True)
+    # Categorical columns (names, sexes) are sent as their values
+    return df.astype({column: str for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)})
+
+
+def encode_result(value, result_format='json'):
+    # JSON-compatible form of a query result
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        df = flat_frame(value)
+        if result_format == 'arrow':
+            sink = pa.BufferOutputStream()
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            return {'arrow': base64.b64encode(sink.getvalue().to_pybytes()).decode('ascii')}
+        # Python values (the floats are sent with all their digits) and null instead of NaN
+        data = df.to_numpy(dtype=object)
+        data[pd.isna(data)] = None
+        return {'columns': list(df.columns), 'data': data.tolist()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class QueryServer:
+    # Answers the queries in a pool of threads (NumPy and pandas release the GIL in the heavy parts, and the event
+    # loop stays responsive). Identical queries that arrive while the first one is still running wait for its result
+    # instead of running again (coalescing), and the encoded results are kept in an LRU cache
+
+    def __init__(self, countries, max_workers=None, cache_items=256):
+        self.countries = countries
+        self.aliases = {alias.lower(): country for alias, country in country_aliases(countries).items()}
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.cache = ResultCache(None, max_items=cache_items)
+        self.running = {}
+        self.stats = {'queries': 0, 'coalesced': 0, 'cached': 0}
+
+    @classmethod
+    def load(cls, sources=DEFAULT_SOURCES, max_workers=None):
+        # Load the sources concurrently and build the indexes of every country
+        frames = load_sources(sources, max_workers=max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            data = dict(zip(frames, pool.map(CountryData, frames.values())))
+        return cls(data, max_workers=max_workers)
+
+    def run_query(self, query, result_format):
+        arguments = dict(query)
+        name = arguments.pop('query')
+        if name not in QUERIES:
+            raise ValueError(f'Unknown query {name!r}, available: {sorted(QUERIES)}')
+        country = self.aliases.get(str(arguments.pop('country', next(iter(self.countries)))).lower())
+        if country is None:
+            raise ValueError(f'Unknown country, available: {list(self.countries)}')
+        return encode_result(QUERIES[name](self.countries[country], **arguments), result_format)
+
+    async def answer(self, query, result_format='json'):
+        start = time.perf_counter()
+        self.stats['queries'] += 1
+        key = result_key('query', json.dumps(query, sort_keys=True), result_format)
+        response = {'coalesced': False}
+        result = self.cache.get(key)
+        if result is not None:
+            self.stats['cached'] += 1
+        elif key in self.running:
+            # The same query is already running - wait for it (shield, so a client that disconnects
+            # doesn't cancel the query of the others)
+            self.stats['coalesced'] += 1
+            response['coalesced'] = True
+            result = await asyncio.shield(self.running[key])
+        else:
+            future = asyncio.get_running_loop().run_in_executor(self.pool, self.run_query, query, result_format)
+            self.running[key] = future
+            try:
+                result = self.cache.put(key, await future)
+            finally:
+                del self.running[key]
+        response['result'] = result
+        response['ms'] = (time.perf_counter() - start) * 1000
+        return response
+
+    async def answer_safely(self, query, result_format):
+        try:
+            return await self.answer(query, result_format)
+        except Exception as e:
+            # A wrong query (unknown name, missing argument) only fails its own result
+            return {'error': f'{type(e).__name__}: {e}'}
+
+    async def handle_request(self, request):
+        if request.get('query') == 'stats':
+            return {'id': request.get('id'), 'stats': dict(self.stats, countries=list(self.countries))}
+        queries = request.get('queries', [request])
+        result_format = request.get('format', 'json')
+        results = await asyncio.gather(*(self.answer_safely(query, result_format) for query in queries))
+        return {'id': request.get('id'), 'results': list(results)}
+
+    async def handle_client(self, reader, writer):
+        # Every line of the connection is a request, the requests of one connection are answered concurrently
+        tasks = set()
+        lock = asyncio.Lock()
+
+        async def respond(line):
+            try:
+                response = await self.handle_request(json.loads(line))
+            except (ValueError, AttributeError) as e:
+                response = {'error': f'Invalid request: {e}'}
+            async with lock:
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+
+        try:
+            while line := await reader.readline():
+                if line.strip():
+                    task = asyncio.create_task(respond(line))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=DEFAULT_PORT, unix_path=None, ready=None):
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self.handle_client, unix_path, limit=2 ** 24)
+        else:
+            server = await asyncio.start_server(self.handle_client, host, port, limit=2 ** 24)
+        if ready is not None:
+            ready(server)
+        async with server:
+            await server.serve_forever()
+
+
+async def request(queries, host='127.0.0.1', port=DEFAULT_PORT, unix_path=None, result_format='json'):
+    # Client - send a batch of queries and return the results (in the same order)
+    if unix_path is not None:
+        reader, writer = await asyncio.open_unix_connection(unix_path, limit=2 ** 24)
+    else:
+        reader, writer = await asyncio.open_connection(host, port, limit=2 ** 24)
+    try:
+        writer.write(json.dumps({'queries': list(queries), 'format': result_format}).encode() + b'\n')
+        await writer.drain()
+        return json.loads(await reader.readline())['results']
+    finally:
+        writer.close()
+
+
+def decode_table(result):
+    # DataFrame from the result of a query (JSON or Arrow)
+    if 'arrow' in result:
+        return pa.ipc.open_stream(base64.b64decode(result['arrow'])).read_all().to_pandas()
+    return pd.DataFrame(result['data'], columns=result['columns'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query server over the loaded names datasets')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix', metavar='PATH', help='listen on a Unix socket instead of TCP')
+    parser.add_argument('--workers', type=int, help='number of the threads answering the queries')
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    query_server = QueryServer.load(max_workers=args.workers)
+    print(f'Loaded {", ".join(query_server.countries)} in {time.perf_counter() - start_time:.2f} s, listening on',
+          args.unix or f'{args.host}:{args.port}', flush=True)
+    try:
+        asyncio.run(query_server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,166 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from analysis import births_by_sex, calculate_frequency
+from name_table import build_name_table, encode_names
+from sources import load_source
+
+# Dataset exported to a directory of .npy files (one for every column, the names as their ids), which any number
+# of processes map read-only - the pages are shared by all of them through the OS page cache, so opening the dataset
+# is almost instant and the memory doesn't grow with the number of the processes:
+#   name.npy      - name id of every row (the codes of the categorical 'name' column)
+#   year.npy, count.npy, frequency.npy
+#   sex.npy       - codes of the categorical 'sex' column
+#   names.npy     - the name of every id (fixed-width unicode, so it can be mapped too)
+#   totals.npy    - births for every (year, sex) - years x sexes
+#   meta.json     - the categories of the sexes, the years and the fingerprint of the source
+COLUMNS = ['year', 'name', 'sex', 'count', 'frequency']
+META_FILE = 'meta.json'
+FORMAT_VERSION = 1
+
+# Datasets already opened in this process (by the path), so every stage of a worker process maps the files only once
+OPENED = {}
+
+
+def export_dataset(df, path, fingerprint=None):
+    # Write the DataFrame (year, name, sex, count) with the frequency and the totals of every (year, sex)
+    # The names are (re-)encoded, so their ids are the positions in the sorted name table built when it's opened
+    df, _ = encode_names(df.copy(deep=False))
+    if 'frequency' not in df.columns:
+        df = calculate_frequency(df.copy(deep=False))
+    totals = births_by_sex(df).unstack(fill_value=0)
+
+    # Written to a temporary directory first, so a crash never leaves a half-written dataset behind
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    arrays = {
+        'year': df['year'].to_numpy(),
+        'name': df['name'].cat.codes.to_numpy(),
+        'sex': df['sex'].cat.codes.to_numpy(),
+        'count': df['count'].to_numpy(),
+        'frequency': df['frequency'].to_numpy(),
+        'names': np.asarray(df['name'].cat.categories, dtype=str),
+        'totals': totals.to_numpy(dtype='int64'),
+    }
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_path, f'{name}.npy'), np.ascontiguousarray(values))
+    meta = {'version': FORMAT_VERSION, 'rows': len(df), 'sexes': list(df['sex'].cat.categories),
+            'years': [int(year) for year in totals.index], 'total_sexes': list(totals.columns),
+            'fingerprint': fingerprint}
+    with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def read_meta(path):
+    # None if there's no (complete) dataset in the directory
+    try:
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('version') == FORMAT_VERSION else None
+
+
+class MappedFrame(pd.DataFrame):
+    # DataFrame whose columns are the mapped files - pickling it (e.g. to a process pool) only sends the path,
+    # and the other process maps the same files. The frames derived from it (copies, filters) are plain DataFrames
+
+    _metadata = ['shared_path']
+
+    def __reduce_ex__(self, protocol):
+        if self.is_mapped():
+            return open_frame, (self.shared_path,)
+        # A column was added, removed or replaced in place - the path would lose the change, so the data is pickled
+        # as a plain DataFrame (rebuilt by the constructor without a copy)
+        return pd.DataFrame, (pd.DataFrame(self),)
+
+    def is_mapped(self):
+        # True if the columns are still exactly the exported ones, with their types, backed by the mapped files
+        path = getattr(self, 'shared_path', None)
+        if path is None or list(self.columns) != COLUMNS:
+            return False
+        dataset = open_dataset(path)
+        dtypes = {'name': dataset.name_dtype, 'sex': dataset.sex_dtype}
+        for column in COLUMNS:
+            values = self[column].array
+            if isinstance(values, pd.Categorical):
+                if values.dtype != dtypes[column]:
+                    return False
+                values = values.codes
+            values = np.asarray(values)
+            mapped = dataset.arrays[column]
+            if values.dtype != mapped.dtype or values.shape != mapped.shape or not np.may_share_memory(values, mapped):
+                return False
+        return True
+
+
+class SharedDataset:
+    # The exported dataset mapped read-only - frame() is the same DataFrame as the exported one (with the frequency)
+    # without copying the columns, names is the name table (small, built in every process)
+
+    def __init__(self, path):
+        meta = read_meta(path)
+        if meta is None:
+            raise FileNotFoundError(f'No exported dataset in {path}')
+        self.path = path
+        self.meta = meta
+        # Plain (read-only) ndarray views of the mapped files, so pandas treats them like any other array
+        self.arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r').view(np.ndarray)
+                       for name in COLUMNS + ['names', 'totals']}
+        self.names = build_name_table(self.arrays['names'])
+        self.name_dtype = pd.CategoricalDtype(self.names['name'])
+        self.sex_dtype = pd.CategoricalDtype(meta['sexes'])
+        self.df = None
+
+    def __reduce__(self):
+        return open_dataset, (self.path,)
+
+    def frame(self):
+        if self.df is None:
+            columns = {
+                'year': self.arrays['year'],
+                'name': pd.Categorical.from_codes(self.arrays['name'], dtype=self.name_dtype),
+                'sex': pd.Categorical.from_codes(self.arrays['sex'], dtype=self.sex_dtype),
+                'count': self.arrays['count'],
+                'frequency': self.arrays['frequency'],
+            }
+            self.df = MappedFrame(columns, copy=False)
+            self.df.shared_path = self.path
+        return self.df
+
+    def births_by_sex(self):
+        # Totals of every (year, sex) - the same Series as analysis.births_by_sex
+        index = pd.MultiIndex.from_product([pd.Index(self.meta['years'], dtype=self.arrays['year'].dtype, name='year'),
+                                            pd.CategoricalIndex(self.meta['total_sexes'], dtype=self.sex_dtype,
+                                                                name='sex')])
+        totals = pd.Series(self.arrays['totals'].ravel(), index=index, name='count')
+        return totals[totals > 0]
+
+
+def open_dataset(path):
+    path = os.path.abspath(path)
+    if path not in OPENED:
+        OPENED[path] = SharedDataset(path)
+    return OPENED[path]
+
+
+def open_frame(path):
+    return open_dataset(path).frame()
+
+
+def load_shared(source, path):
+    # Open the exported dataset of the source, (re-)exporting it first if it's missing or the source has changed
+    fingerprint = source.fingerprint()
+    meta = read_meta(path)
+    if meta is None or meta['fingerprint'] != fingerprint:
+        OPENED.pop(os.path.abspath(path), None)
+        export_dataset(load_source(source), path, fingerprint)
+    return open_dataset(path)
@@ -0,0 +1,142 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+from loader import SSA_DTYPES, YEAR_DTYPE, list_year_files, load_usa_names, source_fingerprint
+from name_table import build_name_table, encode_names
+
+# sqlite3 and pyarrow.parquet are imported by the adapters using them (the import of every module costs startup time)
+
+# Every source is normalized to the schema of the SSA files: year, name, sex ('F' / 'M') and count
+SCHEMA = ['year', 'name', 'sex', 'count']
+
+# Loaders of the supported formats: kind -> function(**options) returning a DataFrame with the SCHEMA columns
+ADAPTERS = {}
+
+
+def register_adapter(kind):
+    # Decorator adding the loader of a new format to the registry
+    def register(func):
+        ADAPTERS[kind] = func
+        return func
+    return register
+
+
+def normalize(df, columns=None, sex_map=None):
+    # Rename the columns of a source to the shared schema, map its sex codes to 'F' / 'M' and use the shared types
+    if columns:
+        df = df.rename(columns=columns)
+    df = df[SCHEMA]
+    sex = df['sex']
+    if sex_map:
+        sex = sex.astype(object).replace(sex_map)
+    sex = sex.astype(SSA_DTYPES['sex'])
+    if sex.isna().any():
+        raise ValueError(f"Unknown sex codes: {sorted(set(df['sex'][sex.isna()].astype(str)))}")
+    return df.assign(year=df['year'].astype(YEAR_DTYPE), sex=sex, count=df['count'].astype(SSA_DTYPES['count']))
+
+
+@register_adapter('csv_dir')
+def load_csv_dir(path, cache_path=None, columns=None, sex_map=None):
+    # Directory with a yobYYYY.txt file for every year (the SSA format) - read concurrently, with the Parquet cache
+    return normalize(load_usa_names(path, cache_path=cache_path), columns, sex_map)
+
+
+@register_adapter('sqlite')
+def load_sqlite(path, tables, columns=None, sex_map=None):
+    # Tables with the same columns (e.g. a table for every sex) combined with UNION ALL,
+    # columns maps the names of the columns in the database to the schema
+    import sqlite3
+
+    select = ', '.join(f'"{source}" AS "{target}"' for source, target in columns.items()) if columns else '*'
+    query = ' UNION ALL '.join(f'SELECT {select} FROM "{table}"' for table in tables)
+    conn = sqlite3.connect(f'file:{quote(os.path.abspath(path))}?mode=ro', uri=True)
+    try:
+        df = pd.read_sql_query(query, conn)
+    finally:
+        conn.close()
+    return normalize(df, sex_map=sex_map)
+
+
+@register_adapter('parquet')
+def load_parquet(path, columns=None, sex_map=None):
+    # Parquet file (or a directory of files) - only the columns of the schema are read
+    import pyarrow.parquet as pq
+
+    df = pq.read_table(path, columns=list(columns) if columns else SCHEMA).to_pandas()
+    return normalize(df, columns, sex_map)
+
+
+class Source:
+    # Dataset of a single country - kind is the name of the adapter and options are its arguments,
+    # code is a short name of the country (e.g. 'pl')
+
+    def __init__(self, country, kind, code=None, **options):
+        if kind not in ADAPTERS:
+            raise ValueError(f'Unknown source kind {kind!r}, available: {sorted(ADAPTERS)}')
+        self.country = country
+        self.kind = kind
+        self.code = code
+        self.options = options
+
+    def __repr__(self):
+        return f'Source({self.country!r}, {self.kind!r})'
+
+    def with_options(self, **options):
+        # The same source with some of the options replaced (e.g. the path of another database with the same layout)
+        return Source(self.country, self.kind, code=self.code, **dict(self.options, **options))
+
+    def fingerprint(self):
+        # Modification time and size of the files of the source - the datasets and the results derived from it
+        # are rebuilt when any of them changes
+        path = self.options['path']
+        return source_fingerprint(list_year_files(path) if self.kind == 'csv_dir' else [path])
+
+
+USA_SOURCE = Source('USA', 'csv_dir', code='us', path=os.path.join('data', 'names'),
+                    cache_path=os.path.join('data', 'cache', 'usa_names.parquet'))
+PL_SOURCE = Source('Poland', 'sqlite', code='pl', path=os.path.join('data', 'names_pl_2000-23.sqlite'), tables=['females', 'males'],
+                   columns={'Rok': 'year', 'Imię': 'name', 'Płeć': 'sex', 'Liczba': 'count'}, sex_map={'K': 'F'})
+DEFAULT_SOURCES = [USA_SOURCE, PL_SOURCE]
+
+
+def country_aliases(countries, sources=DEFAULT_SOURCES):
+    # Names and codes (case insensitive) of the given countries -> the name of the country
+    aliases = {}
+    for source in sources:
+        if source.country in countries and source.code is not None:
+            aliases[source.code.lower()] = source.country
+    aliases.update({country.lower(): country for country in countries})
+    return aliases
+
+
+def load_source(source):
+    return ADAPTERS[source.kind](**source.options)
+
+
+def load_sources(sources, max_workers=None):
+    # Load the sources concurrently (the CSV parser and SQLite release the GIL) - returns {country: DataFrame}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        frames = list(pool.map(load_source, sources))
+    return {source.country: frame for source, frame in zip(sources, frames)}
+
+
+def combine_sources(frames):
+    # Single DataFrame of all the countries with a categorical 'country' column and the names encoded with one name
+    # table (the analysis functions group by the country, so all of them are analyzed in a single pass)
+    names = [frame['name'].cat.categories if isinstance(frame['name'].dtype, pd.CategoricalDtype)
+             else frame['name'].unique() for frame in frames.values()]
+    table = build_name_table(np.concatenate([np.asarray(values, dtype=object) for values in names]))
+    encoded = [encode_names(frame.copy(deep=False), table)[0] for frame in frames.values()]
+    df = pd.concat(encoded, ignore_index=True)
+    df['sex'] = df['sex'].astype(SSA_DTYPES['sex'])
+    codes = np.repeat(np.arange(len(encoded), dtype='int16'), [len(frame) for frame in encoded])
+    df['country'] = pd.Categorical.from_codes(codes, categories=list(frames))
+    return df, table
+
+
+def load_countries(sources=DEFAULT_SOURCES, max_workers=None):
+    return combine_sources(load_sources(sources, max_workers=max_workers))
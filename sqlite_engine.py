@@ -0,0 +1,219 @@
+import os
+import sqlite3
+import threading
+from urllib.parse import quote
+
+import pandas as pd
+
+from analysis import gender_ratio_from_counts, top_n_from_frequency
+from loader import SSA_DTYPES
+from profiling import profiled
+
+# Tables of the Polish database: (table, sex) - the sex is taken from the table, so the queries can use the indexes
+PL_TABLES = [('females', 'F'), ('males', 'M')]
+
+# Window functions (SUM() OVER) are available since SQLite 3.25 - older versions join the totals instead
+WINDOW_FUNCTIONS = sqlite3.sqlite_version_info >= (3, 25, 0)
+
+# Rows fetched at once when the rows themselves (not the aggregates) are needed
+CHUNK_SIZE = 100000
+ROW_DTYPES = {'year': 'int16', 'frequency': 'float64', 'in_top': 'bool'}
+
+
+def create_indexes(db_path):
+    # Covering indexes for the queries below: (year, count) for the totals and the minimum of every year,
+    # (name, year, count) for the sums of every name. This modifies the database, so it's done only on request
+    # (SQLiteNames(..., index=True) or main.py --pl-index) - without them the queries scan the tables
+    conn = sqlite3.connect(db_path)
+    try:
+        for table, _ in PL_TABLES:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_year_count ON {table} (Rok, Liczba)')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_name_year_count ON {table} (Imię, Rok, Liczba)')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def has_indexes(db_path):
+    conn = sqlite3.connect(f'file:{quote(os.path.abspath(db_path))}?mode=ro', uri=True)
+    try:
+        names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    finally:
+        conn.close()
+    return all(f'{table}_name_year_count' in names and f'{table}_year_count' in names for table, _ in PL_TABLES)
+
+
+class SQLiteNames:
+    # Polish names engine - the aggregations of Tasks 12 and 13 are calculated by SQLite, so only the small
+    # results (one row per name, per year or per year and sex) are loaded into pandas.
+    # The database is opened once, read-only and immutable (SQLite doesn't check for changes made by other
+    # connections), with a larger page cache and memory mapping. The connection is shared by the threads
+    # (the queries are serialized with a lock); in another process the database is opened again.
+    # index=True adds the covering indexes to the database first (if they're missing and it's writable)
+
+    def __init__(self, db_path, cache_mb=256, mmap_mb=1024, index=False):
+        self.db_path = db_path
+        self.cache_mb = cache_mb
+        self.mmap_mb = mmap_mb
+        self.index = index
+        if index and os.access(db_path, os.W_OK) and not has_indexes(db_path):
+            create_indexes(db_path)
+        self.conn = sqlite3.connect(f'file:{quote(os.path.abspath(db_path))}?mode=ro&immutable=1', uri=True,
+                                    check_same_thread=False)
+        # Negative cache_size is in KiB
+        self.conn.execute(f'PRAGMA cache_size = {-cache_mb * 1024}')
+        self.conn.execute(f'PRAGMA mmap_size = {mmap_mb * 2 ** 20}')
+        self.conn.execute('PRAGMA temp_store = MEMORY')
+        self.lock = threading.RLock()
+        self.top_names_key = None
+        self.totals = None
+
+    def __getstate__(self):
+        return {'db_path': self.db_path, 'cache_mb': self.cache_mb, 'mmap_mb': self.mmap_mb, 'index': False}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def close(self):
+        self.conn.close()
+
+    def query(self, sql, params=(), dtype=None, chunksize=None):
+        # Read the result into a DataFrame - with chunksize the rows are fetched (and converted to the given types)
+        # in chunks, so the intermediate Python objects are never created for the whole result at once
+        with self.lock:
+            if chunksize is None:
+                return pd.read_sql_query(sql, self.conn, params=params, dtype=dtype)
+            chunks = list(pd.read_sql_query(sql, self.conn, params=params, dtype=dtype, chunksize=chunksize))
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=list(dtype or []))
+
+    def params(self, years):
+        # The years are used once in every table's query (as Python ints - sqlite3 doesn't bind NumPy integers)
+        return tuple(int(year) for year in years) * len(PL_TABLES) if years is not None else ()
+
+    # Totals of the years
+    def year_totals(self):
+        # Sum, minimum and maximum count of every year and sex - read once from the (year, count) indexes and kept
+        # in the instance and in a temporary table, which the queries below join instead of grouping all the rows
+        with self.lock:
+            if self.totals is None:
+                totals = pd.concat([self.query(f"SELECT Rok AS year, '{sex}' AS sex, SUM(Liczba) AS total, "
+                                               f"MIN(Liczba) AS low, MAX(Liczba) AS high FROM {table} GROUP BY Rok",
+                                               dtype={'year': 'int16', 'total': 'int64', 'low': 'int64',
+                                                      'high': 'int64'})
+                                    for table, sex in PL_TABLES], ignore_index=True)
+                self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS year_totals (year INTEGER, sex TEXT, '
+                                  'total INTEGER, PRIMARY KEY (sex, year)) WITHOUT ROWID')
+                self.conn.execute('DELETE FROM year_totals')
+                self.conn.executemany('INSERT INTO year_totals VALUES (?, ?, ?)',
+                                      [(int(year), sex, int(total)) for year, sex, total
+                                       in totals[['year', 'sex', 'total']].itertuples(index=False)])
+                self.totals = totals.sort_values(['year', 'sex'], ignore_index=True)
+            return self.totals
+
+    # Aggregates
+    def number_of_years(self):
+        return self.year_totals()['year'].nunique()
+
+    def births_by_sex(self):
+        # Number of births of every sex in every year (the same as analysis.births_by_sex)
+        return self.year_totals().set_index(['year', 'sex'])['total'].rename('count')
+
+    def lowest_count(self):
+        # The lowest count of every year
+        return self.year_totals().groupby('year')['low'].min().rename('count')
+
+    @profiled
+    def names_frequency(self):
+        # Frequency of every (name, sex) pair averaged over the years, sorted like the groupby in pandas.
+        # Every table is grouped by the name on its own (reading the (name, year, count) index in order)
+        self.year_totals()
+        with self.lock:
+            parts = [self.query(f"SELECT Imię AS name, '{sex}' AS sex, SUM(CAST(Liczba AS REAL) / t.total) "
+                                f"AS frequency FROM {table} JOIN year_totals AS t ON t.sex = '{sex}' AND t.year = Rok "
+                                f"GROUP BY Imię")
+                     for table, sex in PL_TABLES]
+        frequency = pd.concat(parts, ignore_index=True).set_index(['name', 'sex'])['frequency'].sort_index()
+        return frequency / self.number_of_years()
+
+    @profiled
+    def top_n_names(self, n):
+        # The same ranking as calculate_top_n_names
+        return top_n_from_frequency(self.names_frequency(), n)
+
+    def use_top_names(self, top_names):
+        # Store the ranking in a temporary table (in memory, the database itself stays read-only).
+        # The callers hold the lock until their query is done, so another thread can't replace the ranking meanwhile
+        key = tuple(top_names.index)
+        with self.lock:
+            if key == self.top_names_key:
+                return
+            self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS top_names (name TEXT, sex TEXT, PRIMARY KEY (name, sex))'
+                              ' WITHOUT ROWID')
+            self.conn.execute('DELETE FROM top_names')
+            self.conn.executemany('INSERT OR IGNORE INTO top_names VALUES (?, ?)',
+                                  [(str(name), str(sex)) for name, sex in key])
+            self.top_names_key = key
+
+    @profiled
+    def name_diversity(self, top_names):
+        # The same as the percentages of calculate_name_diversity - only the rows of the top names are read
+        # (looked up in the (name, year, count) index), the totals come from year_totals
+        totals = self.year_totals().set_index(['year', 'sex'])['total']
+        with self.lock:
+            self.use_top_names(top_names)
+            top = pd.concat([self.query(f"SELECT Rok AS year, '{sex}' AS sex, SUM(Liczba) AS count "
+                                        f"FROM top_names AS t JOIN {table} ON Imię = t.name WHERE t.sex = '{sex}' "
+                                        f"GROUP BY Rok", dtype={'year': 'int16', 'count': 'int64'})
+                             for table, sex in PL_TABLES], ignore_index=True).set_index(['year', 'sex'])['count']
+        top_percentage = top.reindex(totals.index, fill_value=0) / totals
+        reshaped = top_percentage.unstack(level='sex')
+        reshaped.index = reshaped.index.astype('int64')
+        reshaped['difference'] = abs(reshaped['M'] - reshaped['F'])
+        return reshaped
+
+    @profiled
+    def name_gender_ratio(self, start_year, end_year, only_top, top_names):
+        # The same as calculate_name_gender_ratio - the sums of the range are calculated by SQLite, a name in the
+        # ranking is in the top in all its rows, so in_top is the number of its years
+        parts = [self.query(f"SELECT Imię AS name, '{sex}' AS sex, SUM(Liczba) AS count, COUNT(*) AS years "
+                            f"FROM {table} WHERE Rok BETWEEN ? AND ? GROUP BY Imię",
+                            params=(int(start_year), int(end_year)), dtype={'count': 'int64', 'years': 'int64'})
+                 for table, sex in PL_TABLES]
+        df = pd.concat(parts, ignore_index=True)
+        df['sex'] = df['sex'].astype(SSA_DTYPES['sex'])
+        df = df.set_index(['name', 'sex']).sort_index()
+        df['in_top'] = df.pop('years').where(df.index.isin(top_names.index), 0)
+        return gender_ratio_from_counts(df, only_top)
+
+    @profiled
+    def frequency_rows(self, years, top_names):
+        # Rows of the given years with the frequency and in_top (e.g. for the histograms), read in typed chunks.
+        # The whole years are selected, so the window over the selected rows gives the totals of the years
+        self.year_totals()
+        in_list = ', '.join('?' * len(years))
+        parts = []
+        for table, sex in PL_TABLES:
+            if WINDOW_FUNCTIONS:
+                frequency, source = 'CAST(Liczba AS REAL) / SUM(Liczba) OVER (PARTITION BY Rok)', table
+            else:
+                frequency = 'CAST(Liczba AS REAL) / y.total'
+                source = f"{table} JOIN year_totals AS y ON y.sex = '{sex}' AND y.year = Rok"
+            parts.append(f"SELECT Rok AS year, '{sex}' AS sex, {frequency} AS frequency, "
+                         f"EXISTS (SELECT 1 FROM top_names AS t WHERE t.name = Imię AND t.sex = '{sex}') AS in_top "
+                         f"FROM {source} WHERE Rok IN ({in_list})")
+        with self.lock:
+            self.use_top_names(top_names)
+            df = self.query(' UNION ALL '.join(parts), params=self.params(years), dtype=ROW_DTYPES,
+                            chunksize=CHUNK_SIZE)
+        df['sex'] = df['sex'].astype(SSA_DTYPES['sex'])
+        return df
+
+    def female_frequency_range(self):
+        # Range of df.legacy['frequency_female'] for the whole dataset (0 for the male rows) - the extremes of
+        # every year are its lowest and highest count divided by its total
+        totals = self.year_totals()
+        female = totals[totals['sex'] == 'F']
+        low, high = (female['low'] / female['total']).min(), (female['high'] / female['total']).max()
+        if (totals['sex'] != 'F').any():
+            low, high = min(low, 0.0), max(high, 0.0)
+        return float(low), float(high)
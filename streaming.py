@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from analysis import calculate_frequency, gender_ratio_from_counts, top_n_from_frequency
+from loader import FINGERPRINT_KEY, SSA_DTYPES, list_year_files, load_year_file, source_fingerprint
+from name_table import build_name_table, encode_names, in_ranking, name_attribute
+from sources import USA_SOURCE
+
+# Number of partial aggregates kept in memory before they are merged into one
+MERGE_EVERY = 16
+
+
+def year_partitions(data_dir, cache_path=None):
+    # Yield the dataset one year at a time, so that at most one year of rows is in memory.
+    # If the Parquet cache is up to date, its row groups are read, otherwise the yob*.txt files
+    files = list_year_files(data_dir)
+    if cache_path is not None and os.path.exists(cache_path):
+        parquet_file = pq.ParquetFile(cache_path)
+        stored = (parquet_file.schema_arrow.metadata or {}).get(FINGERPRINT_KEY)
+        if stored is not None and json.loads(stored) == source_fingerprint(files):
+            # Every row group has the rows of a single year, but a year can be split into several row groups
+            # (e.g. in the caches written before the size of the row groups was set) - they're joined
+            year_tables = []
+            for i in range(parquet_file.num_row_groups):
+                table = parquet_file.read_row_group(i)
+                if table.num_rows == 0:
+                    continue
+                if year_tables and table['year'][0].as_py() != year_tables[0]['year'][0].as_py():
+                    yield encode_partition(pa.concat_tables(year_tables).to_pandas())
+                    year_tables = []
+                year_tables.append(table)
+            if year_tables:
+                yield encode_partition(pa.concat_tables(year_tables).to_pandas())
+            return
+
+    for file in files:
+        yield encode_partition(load_year_file(file))
+
+
+def encode_partition(df):
+    # Every partition gets its own (small) name table
+    df['sex'] = df['sex'].astype(SSA_DTYPES['sex'])
+    df, _ = encode_names(df)
+    return df
+
+
+def plain_index(df):
+    # Replace the categorical levels of the index with plain values, so that partial aggregates
+    # of partitions with different name tables can be combined
+    levels = [np.asarray(df.index.get_level_values(i), dtype=object) for i in range(df.index.nlevels)]
+    df.index = pd.MultiIndex.from_arrays(levels, names=df.index.names)
+    return df
+
+
+def merge_partials(partials, keys):
+    # Combine the partial aggregates into one by summing over the keys
+    return pd.concat(partials).groupby(level=keys).sum()
+
+
+def accumulate(partials_iter, keys):
+    # Sum the partial aggregates, merging them every MERGE_EVERY partitions to keep the memory bounded
+    pending = []
+    for partial in partials_iter:
+        pending.append(plain_index(partial))
+        if len(pending) >= MERGE_EVERY:
+            pending = [merge_partials(pending, keys)]
+    return merge_partials(pending, keys) if pending else None
+
+
+# Task 4
+def stream_frequency(partitions, dtype='float64'):
+    # Add the frequency column to every partition - the totals are per year, so one partition is enough to compute them
+    for df in partitions:
+        yield calculate_frequency(df, dtype)
+
+
+# Tasks 2 and 3
+def stream_unique_names(partitions):
+    # Number of unique names (overall and for each sex) - only the sets of names are kept in memory
+    names_by_sex = {}
+    for df in partitions:
+        for sex, names in df.groupby('sex', observed=True)['name']:
+            names_by_sex.setdefault(sex, set()).update(names.unique())
+    all_names = set().union(*names_by_sex.values())
+    by_sex = pd.Series({sex: len(names) for sex, names in sorted(names_by_sex.items())}, name='name')
+    by_sex.index.name = 'sex'
+    return len(all_names), by_sex
+
+
+# Task 6
+def stream_top_n_names(partitions, n):
+    years = set()
+
+    def partials():
+        for df in stream_frequency(partitions):
+            years.update(df['year'].unique())
+            yield df.groupby(['name', 'sex'], observed=True)[['frequency']].sum()
+
+    names_frequency = accumulate(partials(), ['name', 'sex'])['frequency'] / len(years)
+    return top_n_from_frequency(names_frequency, n)
+
+
+# Task 8
+def stream_name_diversity(partitions, top_names):
+    # Percentage of births with the names in the ranking - calculated separately for every year
+    parts = []
+    for df in partitions:
+        df['in_top'] = in_ranking(df, top_names.index)
+        df['in_top_count'] = np.where(df['in_top'], df['count'], 0)
+        totals = df.groupby(['year', 'sex'], observed=True)[['in_top_count', 'count']].sum()
+        parts.append(totals['in_top_count'] / totals['count'])
+
+    reshaped = pd.concat(parts).unstack(level='sex')
+    reshaped['difference'] = abs(reshaped['M'] - reshaped['F'])
+    return reshaped
+
+
+# Task 9
+def stream_last_letter_distribution(partitions):
+    # Popularity of the last letters for every year and sex (the partitions don't overlap, so they are just concatenated)
+    parts = []
+    for df in partitions:
+        names = build_name_table(df['name'].cat.categories)
+        df['last_letter'] = np.asarray(name_attribute(df, names, 'last_letter'), dtype=object)
+        parts.append(df.groupby(['year', 'sex', 'last_letter'], observed=True)['count'].sum())
+
+    last_letter_df = pd.concat(parts).unstack(level='last_letter', fill_value=0)
+    return last_letter_df.div(last_letter_df.sum(axis=1), axis=0)
+
+
+# Task 10
+def stream_name_gender_ratio(partitions, start_year, end_year, only_top, top_names=None):
+    def partials():
+        for df in partitions:
+            df = df[df['year'].between(start_year, end_year)]
+            if df.empty:
+                continue
+            df = df.assign(in_top=in_ranking(df, top_names.index) if top_names is not None else False)
+            yield df.groupby(['name', 'sex'], observed=True)[['count', 'in_top']].sum()
+
+    return gender_ratio_from_counts(accumulate(partials(), ['name', 'sex']), only_top)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Answers of the USA tasks with at most one year of rows in memory')
+    parser.add_argument('--data-dir', default=USA_SOURCE.options['path'], help='directory with the yob*.txt files')
+    parser.add_argument('--cache', default=USA_SOURCE.options['cache_path'],
+                        help='Parquet cache read instead of the files when it is up to date')
+    parser.add_argument('--n', type=int, default=1000, help='length of the ranking')
+    parser.add_argument('--top', type=int, default=10, help='number of the names of the ranking to display')
+    args = parser.parse_args()
+
+    def partitions():
+        # Every analysis makes its own pass over the years
+        return year_partitions(args.data_dir, args.cache)
+
+    start_time = time.perf_counter()
+    unique_names, unique_names_by_sex = stream_unique_names(partitions())
+    print('2. Number of unique names:', unique_names)
+    print('3. Number of unique names by sex:', unique_names_by_sex)
+
+    top_names = stream_top_n_names(partitions(), args.n)
+    print(f'6. Top {args.top} of the {args.n} most popular names:')
+    print(top_names.head(args.top).to_string())
+
+    diversity = stream_name_diversity(partitions(), top_names)
+    max_diff_year = diversity['difference'].idxmax()
+    print('8. Year with the greatest difference in diversity was:', max_diff_year, 'and the difference was:',
+          diversity.loc[max_diff_year, 'difference'])
+
+    last_letters_male = stream_last_letter_distribution(partitions()).xs(key='M', level='sex').T
+    if {1910, 2023} <= set(last_letters_male.columns):
+        last_letter_diff = last_letters_male[2023] - last_letters_male[1910]
+        print('9. Letter with the greatest increase between 1910 and 2023:', last_letter_diff.idxmax(),
+              'and the increase was:', last_letter_diff.max())
+        print('Letter with the greatest decrease between 1910 and 2023:', last_letter_diff.idxmin(),
+              'and the decrease was:', last_letter_diff.min())
+
+    name_ratios_1880_1920 = stream_name_gender_ratio(partitions(), 1880, 1920, True, top_names)
+    name_ratios_2000_2023 = stream_name_gender_ratio(partitions(), 2000, 2023, True, top_names)
+    m2f_change = (name_ratios_1880_1920['p_m'] + name_ratios_2000_2023['p_f']) / 2
+    print('10. Name with the largest change from being a female name to a male name is:', m2f_change.idxmin(),
+          'and the change of p_m is:', 1 - m2f_change.min())
+    print('Name with the largest change from being a male name to a female name is:', m2f_change.idxmax(),
+          'and the change of p_m is:', -m2f_change.max())
+    print(f'Answered in {time.perf_counter() - start_time:.2f} s')
@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+
+
+def top_n_ids(scores, n, candidates):
+    # Ids of the n highest scores (only among the candidates), sorted in descending order.
+    # Ties are resolved in favour of the lower id, the same way as DataFrame.nlargest does it
+    ids = np.flatnonzero(candidates)
+    values = scores[ids]
+    if n < len(ids):
+        # Partial sort - find the n-th largest value, and keep everything above it and the first ties
+        threshold = np.partition(values, len(values) - n)[len(values) - n]
+        above = values > threshold
+        ties = np.flatnonzero(values == threshold)[:n - above.sum()]
+        keep = above
+        keep[ties] = True
+        ids, values = ids[keep], values[keep]
+    order = np.lexsort((ids, -values))
+    return ids[order]
+
+
+class CountTensor:
+    # Dense years x names x sexes matrix of counts, built once from the DataFrame (with the encoded names),
+    # on which the statistics are computed with vectorized axis sums instead of groupby/pivot_table calls
+
+    def __init__(self, df):
+        self.years = np.sort(df['year'].unique())
+        self.names = df['name'].cat.categories
+        self.sexes = df['sex'].cat.categories
+        self.name_dtype = df['name'].dtype
+        self.sex_dtype = df['sex'].dtype
+
+        year_ids = np.searchsorted(self.years, df['year'].to_numpy())
+        self.counts = np.zeros((len(self.years), len(self.names), len(self.sexes)), dtype=np.uint32)
+        np.add.at(self.counts, (year_ids, df['name'].cat.codes.to_numpy(), df['sex'].cat.codes.to_numpy()),
+                  df['count'].to_numpy().astype(np.uint32))
+
+        # Rows that exist in the DataFrame (a name given to a sex in a year)
+        self.present = self.counts > 0
+        # Total number of births for each year and sex (equivalent of 'total_births_by_sex')
+        self.totals = self.counts.sum(axis=1, dtype=np.uint64)
+
+    def sex_id(self, sex):
+        return self.sexes.get_loc(sex)
+
+    def year_slice(self, start_year, end_year):
+        return slice(np.searchsorted(self.years, start_year, 'left'), np.searchsorted(self.years, end_year, 'right'))
+
+    def ranking_mask(self, top_names):
+        # Boolean names x sexes matrix with the (name, sex) pairs that are in the ranking
+        name_ids = self.names.get_indexer(top_names.index.get_level_values('name'))
+        sex_ids = self.sexes.get_indexer(top_names.index.get_level_values('sex'))
+        found = (name_ids >= 0) & (sex_ids >= 0)
+        mask = np.zeros((len(self.names), len(self.sexes)), dtype=bool)
+        mask[name_ids[found], sex_ids[found]] = True
+        return mask
+
+    # Task 4
+    def births_by_sex(self):
+        # Number of births for each year (rows) and sex (columns)
+        return pd.DataFrame(self.totals, index=pd.Index(self.years, name='year'),
+                            columns=pd.CategoricalIndex(self.sexes, dtype=self.sex_dtype, name='sex'))
+
+    def frequency(self, name, sex):
+        # Popularity of the name in every year (0 for the years in which the name wasn't given)
+        counts = self.counts[:, self.names.get_loc(name), self.sex_id(sex)]
+        totals = self.totals[:, self.sex_id(sex)]
+        return pd.Series(counts / totals, index=pd.Index(self.years, name='year'), name='frequency')
+
+    # Task 6
+    def top_n_names(self, n):
+        # Sum of the yearly popularity of each name divided by the number of years, as in calculate_top_n_names
+        scores = np.einsum('yns,ys->ns', self.counts, 1 / self.totals) / len(self.years)
+        observed = self.present.any(axis=0)
+
+        parts = []
+        for sex, column in [('M', 'frequency_male'), ('F', 'frequency_female')]:
+            s = self.sex_id(sex)
+            ids = top_n_ids(scores[:, s], n, observed[:, s])
+            index = pd.MultiIndex.from_arrays([pd.Categorical.from_codes(ids, dtype=self.name_dtype),
+                                               pd.Categorical([sex] * len(ids), dtype=self.sex_dtype)],
+                                              names=['name', 'sex'])
+            part = pd.DataFrame({'frequency_male': 0.0, 'frequency_female': 0.0}, index=index)
+            part[column] = scores[ids, s]
+            parts.append(part)
+        return pd.concat(parts)
+
+    # Task 8
+    def name_diversity(self, top_names):
+        # Percentage of births with names in the ranking, for every year and sex
+        mask = self.ranking_mask(top_names)
+        in_top = np.einsum('yns,ns->ys', self.counts, mask, dtype=np.uint64)
+        reshaped = pd.DataFrame(in_top / self.totals, index=pd.Index(self.years, name='year'),
+                                columns=pd.CategoricalIndex(self.sexes, dtype=self.sex_dtype, name='sex'))
+        reshaped['difference'] = abs(reshaped['M'] - reshaped['F'])
+        return reshaped
+
+    # Task 10
+    def name_gender_ratio(self, start_year, end_year, only_top, top_names=None):
+        window = self.year_slice(start_year, end_year)
+        counts = self.counts[window].sum(axis=0, dtype=np.uint64)
+        years_present = self.present[window].sum(axis=0)
+
+        # Keep only the (name, sex) pairs and the names that were given in the range, the same as the groupby does
+        observed = years_present > 0
+        rows = observed.any(axis=1)
+        if top_names is not None:
+            in_top = years_present * self.ranking_mask(top_names)
+        else:
+            in_top = np.zeros_like(years_present)
+        if only_top:
+            # In pandas the in_top of a sex that wasn't given the name is NaN, so the sum is NaN and the name
+            # is dropped - only the names given to both sexes (with a pair in the ranking) are kept
+            rows &= observed.all(axis=1) & (in_top.sum(axis=1) > 0)
+
+        counts = np.where(observed, counts, np.nan)[rows]
+        in_top = np.where(observed, in_top, np.nan)[rows]
+        index = pd.CategoricalIndex(self.names[rows], dtype=self.name_dtype, name='name')
+        columns = pd.MultiIndex.from_product([['count', 'in_top'], list(self.sexes)], names=[None, 'sex'])
+        ratio_df = pd.DataFrame(np.hstack([counts, in_top]), index=index, columns=columns)
+
+        m, f = self.sex_id('M'), self.sex_id('F')
+        ratio_df['p_m'] = counts[:, m] / (counts[:, m] + counts[:, f])
+        ratio_df['p_f'] = 1 - ratio_df['p_m']
+        if only_top:
+            ratio_df = ratio_df.drop(columns=['count', 'in_top'])
+        return ratio_df